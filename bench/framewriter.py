@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Frame transport throughput, VapourSynth output against FrameWriter
+#
+#   python bench/framewriter.py [frames]
+
+import os
+import subprocess
+import sys
+import time
+
+import vapoursynth as vs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pyhenkan.framewriter import FrameWriter, get_pix_fmt
+
+SIZES = [('1080p', 1920, 1080), ('2160p', 3840, 2160)]
+
+
+def get_clip(width, height, frames):
+    core = vs.get_core()
+    # One blank frame repeated, rendering costs next to nothing
+    clip = core.std.BlankClip(width=width, height=height,
+                              format=vs.YUV420P8, length=1, fpsnum=24,
+                              fpsden=1)
+    return clip * frames
+
+
+def vs_output(clip, stream):
+    clip.output(stream, y4m=True)
+
+
+def writer_y4m(clip, stream):
+    FrameWriter(clip, stream, y4m=True).write()
+
+
+def writer_raw(clip, stream):
+    FrameWriter(clip, stream, y4m=False).write()
+
+
+def to_devnull(clip, method, y4m):
+    with open(os.devnull, 'wb') as f:
+        method(clip, f)
+
+
+def to_ffmpeg(clip, method, y4m):
+    cmd = ['ffmpeg', '-v', 'error', '-nostdin']
+    if not y4m:
+        cmd += ['-f', 'rawvideo', '-pix_fmt', get_pix_fmt(clip.format),
+                '-s', '{}x{}'.format(clip.width, clip.height),
+                '-r', '{}/{}'.format(clip.fps_num, clip.fps_den)]
+    cmd += ['-i', '-', '-f', 'null', '-']
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    method(clip, proc.stdin)
+    proc.stdin.close()
+    proc.wait()
+
+
+def get_cpu():
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.partition(':')[2].strip()
+    except OSError:
+        pass
+    return 'unknown CPU'
+
+
+def get_ffmpeg():
+    try:
+        out = subprocess.check_output(['ffmpeg', '-version'])
+    except (OSError, subprocess.CalledProcessError):
+        return 'no ffmpeg'
+    return out.decode(errors='replace').splitlines()[0]
+
+
+def print_env(frames):
+    # Numbers mean nothing without the machine they come from
+    print('CPU: {}, {} threads'.format(get_cpu(), os.cpu_count()))
+    print('VapourSynth: {}'.format(
+        vs.get_core().version().splitlines()[0]))
+    print('{}'.format(get_ffmpeg()))
+    print('Frames: {}'.format(frames))
+    print()
+
+
+def main(frames):
+    print_env(frames)
+    methods = [('clip.output y4m', vs_output, True),
+               ('FrameWriter y4m', writer_y4m, True),
+               ('FrameWriter raw', writer_raw, False)]
+    sinks = [('/dev/null', to_devnull), ('ffmpeg', to_ffmpeg)]
+
+    print('{:<6} {:<10} {:<16} {:>10} {:>8}'.format('size', 'sink',
+                                                    'method', 'MB/s', 'fps'))
+    for name, width, height in SIZES:
+        clip = get_clip(width, height, frames)
+        size = width * height * 3 // 2 * frames
+        for sink, run in sinks:
+            for method, write, y4m in methods:
+                start = time.perf_counter()
+                run(clip, write, y4m)
+                elapsed = time.perf_counter() - start
+                print('{:<6} {:<10} {:<16} {:>10.1f} {:>8.1f}'.format(
+                    name, sink, method, size / elapsed / 1e6,
+                    frames / elapsed))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
+
+# vim: ts=4 sw=4 et:
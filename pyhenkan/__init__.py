@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 
+from threading import Thread
+
+from pyhenkan import cli
+from pyhenkan.budget import SizeBudget
 from pyhenkan.chapter import ChapterEditorWindow
+from pyhenkan.crfsearch import CrfSearch
 from pyhenkan.environment import Environment
-from pyhenkan.mediafile import MediaFile
+from pyhenkan.estimate import Estimator
+from pyhenkan.index import Indexer
+from pyhenkan.mediafile import MediaFile, resume
 from pyhenkan.plugin import CropAbs, CropRel, ResizePlugin, SourcePlugin
-from pyhenkan.queue import Queue
+from pyhenkan.queue import GtkQueueView, Queue
 from pyhenkan.script import ScriptCreatorWindow
 from pyhenkan.vapoursynth import VapourSynth
 
@@ -122,6 +130,7 @@ class MainWindow(Gtk.Window):
         output_hsep1 = Gtk.Separator(orientation=Gtk.Orientation.HORIZONTAL)
         output_hsep2 = Gtk.Separator(orientation=Gtk.Orientation.HORIZONTAL)
         output_hsep3 = Gtk.Separator(orientation=Gtk.Orientation.HORIZONTAL)
+        output_hsep4 = Gtk.Separator(orientation=Gtk.Orientation.HORIZONTAL)
 
         self.out_name_entry = Gtk.Entry()
         self.out_name_entry.set_sensitive(False)
@@ -169,6 +178,35 @@ class MainWindow(Gtk.Window):
         output_hbox.pack_start(Gtk.Label('.'), False, False, 0)
         output_hbox.pack_start(self.out_cont_cbtext, False, True, 0)
 
+        # Total size of the queued files, 0 keeps the codec settings
+        budget_label = Gtk.Label('Size Budget (MB)')
+        budget_adj = Gtk.Adjustment(0, 0, 10000000, 100, 1000)
+        self.budget_spin = Gtk.SpinButton()
+        self.budget_spin.set_adjustment(budget_adj)
+        self.budget_spin.set_numeric(True)
+        self.budget_spin.set_property('hexpand', True)
+
+        # Highest CRF whose worst sampled segment reaches the score
+        crf_target_label = Gtk.Label('CRF Target')
+        self.crf_metric_cbtext = Gtk.ComboBoxText()
+        for m in ['Off', 'SSIM', 'PSNR']:
+            self.crf_metric_cbtext.append_text(m)
+        self.crf_metric_cbtext.set_active(0)
+        self.crf_metric_cbtext.connect('changed', self.on_crf_metric_changed)
+        crf_target_adj = Gtk.Adjustment(0.98, 0, 100, 0.001, 0.01)
+        self.crf_target_spin = Gtk.SpinButton()
+        self.crf_target_spin.set_adjustment(crf_target_adj)
+        self.crf_target_spin.set_digits(3)
+        self.crf_target_spin.set_numeric(True)
+        self.crf_target_spin.set_property('hexpand', True)
+        self.crf_target_spin.set_sensitive(False)
+
+        crf_target_hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL,
+                                  spacing=6)
+        crf_target_hbox.pack_start(crf_target_label, False, False, 0)
+        crf_target_hbox.pack_start(self.crf_metric_cbtext, False, True, 0)
+        crf_target_hbox.pack_start(self.crf_target_spin, True, True, 0)
+
         self.queue_button = Gtk.Button('Queue')
         self.queue_button.set_property('hexpand', True)
         self.queue_button.set_sensitive(False)
@@ -187,10 +225,18 @@ class MainWindow(Gtk.Window):
         output_box.pack_start(self.out_start_spin, True, True, 0)
         output_box.pack_start(self.out_end_spin, True, True, 0)
         output_box.pack_start(output_hsep3, False, False, 0)
+        output_box.pack_start(budget_label, True, True, 0)
+        output_box.pack_start(self.budget_spin, True, True, 0)
+        output_box.pack_start(crf_target_hbox, True, True, 0)
+        output_box.pack_start(output_hsep4, False, False, 0)
         output_box.pack_start(self.queue_button, False, False, 0)
 
         # -- Queue -- #
         self.queue = Queue()
+        self.queue_view = GtkQueueView(self.queue, Estimator())
+        self.queue.view = self.queue_view
+        # Requeue the jobs left unfinished by a previous session
+        resume()
 
         # -- Notebook --#
         input_label = Gtk.Label('Input')
@@ -200,7 +246,7 @@ class MainWindow(Gtk.Window):
         notebook = Gtk.Notebook()
         notebook.append_page(input_box, input_label)
         notebook.append_page(output_box, output_label)
-        notebook.append_page(self.queue.vbox, queue_label)
+        notebook.append_page(self.queue_view.vbox, queue_label)
 
         for tab in notebook.get_children():
             notebook.child_set_property(tab, 'tab-expand', True)
@@ -208,7 +254,8 @@ class MainWindow(Gtk.Window):
         # -- Main Box -- #
         main_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
         main_box.pack_start(notebook, True, True, 0)
-        main_box.pack_start(self.queue.pbar, False, True, 0)
+        main_box.pack_start(self.queue_view.pbar, False, True, 0)
+        main_box.pack_start(self.queue_view.index_pbar, False, True, 0)
 
         self.add(main_box)
 
@@ -249,7 +296,10 @@ class MainWindow(Gtk.Window):
 
             self.wdir = dlg.get_current_folder()
             for f in dlg.get_filenames():
-                self.files.append(MediaFile(f))
+                mf = MediaFile(f)
+                # Indexes while the next files are parsed and set up
+                Indexer().submit(mf)
+                self.files.append(mf)
 
             # TODO find a cleaner way to do this
             self.workfile = self.files[0]
@@ -493,47 +543,72 @@ class MainWindow(Gtk.Window):
         #             t.default = False
 
     def on_queue_clicked(self, button):
-        for f in self.files:
+        files = list(self.files)
+        for f in files:
             name = self.out_name_entry.get_text()
             suffix = self.out_suffix_entry.get_text()
             cont = self.out_cont_cbtext.get_active_text()
             f.oname = '.'.join(['_'.join([name if name else f.name, suffix]),
                                 cont])
 
-            f.process()
-
-            # Clean up
-            self.queue.executor.submit(f.clean)
-
-            # Update queue
-            self.queue.executor.submit(self.queue.update)
-
-            # Add a wait job after each encoding job
-            future = self.queue.executor.submit(self.queue.wait)
-            self.queue.waitlist.append(future)
-            if self.queue.idle:
-                GLib.idle_add(self.queue.start_button.set_sensitive, True)
-                GLib.idle_add(self.queue.delete_button.set_sensitive, True)
-                GLib.idle_add(self.queue.clear_button.set_sensitive, True)
+        budget = self.budget_spin.get_value_as_int()
+        metric = self.crf_metric_cbtext.get_active_text()
+        search = None
+        if metric != 'Off' and not budget:
+            target = self.crf_target_spin.get_value()
+            search = CrfSearch(metric.lower(), target)
+        if budget or search:
+            # Measuring takes a while, keep the window responsive
+            self.queue_button.set_sensitive(False)
+            Thread(target=self._prepare, args=(files, budget, search),
+                   daemon=True).start()
+        else:
+            self._process(files)
+
+        # Create new MediaFile instances and carry settings over
+        # Otherwise they may have changed by the time jobs are processed
+        for i in range(len(self.files)):
+            self.files[i] = self.files[i].copy()
+        self.workfile = self.files[0]
+        self.tracklist = self.workfile.tracklist
+
+    def on_crf_metric_changed(self, cbtext):
+        metric = cbtext.get_active_text()
+        self.crf_target_spin.set_sensitive(metric != 'Off')
+        # Sensible starting points
+        if metric == 'SSIM':
+            self.crf_target_spin.set_value(0.98)
+        elif metric == 'PSNR':
+            self.crf_target_spin.set_value(42)
+
+    def _prepare(self, files, budget, search):
+        try:
+            if budget:
+                SizeBudget(budget).apply(files)
+            else:
+                search.apply(files)
+        except Exception as e:
+            GLib.idle_add(self._prepare_failed, str(e))
+            return
+        GLib.idle_add(self._process, files)
+
+    def _prepare_failed(self, text):
+        self.queue_button.set_sensitive(True)
+        dialog = Gtk.MessageDialog(self, 0, Gtk.MessageType.ERROR,
+                                   Gtk.ButtonsType.OK, 'Queue Failed')
+        dialog.format_secondary_text(text)
+        dialog.run()
+        dialog.destroy()
 
-            # Create new MediaFile instances and carry settings over
-            # Otherwise they may have changed by the time jobs are processed
-                for i in range(len(self.files)):
-                    self.files[i] = self.files[i].copy()
-                self.workfile = self.files[0]
-                self.tracklist = self.workfile.tracklist
+    def _process(self, files):
+        self.queue_button.set_sensitive(True)
+        for f in files:
+            f.process()
 
     def on_delete_event(event, self, widget):
-        # Cancel all jobs
-        for job in self.queue.tstore:
-            for step in job.iterchildren():
-                future = self.queue.tstore.get_value(step.iter, 0)
-                if not future.done():
-                    future.cancel()
-        for future in self.queue.waitlist:
-            future.cancel()
+        # Stop running jobs, the journal keeps them for the next session
+        self.queue.stop()
         Notify.uninit()
-        self.queue.lock.release()
         Gtk.main_quit()
 
 
@@ -554,7 +629,13 @@ class AboutDialog(Gtk.AboutDialog):
         self.set_license_type(Gtk.License.GPL_3_0)
         self.set_website('https://github.com/alucryd/pyhenkan')
 
-MainWindow().show_all()
-Gtk.main()
+
+def main():
+    # Any argument switches to the headless command line mode
+    if len(sys.argv) > 1:
+        sys.exit(cli.main(sys.argv[1:]))
+
+    MainWindow().show_all()
+    Gtk.main()
 
 # vim: ts=4 sw=4 et:
@@ -0,0 +1,5 @@
+from pyhenkan import main
+
+main()
+
+# vim: ts=4 sw=4 et:
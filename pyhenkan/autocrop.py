@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import vapoursynth as vs
+
+from pyhenkan.plugin import CropAbs, CropRel
+
+# Frames analysed, spread evenly
+SAMPLES = 32
+# Mean luma, out of 255, below which a line is part of a border
+THRESHOLD = 24
+
+
+class AutoCrop:
+    def __init__(self, samples=SAMPLES, threshold=THRESHOLD):
+        self.samples = samples
+        self.threshold = threshold
+
+    def detect(self, clip):
+        fmt = clip.format
+        if fmt is None or not clip.width or not clip.height:
+            raise ValueError('Variable format or dimensions')
+        if fmt.sample_type == vs.INTEGER:
+            peak = (1 << fmt.bits_per_sample) - 1
+        else:
+            peak = 1.0
+        threshold = self.threshold * peak / 255
+
+        # Skip the first and last frames, often black or logos
+        last = clip.num_frames - 1
+        frames = sorted(set([round(last * (i + 1) / (self.samples + 1))
+                             for i in range(self.samples)]))
+        workers = vs.get_core().num_threads
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            edges = list(executor.map(
+                lambda n: self._measure(clip, n, threshold), frames))
+        # Fades and black frames tell nothing about the borders
+        edges = [e for e in edges if e]
+        if not edges:
+            return OrderedDict([('left', 0), ('right', 0), ('top', 0),
+                                ('bottom', 0)])
+
+        # Widest picture seen, a dark scene must not eat into it
+        e = np.array(edges).min(axis=0)
+        # Chroma planes must be cropped by whole samples
+        mod_w = 1 << fmt.subsampling_w
+        mod_h = 1 << fmt.subsampling_h
+        return OrderedDict([('left', int(e[0]) // mod_w * mod_w),
+                            ('right', int(e[1]) // mod_w * mod_w),
+                            ('top', int(e[2]) // mod_h * mod_h),
+                            ('bottom', int(e[3]) // mod_h * mod_h)])
+
+    def _measure(self, clip, n, threshold):
+        # Border width on each side, from the luma plane as is
+        frame = clip.get_frame(n)
+        luma = np.asarray(frame.get_read_array(0))
+        cols = np.flatnonzero(luma.mean(axis=0) > threshold)
+        rows = np.flatnonzero(luma.mean(axis=1) > threshold)
+        if not len(cols) or not len(rows):
+            return None
+        return [cols[0], luma.shape[1] - 1 - cols[-1], rows[0],
+                luma.shape[0] - 1 - rows[-1]]
+
+    def get_crop_rel(self, crop):
+        plugin = CropRel()
+        plugin.args.update(crop)
+        return plugin
+
+    def get_crop_abs(self, crop, width, height):
+        plugin = CropAbs()
+        plugin.args['width'] = width - crop['left'] - crop['right']
+        plugin.args['height'] = height - crop['top'] - crop['bottom']
+        plugin.args['left'] = crop['left']
+        plugin.args['top'] = crop['top']
+        return plugin
+
+    def get_text(self, crop, width, height):
+        crop_abs = self.get_crop_abs(crop, width, height)
+        return 'CropRel {}, CropAbs {}'.format(
+            ' '.join(['{}={}'.format(k, v) for k, v in crop.items()]),
+            ' '.join(['{}={}'.format(k, v)
+                      for k, v in crop_abs.args.items()]))
+
+    def add(self, filters, crop):
+        # Crops the end of the chain, where the clip was analysed
+        if not any(crop.values()):
+            return
+        last = filters[-1]
+        if isinstance(last, CropRel):
+            # One crop is enough
+            for key in crop:
+                last.args[key] += crop[key]
+        else:
+            filters.append(self.get_crop_rel(crop))
+
+# vim: ts=4 sw=4 et:
@@ -0,0 +1,109 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import vapoursynth as vs
+
+from pyhenkan.queue import Queue
+from pyhenkan.vapoursynth import VapourSynth
+
+# Frames measured per file, spread evenly
+SAMPLES = 48
+# Measurement resolution, detail finer than this barely moves the ratio
+WIDTH = 160
+HEIGHT = 90
+# Container overhead, as a share of the total size
+OVERHEAD = 0.01
+# At equal quality, bits grow slower than complexity
+EXPONENT = 0.5
+
+
+def get_bitrate(track):
+    # kbit/s a track other than the budgeted video takes
+    c = track.codec if track.type in ['Video', 'Audio'] else None
+    if c is None:
+        # Muxed as is
+        return track.bitrate
+    if hasattr(c, 'bitrate'):
+        # A fair guess for quality based modes too
+        return c.bitrate
+    # Lossless, about 60% of PCM
+    channels = c.channel if c.channel else track.channel
+    rate = c.rate if c.rate else track.rate
+    return channels * rate * (track.depth if track.depth else 16) * 0.6 / 1000
+
+
+class SizeBudget:
+    def __init__(self, size, overhead=OVERHEAD):
+        # Total size of the batch in MB
+        self.size = size
+        self.overhead = overhead
+
+    def get_complexity(self, clip):
+        small = clip.resize.Bilinear(WIDTH, HEIGHT, format=vs.GRAY8)
+        last = max(small.num_frames - 2, 0)
+        frames = sorted(set([round(last * i / max(SAMPLES - 1, 1))
+                             for i in range(SAMPLES)]))
+
+        workers = vs.get_core().num_threads
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            scores = list(executor.map(lambda n: self._measure(small, n),
+                                       frames))
+        # Even a still black clip needs some bits
+        return max(float(np.mean(scores)), 1.0)
+
+    def _measure(self, clip, n):
+        a = self._luma(clip, n)
+        b = self._luma(clip, min(n + 1, clip.num_frames - 1))
+        # Spatial detail and motion, both out of 255
+        spatial = (np.abs(np.diff(a, axis=0)).mean() +
+                   np.abs(np.diff(a, axis=1)).mean())
+        temporal = np.abs(b - a).mean()
+        return spatial + temporal
+
+    def _luma(self, clip, n):
+        frame = clip.get_frame(n)
+        return np.array(frame.get_read_array(0), dtype=np.int16)
+
+    def split(self, mediafiles):
+        queue = Queue()
+
+        # kbit, 1 MB is 8000 kbit
+        total = self.size * 8000 * (1 - self.overhead)
+        videos = []
+        for i, mf in enumerate(mediafiles):
+            queue.set_text('Measuring complexity...')
+            for t in mf.tracklist:
+                if not t.enable or t.type == 'Menu':
+                    continue
+                if t.type == 'Video' and t.codec:
+                    clip = VapourSynth(mf).get_clip()
+                    duration = t.get_duration()
+                    if clip.fps_num:
+                        duration = clip.num_frames * clip.fps_den / \
+                            clip.fps_num
+                    videos.append((t, duration, self.get_complexity(clip)))
+                else:
+                    total -= get_bitrate(t) * t.get_duration()
+            queue.progress_update(i + 1, len(mediafiles))
+        queue.set_text('Ready')
+        queue.set_progress(0)
+
+        if total <= 0:
+            raise ValueError('Size budget too small for the audio and muxed '
+                             'tracks')
+        weights = [d * c ** EXPONENT for t, d, c in videos]
+        bitrates = []
+        for (t, d, c), w in zip(videos, weights):
+            if not d:
+                raise ValueError('Unknown duration: ' + t.file.bname)
+            bits = total * w / sum(weights)
+            bitrates.append((t, max(int(bits / d), 1)))
+        return bitrates
+
+    def apply(self, mediafiles):
+        for t, bitrate in self.split(mediafiles):
+            Queue().log('{}: {} kbit/s'.format(t.file.bname, bitrate))
+            t.codec.mode = '2-pass'
+            t.codec.bitrate = bitrate
+
+# vim: ts=4 sw=4 et:
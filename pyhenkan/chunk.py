@@ -0,0 +1,250 @@
+import hashlib
+import json
+import math
+import os
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Event, Lock
+
+from pyhenkan.framewriter import FrameWriter
+from pyhenkan.progress import FFmpegProgress
+from pyhenkan.queue import Queue
+
+
+class ChunkError(Exception):
+    pass
+
+
+def plan_chunks(num_frames, chunks, chunk_size=0, cuts=[]):
+    # Split [0, num_frames) into frame ranges, evenly unless a size is set
+    if chunk_size <= 0:
+        chunk_size = math.ceil(num_frames / max(chunks, 1))
+    chunk_size = max(chunk_size, 1)
+    starts = [0]
+    for target in range(chunk_size, num_frames, chunk_size):
+        # Prefer the nearest scene cut within half a chunk
+        near = [c for c in cuts if starts[-1] < c < num_frames and
+                abs(c - target) <= chunk_size // 2]
+        start = min(near, key=lambda c: abs(c - target)) if near else target
+        if start > starts[-1]:
+            starts.append(start)
+    return list(zip(starts, starts[1:] + [num_frames]))
+
+
+class ChunkEncoder:
+    def __init__(self, codec, clip, output, cuts=[], source=None,
+                 prefetch=0, key=None):
+        self.codec = codec
+        self.clip = clip
+        # Source, filter settings and trim remote workers rebuild it from
+        self.source = source
+        # Scene cuts, chunks start on them whenever possible
+        self.cuts = cuts
+        # Output path without extension, as passed to Codec.get_cmd
+        self.output = output
+        # Frames in flight for the whole job, split across local chunks
+        self.prefetch = prefetch
+        # Source and filters, first pass stats are reused while they match
+        self.key = key
+        self.passes = codec.get_passes()
+        self.lock = Lock()
+        self.frames = {}
+        # Set once a chunk fails, the others give up
+        self.failed = Event()
+
+    def plan(self):
+        cuts = self.cuts if self.codec.scenes else []
+        # A size kept from an earlier split means nothing for a single chunk
+        size = self.codec.chunk_size if self.codec.chunks > 1 else 0
+        return plan_chunks(self.clip.num_frames, self.codec.chunks, size,
+                           cuts)
+
+    def encode(self):
+        queue = Queue()
+
+        # Chunks run on threads of their own, keep them tied to the step
+        self.step = queue.get_step()
+
+        ranges = self.plan()
+        paths = ['{}_{:04d}'.format(self.output, i)
+                 for i in range(len(ranges))]
+
+        # Encoders run in parallel, VapourSynth or the workers feed them all
+        workers = len(ranges) if queue.pool else self.codec.chunks
+        self.chunk_prefetch = 0
+        if self.prefetch:
+            parallel = min(workers, len(ranges))
+            self.chunk_prefetch = max(self.prefetch // parallel, 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._encode_chunk, i, r, p)
+                       for i, (r, p) in enumerate(zip(ranges, paths))]
+            try:
+                for f in as_completed(futures):
+                    f.result()
+            except BaseException:
+                # The other chunks are wasted work, stop them all
+                self.failed.set()
+                for f in futures:
+                    f.cancel()
+                queue.kill(self.step)
+                raise
+
+        files = ['.'.join([p, self.codec.container]) for p in paths]
+        o = '.'.join([self.output, self.codec.container])
+        if len(files) == 1:
+            os.replace(files[0], o)
+            return
+        queue.set_text('Joining chunks...')
+        self._concat(files)
+        for f in files:
+            os.remove(f)
+
+    def _encode_chunk(self, i, r, path):
+        queue = Queue()
+
+        self._check()
+        # Keyframes are relative to the chunk start
+        keyframes = [c - r[0] for c in self.cuts if r[0] < c < r[1]]
+
+        if queue.pool:
+            # Workers encode in a directory of their own
+            name = os.path.basename(path)
+            files = self.codec.get_files(name, keyframes)
+            cmds = [self.codec.get_cmd(name, keyframes, self.clip, n)
+                    for n in self.passes]
+            work = dict(self.source,
+                        cmds=cmds,
+                        remux=self.codec.get_remux_cmd(name, self.clip),
+                        files=files,
+                        output='.'.join([name, self.codec.container]),
+                        start=r[0], end=r[1],
+                        y4m=not self.codec.rawvideo,
+                        prefetch=self.chunk_prefetch,
+                        standalone=self.codec.standalone)
+            queue.pool.encode(work, '.'.join([path, self.codec.container]),
+                              lambda c: self._remote_progress(i, c))
+            return
+
+        files = self.codec.get_files(path, keyframes)
+        for f in files:
+            with open(f, 'w') as fh:
+                fh.write(files[f])
+
+        clip = self.clip[r[0]:r[1]]
+        # Written once the first pass is through, names what it ran on
+        stamp = self.codec.get_stats(path) + '.json'
+        for k, n in enumerate(self.passes):
+            cmd = self.codec.get_cmd(path, keyframes, self.clip, n)
+            offset = k * clip.num_frames
+            key = self._get_stats_key(r, cmd) if n == 1 else None
+            if key and self._read_stamp(stamp) == key:
+                queue.log('Reuse first pass statistics of ' + path)
+                self._progress(i, offset + clip.num_frames)
+                continue
+            if n == 1 and os.path.exists(stamp):
+                os.remove(stamp)
+            self._check()
+            self._run(cmd, clip, i, offset)
+            if key:
+                with open(stamp, 'w') as f:
+                    json.dump(key, f)
+
+        remux = self.codec.get_remux_cmd(path, self.clip)
+        if remux:
+            queue.log(' '.join(remux))
+            self._check()
+            proc = queue.popen(remux, step=self.step,
+                               stdout=subprocess.DEVNULL)
+            if self.failed.is_set():
+                proc.kill()
+            # mkvmerge returns 1 on warnings
+            if proc.wait() not in [0, 1]:
+                raise subprocess.CalledProcessError(proc.returncode, remux)
+            os.remove(remux[-1])
+        for f in files:
+            os.remove(f)
+
+    def _run(self, cmd, clip, i, offset=0):
+        queue = Queue()
+
+        queue.log(' '.join(cmd))
+
+        # Standalone encoders have no machine readable progress
+        standalone = self.codec.standalone
+        proc = queue.popen(cmd, step=self.step, stdin=subprocess.PIPE,
+                           stdout=subprocess.DEVNULL if standalone
+                           else subprocess.PIPE,
+                           stderr=subprocess.DEVNULL)
+        if self.failed.is_set():
+            # Started as another chunk failed, after the others were killed
+            proc.kill()
+        progress = FFmpegProgress(frames=clip.num_frames, callback=lambda p:
+                                  self._progress(i, offset + p.frame))
+        if not standalone:
+            progress.start(proc.stdout)
+
+        update = (lambda c, t: self._progress(i, offset + c)) \
+            if standalone else None
+        writer = FrameWriter(clip, proc.stdin, not self.codec.rawvideo,
+                             self.chunk_prefetch)
+        writer.write(update)
+        proc.stdin.close()
+        proc.wait()
+        progress.join()
+
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    def _get_stats_key(self, r, cmd):
+        if self.key is None:
+            return None
+        key = json.dumps([self.key, r, cmd], sort_keys=True)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _read_stamp(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _check(self):
+        if self.failed.is_set():
+            raise ChunkError('Another chunk failed')
+
+    def _remote_progress(self, i, current):
+        # Raising drops the connection, the worker kills its encoder
+        self._check()
+        self._progress(i, current)
+
+    def _progress(self, i, current):
+        queue = Queue()
+
+        # Every pass goes through all the frames
+        with self.lock:
+            self.frames[i] = current
+            done = sum(self.frames.values())
+        total = self.clip.num_frames * len(self.passes)
+        queue.progress_update(done, total, self.step)
+
+    def _concat(self, files):
+        queue = Queue()
+
+        # Stream copy, chunks only hold the one video stream
+        lst = self.output + '_chunks.txt'
+        with open(lst, 'w') as f:
+            for path in files:
+                f.write("file '{}'\n".format(path.replace("'", "'\\''")))
+
+        o = '.'.join([self.output, self.codec.container])
+        cmd = ['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', lst,
+               '-map', '0:v', '-c', 'copy', o]
+        queue.log(' '.join(cmd))
+        proc = queue.popen(cmd, step=self.step, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        os.remove(lst)
+
+# vim: ts=4 sw=4 et:
@@ -0,0 +1,343 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+from threading import Lock
+
+import pyhenkan.plugin as plugin
+from pyhenkan.autocrop import AutoCrop
+from pyhenkan.budget import SizeBudget
+from pyhenkan.crfsearch import METRICS, CrfSearch
+from pyhenkan.estimate import Estimator
+from pyhenkan.index import IndexCache
+from pyhenkan.journal import Journal
+from pyhenkan.mediafile import MediaFile, resume
+from pyhenkan.plugin import SourcePlugin
+from pyhenkan.queue import Job, Queue, QueueView, format_eta, format_size
+from pyhenkan.vapoursynth import VapourSynth
+from pyhenkan.worker import WorkerPool, get_secret
+
+
+class ConsoleQueueView(QueueView):
+    def __init__(self, stream=sys.stdout):
+        self.stream = stream
+        self.lock = Lock()
+        self.text = ''
+        self.percent = -1
+        self.fps = 0
+        self.eta = None
+
+    def emit(self, event, **fields):
+        if event == 'progress':
+            line = '{} {}%'.format(fields['text'], fields['percent'])
+            if fields.get('fps'):
+                line += ' {:.1f} fps'.format(fields['fps'])
+            if fields.get('eta') is not None:
+                line += ' ETA ' + format_eta(fields['eta'])
+        elif event == 'estimate':
+            line = 'Estimate {} {}, {}'.format(fields['input'],
+                                               format_eta(fields['seconds']),
+                                               format_size(fields['size']))
+        elif event == 'index':
+            line = 'Indexed {}/{} {}'.format(fields['done'], fields['total'],
+                                             fields['input'])
+        elif event == 'status' and 'step' in fields:
+            line = '{} {} [{}]'.format(fields['status'], fields['input'],
+                                       fields['step'])
+        elif event in ['status', 'queued']:
+            line = '{} {} -> {}'.format(fields.get('status', 'Queued'),
+                                        fields['input'], fields['output'])
+        else:
+            line = fields['text']
+        with self.lock:
+            print(line, file=self.stream, flush=True)
+
+    def add_job(self, job):
+        mf = job.mediafile
+        self.emit('queued', input=mf.path, output=mf.oname)
+
+    def set_status(self, obj):
+        if isinstance(obj, Job):
+            mf = obj.mediafile
+            self.emit('status', input=mf.path, output=mf.oname,
+                      status=obj.status)
+        else:
+            self.emit('status', input=obj.job.mediafile.path, step=obj.name,
+                      status=obj.status)
+
+    def set_progress(self, fraction):
+        # Only report whole percents
+        percent = int(fraction * 100)
+        if percent != self.percent:
+            self.percent = percent
+            self.emit('progress', text=self.text, percent=percent,
+                      fps=self.fps, eta=self.eta)
+
+    def set_rate(self, fps, eta):
+        # Reported along with the next percent
+        self.fps = fps
+        self.eta = eta
+
+    def set_estimate(self, job):
+        seconds, size = job.estimate
+        self.emit('estimate', input=job.mediafile.path, seconds=seconds,
+                  size=size)
+
+    def set_total_estimate(self, seconds, size):
+        self.emit('estimate', input='total', seconds=seconds, size=size)
+
+    def set_index(self, done, total, name):
+        self.emit('index', input=name, done=done, total=total)
+
+    def set_text(self, text):
+        self.text = text
+        self.percent = -1
+
+    def notify(self, text):
+        self.emit('message', text=text)
+
+    def log(self, text):
+        self.emit('log', text=text)
+
+    def finished(self):
+        self.emit('message', text='Jobs done')
+
+
+class JsonQueueView(ConsoleQueueView):
+    def emit(self, event, **fields):
+        fields['event'] = event
+        fields['time'] = time.time()
+        with self.lock:
+            print(json.dumps(fields, sort_keys=True), file=self.stream,
+                  flush=True)
+
+
+def expand_inputs(patterns):
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(os.path.expanduser(pattern)))
+        for m in matches if matches else [pattern]:
+            if os.path.isfile(m):
+                paths.append(os.path.abspath(m))
+            else:
+                print('Skipping {}: no such file'.format(m), file=sys.stderr)
+    return paths
+
+
+def get_oname(mediafile, output):
+    name = output.get('name', '{name}').format(name=mediafile.name)
+    if output.get('suffix'):
+        name = '_'.join([name, output['suffix']])
+    oname = '.'.join([name, output.get('container', 'mkv')])
+    if output.get('dir'):
+        oname = os.path.join(os.path.abspath(output['dir']), oname)
+    return oname
+
+
+def apply_template(mediafile, template):
+    settings = dict(template)
+    # Templates may leave the source filter out
+    filters = settings.get('filters')
+    if filters and not isinstance(plugin.from_settings(filters[0]),
+                                  SourcePlugin):
+        source = mediafile.filters[0].get_settings()
+        settings['filters'] = [source] + filters
+    mediafile.set_settings(settings)
+
+    # Tracks beyond the indexed ones fall back to per type defaults
+    n = len(settings.get('tracks', []))
+    for t in mediafile.tracklist[n:]:
+        ts = template.get(t.type.lower())
+        if ts:
+            t.set_settings(ts)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='pyhenkan',
+                                     description='Transcode media files '
+                                     'without the graphical interface.')
+    parser.add_argument('inputs', nargs='*', metavar='INPUT',
+                        help='input files or glob patterns')
+    parser.add_argument('-t', '--template',
+                        help='JSON job template (filters, trim, tracks, '
+                        'output)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of jobs processed simultaneously')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(),
+                        help='VapourSynth threads split across running '
+                        'jobs')
+    parser.add_argument('--memory', type=int, default=0, metavar='MB',
+                        help='VapourSynth frame cache split across running '
+                        'jobs')
+    parser.add_argument('--job-threads', type=int, metavar='N',
+                        help='VapourSynth threads of every remote job, '
+                        'instead of a share')
+    parser.add_argument('--job-memory', type=int, metavar='MB',
+                        help='VapourSynth frame cache of every remote job, '
+                        'instead of a share')
+    parser.add_argument('--prefetch', type=int, metavar='N',
+                        help='frames requested ahead by every job, defaults '
+                        'to its threads')
+    parser.add_argument('--index-cache', type=int, metavar='MB',
+                        help='size of the source index cache, least '
+                        'recently used indexes are evicted past it')
+    parser.add_argument('--autocrop', action='store_true',
+                        help='crop the black borders found on frames '
+                        'sampled across the filtered clip')
+    parser.add_argument('-O', '--optimize-filters', action='store_true',
+                        help='merge crops into resizes and drop filters '
+                        'that change nothing')
+    parser.add_argument('-n', '--name',
+                        help='output name, {name} is the input name')
+    parser.add_argument('-s', '--suffix', help='output name suffix')
+    parser.add_argument('-c', '--container', help='output container')
+    parser.add_argument('-o', '--output-dir',
+                        help='output directory, defaults to the input one')
+    parser.add_argument('-b', '--budget', type=float, metavar='MB',
+                        help='total size of the new files, video is encoded '
+                        'in 2 passes to fit')
+    parser.add_argument('--crf-target', metavar='METRIC:SCORE',
+                        help='pick the highest CRF whose sampled segments '
+                        'score at least SCORE, METRIC is ssim or psnr')
+    parser.add_argument('-e', '--estimate', action='store_true',
+                        help='encode a small sample of every input, print '
+                        'the expected time and size and exit')
+    parser.add_argument('-r', '--remote', action='append', default=[],
+                        metavar='ADDRESS',
+                        help='encode video on the pyhenkan-worker listening '
+                        'on HOST:PORT or unix:PATH, may be repeated')
+    parser.add_argument('--secret-file', metavar='PATH',
+                        help='secret shared with the workers, defaults to '
+                        '~/.config/pyhenkan/secret or $PYHENKAN_SECRET')
+    parser.add_argument('-j', '--json', action='store_true',
+                        help='report progress as a stream of JSON objects')
+    parser.add_argument('--journal', help='queue journal path')
+    parser.add_argument('--resume', action='store_true',
+                        help='resume the jobs left unfinished in the '
+                        'journal')
+    args = parser.parse_args(argv)
+
+    search = None
+    if args.crf_target:
+        metric, sep, score = args.crf_target.partition(':')
+        try:
+            score = float(score)
+        except ValueError:
+            score = None
+        if metric not in METRICS or score is None:
+            parser.error('--crf-target takes ssim:SCORE or psnr:SCORE')
+        if args.budget:
+            parser.error('--crf-target and --budget are exclusive')
+        search = CrfSearch(metric, score)
+
+    template = {}
+    if args.template:
+        with open(args.template) as f:
+            template = json.load(f)
+    output = {'suffix': 'new', 'container': 'mkv'}
+    output.update(template.pop('output', {}))
+    for key, value in [('name', args.name), ('suffix', args.suffix),
+                       ('container', args.container),
+                       ('dir', args.output_dir)]:
+        if value is not None:
+            output[key] = value
+
+    # Keep headless jobs apart from the GUI queue
+    journal = Journal()
+    if args.journal:
+        journal.path = os.path.abspath(args.journal)
+    else:
+        journal.path = os.path.join(os.path.dirname(journal.path),
+                                    'cli.sqlite')
+
+    queue = Queue()
+    # Progress and logs alike go through the view, JSON keeps stdout clean
+    queue.view = JsonQueueView() if args.json else ConsoleQueueView()
+    queue.workers = max(1, args.workers)
+    queue.set_threads(max(1, args.threads))
+    queue.set_memory(max(0, args.memory))
+    if (args.job_threads is not None or args.job_memory is not None) and \
+            not args.remote:
+        print('--job-threads and --job-memory need --remote, local jobs '
+              'share one core', file=sys.stderr)
+        return 1
+    if any(template.get('core', {}).get(key) for key in
+           ['threads', 'max_cache_size']) and not args.remote:
+        print('Template core threads and max_cache_size only apply to '
+              'remote workers', file=sys.stderr)
+    core = {}
+    for key, value in [('threads', args.job_threads),
+                       ('max_cache_size', args.job_memory),
+                       ('prefetch', args.prefetch)]:
+        if value is not None:
+            core[key] = max(0, value)
+    if args.remote:
+        queue.pool = WorkerPool(args.remote, get_secret(args.secret_file))
+    if args.index_cache is not None:
+        IndexCache().size = max(0, args.index_cache)
+
+    files = []
+    for path in expand_inputs(args.inputs):
+        f = MediaFile(path)
+        try:
+            apply_template(f, template)
+        except ValueError as e:
+            print('Invalid template: {}'.format(e), file=sys.stderr)
+            return 1
+        f.core.update(core)
+        if args.autocrop:
+            autocrop = AutoCrop()
+            clip = VapourSynth(f).get_clip()
+            crop = autocrop.detect(clip)
+            print('{}: {}'.format(f.bname, autocrop.get_text(
+                crop, clip.width, clip.height)), file=sys.stderr)
+            autocrop.add(f.filters, crop)
+        if args.optimize_filters:
+            f.optimize = True
+        if f.optimize:
+            optimizer = VapourSynth(f).get_optimizer()
+            optimizer.optimize(f.filters)
+            for line in optimizer.get_report():
+                print('{}: {}'.format(f.bname, line), file=sys.stderr)
+        f.oname = get_oname(f, output)
+        if os.path.join(f.dname, f.oname) == f.path:
+            print('Skipping {}: output would overwrite it'.format(path),
+                  file=sys.stderr)
+            continue
+        files.append(f)
+
+    if args.budget and files:
+        try:
+            SizeBudget(args.budget).apply(files)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 1
+    elif search:
+        search.apply(files)
+
+    if args.estimate:
+        # Jobs of their own, out of the queue and the journal
+        Estimator().estimate_jobs([Job(f) for f in files])
+        return 0
+
+    jobs = resume() if args.resume else []
+    jobs += [f.process() for f in files]
+
+    if not jobs:
+        print('Nothing to do', file=sys.stderr)
+        return 1
+
+    queue.start()
+    try:
+        queue.wait()
+    except KeyboardInterrupt:
+        queue.stop()
+        queue.wait()
+    print(IndexCache().get_report(), file=sys.stderr)
+
+    return 0 if all([j.status == 'Done' for j in jobs]) else 1
+
+# vim: ts=4 sw=4 et:
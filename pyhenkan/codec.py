@@ -1,10 +1,14 @@
 import io
+import os
+import shutil
 import subprocess
 import sys
 
 from collections import OrderedDict
 from decimal import Decimal
 
+from pyhenkan.framewriter import get_csp, get_pix_fmt
+
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk
@@ -41,24 +45,107 @@ class Codec:
         dlg.run()
         dlg.destroy()
 
+    def get_settings(self):
+        settings = OrderedDict([('codec', type(self).__name__)])
+        for key in sorted(vars(self)):
+            if key not in ['library', 'binary', 'dialog']:
+                settings[key] = getattr(self, key)
+        return settings
+
+
+def from_settings(settings):
+    name = settings.get('codec')
+    if name not in CODECS:
+        raise ValueError('Unknown codec {!r}'.format(name))
+    c = CODECS[name]()
+    for key in settings:
+        if key != 'codec':
+            setattr(c, key, settings[key])
+    return c
+
 
 class VideoCodec(Codec):
     def __init__(self, library, dialog):
         Codec.__init__(self, library, dialog)
         self.pixel_format = 'auto'
         self.color_matrix = ['auto', 'auto']
-
-    def get_cmd(self, output, settings):
-        cmd = ['ffmpeg', '-y', '-i', '-', '-c:v', self.library]
+        # CRF, or 2-pass to a bitrate in kbit/s
+        self.mode = 'CRF'
+        self.bitrate = 4000
+        # Parallel encoders, chunk_size in frames, 0 splits evenly
+        self.chunks = 1
+        self.chunk_size = 0
+        # Start chunks on scene cuts, force keyframes on them
+        self.scenes = True
+        self.keyframes = False
+        # Pipe rawvideo with explicit geometry instead of Y4M
+        self.rawvideo = False
+        # Feed the encoder binary directly instead of going through ffmpeg
+        self.binary = ''
+        self.standalone = False
+
+    def is_binary_avail(self):
+        return bool(self.binary) and shutil.which(self.binary) is not None
+
+    def set_standalone(self, standalone):
+        self.standalone = standalone
+
+    def get_passes(self):
+        # Pass numbers to run, 0 is a single CRF pass
+        return [1, 2] if self.mode == '2-pass' else [0]
+
+    def get_crf_range(self):
+        # Where automatic CRF search looks
+        return 14, 35
+
+    def get_stats(self, output):
+        # First pass statistics, encoders may add their own suffixes
+        return output + '.stats'
+
+    def get_raw_input(self, clip):
+        # Geometry of a rawvideo pipe, for standalone encoders
+        fmt = clip.format
+        return {'csp': get_csp(fmt),
+                'depth': str(fmt.bits_per_sample),
+                'res': '{}x{}'.format(clip.width, clip.height),
+                'fps': '{}/{}'.format(clip.fps_num, clip.fps_den)}
+
+    def get_files(self, output, keyframes=[]):
+        # Files the command reads, x264 and x265 take keyframes as a qpfile
+        if self.standalone and self.keyframes and keyframes:
+            qpfile = ''.join(['{} I -1\n'.format(k) for k in keyframes])
+            return {output + '.qp': qpfile}
+        return {}
+
+    def get_remux_cmd(self, output, clip):
+        # Turns an elementary stream into the container, if needed
+        return None
+
+    def get_cmd(self, output, settings, keyframes=[], clip=None, npass=0):
+        # Machine readable progress on stdout
+        cmd = ['ffmpeg', '-y', '-progress', 'pipe:1', '-nostats']
+        if self.rawvideo and clip is not None:
+            cmd += ['-f', 'rawvideo',
+                    '-pix_fmt', get_pix_fmt(clip.format),
+                    '-s', '{}x{}'.format(clip.width, clip.height),
+                    '-r', '{}/{}'.format(clip.fps_num, clip.fps_den)]
+        cmd += ['-i', '-', '-c:v', self.library]
         if self.pixel_format != 'auto':
             cmd += ['-pix_fmt', self.pixel_format]
         if self.color_matrix != ['auto', 'auto']:
             cmd += ['-vf', 'colormatrix={}:{}'.format(self.color_matrix[0],
                                                       self.color_matrix[1])]
         cmd += settings
+        if self.keyframes and keyframes:
+            expr = '+'.join(['eq(n,{})'.format(k) for k in keyframes])
+            cmd += ['-force_key_frames', 'expr:' + expr]
         if self.arguments:
             cmd += self.arguments.split()
-        cmd += ['{}.{}'.format(output, self.container)]
+        # The first pass only writes statistics
+        if npass == 1:
+            cmd += ['-f', 'null', os.devnull]
+        else:
+            cmd += ['{}.{}'.format(output, self.container)]
         return cmd
 
 
@@ -68,15 +155,55 @@ class Vpx(VideoCodec):
         self.crf = 10
         self.preset = 'good'
         self.cpu_used = 2
+        self.pass1_cpu_used = 4
         self.container = 'webm'
+        self.binary = 'vpxenc'
+
+    def get_crf_range(self):
+        return 10, 52
+
+    def get_cpu_used(self, npass):
+        return self.pass1_cpu_used if npass == 1 else self.cpu_used
+
+    def get_binary_cmd(self, output, clip, npass=0):
+        codec = 'vp9' if self.library == 'libvpx-vp9' else 'vp8'
+        cmd = ['vpxenc', '--codec=' + codec]
+        if npass:
+            cmd += ['--passes=2', '--pass={}'.format(npass),
+                    '--fpf=' + self.get_stats(output), '--end-usage=vbr',
+                    '--target-bitrate={}'.format(self.bitrate)]
+        else:
+            cmd += ['--end-usage=q', '--cq-level={}'.format(self.crf)]
+        cmd += ['--rt' if self.preset == 'realtime' else '--' + self.preset]
+        if self.preset != 'best':
+            cmd += ['--cpu-used={}'.format(self.get_cpu_used(npass))]
+        # Y4M is detected
+        if self.rawvideo:
+            raw = self.get_raw_input(clip)
+            w, h = raw['res'].split('x')
+            cmd += ['--' + raw['csp'], '--width=' + w, '--height=' + h,
+                    '--fps=' + raw['fps'],
+                    '--input-bit-depth=' + raw['depth']]
+        if self.arguments:
+            cmd += self.arguments.split()
+        o = os.devnull if npass == 1 else \
+            '{}.{}'.format(output, self.container)
+        cmd += ['-o', o, '-']
+        return cmd
 
-    def get_cmd(self, output):
-        settings = ['-crf', str(self.crf),
-                    '-b:v', str(0),
-                    '-quality', self.preset]
+    def get_cmd(self, output, keyframes=[], clip=None, npass=0):
+        if self.standalone:
+            return self.get_binary_cmd(output, clip, npass)
+        if npass:
+            settings = ['-b:v', '{}k'.format(self.bitrate),
+                        '-pass', str(npass),
+                        '-passlogfile', self.get_stats(output)]
+        else:
+            settings = ['-crf', str(self.crf), '-b:v', str(0)]
+        settings += ['-quality', self.preset]
         if self.preset != 'best':
-            settings += ['-cpu-used', str(self.cpu_used)]
-        cmd = super().get_cmd(output, settings)
+            settings += ['-cpu-used', str(self.get_cpu_used(npass))]
+        cmd = super().get_cmd(output, settings, keyframes, clip, npass)
         return cmd
 
 
@@ -96,15 +223,71 @@ class X264(VideoCodec):
         self.crf = 18
         self.preset = 'medium'
         self.tune = 'none'
+        # Either a real preset, or the one of the second pass
+        self.pass1_preset = 'Same as pass 2'
+        # Lighter or full analysis, whatever the preset
+        self.pass1_analysis = 'Fast analysis'
         self.container = 'mp4'
+        self.binary = 'x264'
+
+    def set_standalone(self, standalone):
+        super().set_standalone(standalone)
+        # x264 writes matroska itself
+        self.container = 'mkv' if standalone else 'mp4'
+
+    def get_preset(self, npass):
+        if npass == 1 and self.pass1_preset != 'Same as pass 2':
+            return self.pass1_preset
+        return self.preset
+
+    def get_binary_cmd(self, output, keyframes, clip, npass=0):
+        if npass:
+            cmd = ['x264', '--bitrate', str(self.bitrate),
+                   '--pass', str(npass), '--stats', self.get_stats(output)]
+            if npass == 1 and self.pass1_analysis == 'Full analysis':
+                cmd += ['--slow-firstpass']
+        else:
+            cmd = ['x264', '--crf', str(self.crf)]
+        preset = self.get_preset(npass)
+        if preset != 'none':
+            cmd += ['--preset', preset]
+        if self.tune != 'none':
+            cmd += ['--tune', self.tune]
+        if self.keyframes and keyframes:
+            cmd += ['--qpfile', output + '.qp']
+        if self.rawvideo:
+            raw = self.get_raw_input(clip)
+            cmd += ['--demuxer', 'raw', '--input-csp', raw['csp'],
+                    '--input-depth', raw['depth'],
+                    '--input-res', raw['res'], '--fps', raw['fps']]
+        else:
+            cmd += ['--demuxer', 'y4m']
+        if self.arguments:
+            cmd += self.arguments.split()
+        o = os.devnull if npass == 1 else \
+            '{}.{}'.format(output, self.container)
+        cmd += ['-o', o, '-']
+        return cmd
 
-    def get_cmd(self, output):
-        settings = ['-crf', str(self.crf)]
-        if self.preset != 'none':
-            settings += ['-preset', self.preset]
+    def get_cmd(self, output, keyframes=[], clip=None, npass=0):
+        if self.standalone:
+            return self.get_binary_cmd(output, keyframes, clip, npass)
+        if npass:
+            settings = ['-b:v', '{}k'.format(self.bitrate),
+                        '-pass', str(npass),
+                        '-passlogfile', self.get_stats(output)]
+            if npass == 1 and self.pass1_analysis == 'Full analysis':
+                settings += ['-fastfirstpass', '0']
+        else:
+            settings = ['-crf', str(self.crf)]
+        preset = self.get_preset(npass)
+        if preset != 'none':
+            settings += ['-preset', preset]
         if self.tune != 'none':
             settings += ['-tune', self.tune]
-        cmd = super().get_cmd(output, settings)
+        if self.keyframes:
+            settings += ['-forced-idr', '1']
+        cmd = super().get_cmd(output, settings, keyframes, clip, npass)
         return cmd
 
 
@@ -113,13 +296,77 @@ class X265(VideoCodec):
         VideoCodec.__init__(self, 'libx265', X265Dialog)
         self.crf = 18
         self.preset = 'medium'
+        # Either a real preset, or the one of the second pass
+        self.pass1_preset = 'Same as pass 2'
+        # Lighter or full analysis, whatever the preset
+        self.pass1_analysis = 'Fast analysis'
         self.container = 'mp4'
+        self.binary = 'x265'
+
+    def set_standalone(self, standalone):
+        super().set_standalone(standalone)
+        # Remuxed from the elementary stream by mkvmerge
+        self.container = 'mkv' if standalone else 'mp4'
+
+    def get_preset(self, npass):
+        if npass == 1 and self.pass1_preset != 'Same as pass 2':
+            return self.pass1_preset
+        return self.preset
+
+    def get_binary_cmd(self, output, keyframes, clip, npass=0):
+        if npass:
+            cmd = ['x265', '--bitrate', str(self.bitrate),
+                   '--pass', str(npass), '--stats', self.get_stats(output)]
+            if npass == 1:
+                cmd += ['--slow-firstpass'
+                        if self.pass1_analysis == 'Full analysis'
+                        else '--no-slow-firstpass']
+        else:
+            cmd = ['x265', '--crf', str(self.crf)]
+        preset = self.get_preset(npass)
+        if preset != 'none':
+            cmd += ['--preset', preset]
+        if self.keyframes and keyframes:
+            cmd += ['--qpfile', output + '.qp']
+        if self.rawvideo:
+            raw = self.get_raw_input(clip)
+            cmd += ['--input-csp', raw['csp'], '--input-depth', raw['depth'],
+                    '--input-res', raw['res'], '--fps', raw['fps']]
+        else:
+            cmd += ['--y4m']
+        if self.arguments:
+            cmd += self.arguments.split()
+        o = os.devnull if npass == 1 else output + '.hevc'
+        cmd += ['--input', '-', '--output', o]
+        return cmd
 
-    def get_cmd(self, output):
-        settings = ['-crf', str(self.crf)]
-        if self.preset != 'none':
-            settings += ['-preset', self.preset]
-        cmd = super().get_cmd(output, settings)
+    def get_remux_cmd(self, output, clip):
+        if not self.standalone:
+            return None
+        duration = '0:{}/{}fps'.format(clip.fps_num, clip.fps_den)
+        return ['mkvmerge', '-q', '-o', '{}.{}'.format(output, self.container),
+                '--default-duration', duration, output + '.hevc']
+
+    def get_cmd(self, output, keyframes=[], clip=None, npass=0):
+        if self.standalone:
+            return self.get_binary_cmd(output, keyframes, clip, npass)
+        if npass:
+            # libx265 ignores -pass, it only takes x265 parameters
+            params = ['pass={}'.format(npass),
+                      'stats=' + self.get_stats(output)]
+            if npass == 1:
+                slow = 1 if self.pass1_analysis == 'Full analysis' else 0
+                params += ['slow-firstpass={}'.format(slow)]
+            settings = ['-b:v', '{}k'.format(self.bitrate),
+                        '-x265-params', ':'.join(params)]
+        else:
+            settings = ['-crf', str(self.crf)]
+        preset = self.get_preset(npass)
+        if preset != 'none':
+            settings += ['-preset', preset]
+        if self.keyframes:
+            settings += ['-forced-idr', '1']
+        cmd = super().get_cmd(output, settings, keyframes, clip, npass)
         return cmd
 
 
@@ -132,7 +379,7 @@ class AudioCodec(Codec):
 
     # Try to get rid of all those track.file
     def get_cmd(self, track, output, settings):
-        cmd = ['ffmpeg', '-y']
+        cmd = ['ffmpeg', '-y', '-progress', 'pipe:1', '-nostats']
         if track.format == 'DTS' and Dcadec().is_avail():
             cmd += ['-c:a', 'libdcadec']
         cmd += ['-i', track.file.path,
@@ -280,6 +527,13 @@ class Soxr(AudioCodec):
         AudioCodec.__init__(self, 'libsoxr', None)
 
 
+# Codecs settings may name, templates and the journal included
+CODECS = OrderedDict([(c.__name__, c) for c in [Vp8, Vp9, X264, X265, Aac,
+                                                 Faac, Fdkaac, Flac, Lame,
+                                                 Opus, Vorbis, Dcadec, Swr,
+                                                 Soxr]])
+
+
 class CodecDialog(Gtk.Dialog):
     def __init__(self, codec, parent):
         Gtk.Dialog.__init__(self, codec.library, parent, Gtk.DialogFlags.MODAL)
@@ -341,6 +595,64 @@ class CodecDialog(Gtk.Dialog):
         self.cpu_used_spin.set_value(self.codec.cpu_used)
         self.cpu_used_spin.connect('value-changed', self.on_cpu_used_changed)
 
+    def pass1_preset(self, presets):
+        self.pass1_preset_label = Gtk.Label('First Pass')
+        self.pass1_preset_label.set_halign(Gtk.Align.START)
+
+        presets = ['Same as pass 2'] + [p for p in presets if p != 'none']
+        self.pass1_preset_cbtext = Gtk.ComboBoxText()
+        self.pass1_preset_cbtext.set_property('hexpand', True)
+        for p in presets:
+            self.pass1_preset_cbtext.append_text(p)
+        i = presets.index(self.codec.pass1_preset)
+        self.pass1_preset_cbtext.set_active(i)
+        self.pass1_preset_cbtext.set_sensitive(self.codec.mode == '2-pass')
+        self.pass1_preset_cbtext.connect('changed',
+                                         self.on_pass1_preset_changed)
+
+        self.pass1_analysis_label = Gtk.Label('First Pass Analysis')
+        self.pass1_analysis_label.set_halign(Gtk.Align.START)
+
+        analyses = ['Fast analysis', 'Full analysis']
+        self.pass1_analysis_cbtext = Gtk.ComboBoxText()
+        self.pass1_analysis_cbtext.set_property('hexpand', True)
+        for a in analyses:
+            self.pass1_analysis_cbtext.append_text(a)
+        i = analyses.index(self.codec.pass1_analysis)
+        self.pass1_analysis_cbtext.set_active(i)
+        self.pass1_analysis_cbtext.set_sensitive(self.codec.mode == '2-pass')
+        self.pass1_analysis_cbtext.connect('changed',
+                                           self.on_pass1_analysis_changed)
+
+    def pass1_cpu_used(self, cpus_used):
+        self.pass1_cpu_used_label = Gtk.Label('First Pass CPU Used')
+        self.pass1_cpu_used_label.set_halign(Gtk.Align.START)
+
+        self.pass1_cpu_used_spin = Gtk.SpinButton()
+        self.pass1_cpu_used_spin.set_property('hexpand', True)
+        self.pass1_cpu_used_spin.set_numeric(True)
+        self.pass1_cpu_used_spin.set_adjustment(cpus_used)
+        self.pass1_cpu_used_spin.set_value(self.codec.pass1_cpu_used)
+        self.pass1_cpu_used_spin.set_sensitive(self.codec.mode == '2-pass')
+        self.pass1_cpu_used_spin.connect('value-changed',
+                                         self.on_pass1_cpu_used_changed)
+
+    def backend(self):
+        backends = ['ffmpeg']
+        if self.codec.is_binary_avail():
+            backends.append(self.codec.binary)
+
+        self.backend_label = Gtk.Label('Backend')
+        self.backend_label.set_halign(Gtk.Align.START)
+
+        self.backend_cbtext = Gtk.ComboBoxText()
+        self.backend_cbtext.set_property('hexpand', True)
+        for b in backends:
+            self.backend_cbtext.append_text(b)
+        i = 1 if self.codec.standalone and len(backends) > 1 else 0
+        self.backend_cbtext.set_active(i)
+        self.backend_cbtext.connect('changed', self.on_backend_changed)
+
     def arguments(self):
         self.arguments_label = Gtk.Label('Custom arguments')
         self.arguments_label.set_halign(Gtk.Align.CENTER)
@@ -350,6 +662,45 @@ class CodecDialog(Gtk.Dialog):
         self.arguments_entry.set_text(self.codec.arguments)
         self.arguments_entry.connect('changed', self.on_arguments_changed)
 
+    def chunks(self):
+        self.chunks_label = Gtk.Label('Chunks')
+        self.chunks_label.set_halign(Gtk.Align.START)
+
+        self.chunks_spin = Gtk.SpinButton()
+        self.chunks_spin.set_property('hexpand', True)
+        self.chunks_spin.set_numeric(True)
+        self.chunks_spin.set_adjustment(Gtk.Adjustment(1, 1, 64, 1, 4))
+        self.chunks_spin.set_value(self.codec.chunks)
+        self.chunks_spin.connect('value-changed', self.on_chunks_changed)
+
+        self.chunk_size_label = Gtk.Label('Chunk Size')
+        self.chunk_size_label.set_halign(Gtk.Align.START)
+
+        self.chunk_size_spin = Gtk.SpinButton()
+        self.chunk_size_spin.set_property('hexpand', True)
+        self.chunk_size_spin.set_numeric(True)
+        self.chunk_size_spin.set_adjustment(Gtk.Adjustment(0, 0, 1000000,
+                                                           100, 1000))
+        self.chunk_size_spin.set_value(self.codec.chunk_size)
+        self.chunk_size_spin.set_sensitive(self.codec.chunks > 1)
+        self.chunk_size_spin.connect('value-changed',
+                                     self.on_chunk_size_changed)
+
+        self.scenes_check = Gtk.CheckButton('Split on scene cuts')
+        self.scenes_check.set_active(self.codec.scenes)
+        self.scenes_check.set_sensitive(self.codec.chunks > 1)
+        self.scenes_check.connect('toggled', self.on_scenes_toggled)
+
+    def rawvideo(self):
+        self.rawvideo_check = Gtk.CheckButton('Raw video pipe')
+        self.rawvideo_check.set_active(self.codec.rawvideo)
+        self.rawvideo_check.connect('toggled', self.on_rawvideo_toggled)
+
+    def keyframes(self):
+        self.keyframes_check = Gtk.CheckButton('Keyframes on scene cuts')
+        self.keyframes_check.set_active(self.codec.keyframes)
+        self.keyframes_check.connect('toggled', self.on_keyframes_toggled)
+
     def pixel_format(self):
         pixel_formats = OrderedDict()
         pixel_formats['Auto'] = 'auto'
@@ -562,9 +913,38 @@ class CodecDialog(Gtk.Dialog):
     def on_cpu_used_changed(self, spin):
         self.codec.cpu_used = spin.get_value_as_int()
 
+    def on_pass1_preset_changed(self, cbtext):
+        self.codec.pass1_preset = cbtext.get_active_text()
+
+    def on_pass1_analysis_changed(self, cbtext):
+        self.codec.pass1_analysis = cbtext.get_active_text()
+
+    def on_pass1_cpu_used_changed(self, spin):
+        self.codec.pass1_cpu_used = spin.get_value_as_int()
+
+    def on_backend_changed(self, cbtext):
+        self.codec.set_standalone(cbtext.get_active() == 1)
+
     def on_arguments_changed(self, entry):
         self.codec.arguments = entry.get_text()
 
+    def on_chunks_changed(self, spin):
+        self.codec.chunks = spin.get_value_as_int()
+        self.chunk_size_spin.set_sensitive(self.codec.chunks > 1)
+        self.scenes_check.set_sensitive(self.codec.chunks > 1)
+
+    def on_chunk_size_changed(self, spin):
+        self.codec.chunk_size = spin.get_value_as_int()
+
+    def on_scenes_toggled(self, check):
+        self.codec.scenes = check.get_active()
+
+    def on_keyframes_toggled(self, check):
+        self.codec.keyframes = check.get_active()
+
+    def on_rawvideo_toggled(self, check):
+        self.codec.rawvideo = check.get_active()
+
     def on_pixel_format_changed(self, cbtext, pixel_formats):
         self.codec.pixel_format = pixel_formats[cbtext.get_active_text()]
 
@@ -597,10 +977,18 @@ class CodecDialog(Gtk.Dialog):
         elif m == 'VBR':
             self.bitrate_spin.set_sensitive(False)
             self.quality_spin.set_sensitive(True)
+        elif m == 'CRF' or m == '2-pass':
+            self.crf_spin.set_sensitive(m == 'CRF')
+            self.bitrate_spin.set_sensitive(m == '2-pass')
+            if hasattr(self, 'pass1_preset_cbtext'):
+                self.pass1_preset_cbtext.set_sensitive(m == '2-pass')
+                self.pass1_analysis_cbtext.set_sensitive(m == '2-pass')
+            else:
+                self.pass1_cpu_used_spin.set_sensitive(m == '2-pass')
         self.codec.mode = m
 
     def on_bitrate_changed(self, spin):
-        self.codec.mode = spin.get_value_as_int()
+        self.codec.bitrate = spin.get_value_as_int()
 
     def on_quality_changed(self, spin):
         self.codec.quality = spin.get_value_as_int()
@@ -621,6 +1009,8 @@ class VideoCodecDialog(CodecDialog):
 
         self.pixel_format()
         self.color_matrix()
+        self.chunks()
+        self.rawvideo()
 
         hsep = Gtk.Separator(orientation=Gtk.Orientation.HORIZONTAL)
 
@@ -630,7 +1020,13 @@ class VideoCodecDialog(CodecDialog):
         self.grid.attach(self.input_matrix_cbtext, 1, 1, 1, 1)
         self.grid.attach(self.output_matrix_label, 0, 2, 1, 1)
         self.grid.attach(self.output_matrix_cbtext, 1, 2, 1, 1)
-        self.grid.attach(hsep, 0, 3, 2, 1)
+        self.grid.attach(self.chunks_label, 0, 3, 1, 1)
+        self.grid.attach(self.chunks_spin, 1, 3, 1, 1)
+        self.grid.attach(self.chunk_size_label, 0, 4, 1, 1)
+        self.grid.attach(self.chunk_size_spin, 1, 4, 1, 1)
+        self.grid.attach(self.scenes_check, 0, 5, 2, 1)
+        self.grid.attach(self.rawvideo_check, 0, 6, 2, 1)
+        self.grid.attach(hsep, 0, 7, 2, 1)
 
 
 class VpxDialog(VideoCodecDialog):
@@ -642,23 +1038,44 @@ class VpxDialog(VideoCodecDialog):
                    'good',
                    'realtime']
         cpus_used = Gtk.Adjustment(2, 0, 5, 1, 1)
+        pass1_cpus_used = Gtk.Adjustment(4, 0, 5, 1, 1)
+        bitrates = Gtk.Adjustment(4000, 1, 200000, 100, 1000)
 
+        self.mode(['CRF', '2-pass'])
         self.crf(crfs)
+        self.bitrate(bitrates)
         self.preset(presets)
         self.cpu_used(cpus_used)
+        self.pass1_cpu_used(pass1_cpus_used)
+        self.backend()
         self.arguments()
 
-        self.grid.attach(self.crf_label, 0, 4, 1, 1)
+        self.crf_spin.set_sensitive(self.codec.mode == 'CRF')
+        self.bitrate_spin.set_sensitive(self.codec.mode == '2-pass')
+
+        self.grid.attach(self.mode_label, 0, 8, 1, 1)
+        self.grid.attach_next_to(self.mode_cbtext, self.mode_label,
+                                 Gtk.PositionType.RIGHT, 1, 1)
+        self.grid.attach(self.crf_label, 0, 9, 1, 1)
         self.grid.attach_next_to(self.crf_spin, self.crf_label,
                                  Gtk.PositionType.RIGHT, 1, 1)
-        self.grid.attach(self.preset_label, 0, 5, 1, 1)
+        self.grid.attach(self.bitrate_label, 0, 10, 1, 1)
+        self.grid.attach_next_to(self.bitrate_spin, self.bitrate_label,
+                                 Gtk.PositionType.RIGHT, 1, 1)
+        self.grid.attach(self.preset_label, 0, 11, 1, 1)
         self.grid.attach_next_to(self.preset_cbtext, self.preset_label,
                                  Gtk.PositionType.RIGHT, 1, 1)
-        self.grid.attach(self.cpu_used_label, 0, 6, 1, 1)
+        self.grid.attach(self.cpu_used_label, 0, 12, 1, 1)
         self.grid.attach_next_to(self.cpu_used_spin, self.cpu_used_label,
                                  Gtk.PositionType.RIGHT, 1, 1)
-        self.grid.attach(self.arguments_label, 0, 7, 2, 1)
-        self.grid.attach(self.arguments_entry, 0, 8, 2, 1)
+        self.grid.attach(self.pass1_cpu_used_label, 0, 13, 1, 1)
+        self.grid.attach_next_to(self.pass1_cpu_used_spin,
+                                 self.pass1_cpu_used_label,
+                                 Gtk.PositionType.RIGHT, 1, 1)
+        self.grid.attach(self.backend_label, 0, 14, 1, 1)
+        self.grid.attach(self.backend_cbtext, 1, 14, 1, 1)
+        self.grid.attach(self.arguments_label, 0, 15, 2, 1)
+        self.grid.attach(self.arguments_entry, 0, 16, 2, 1)
 
         self.show_all()
 
@@ -699,22 +1116,49 @@ class X264Dialog(VideoCodecDialog):
                  'fastdecode',
                  'zerolatency']
 
+        bitrates = Gtk.Adjustment(4000, 1, 200000, 100, 1000)
+
+        self.mode(['CRF', '2-pass'])
         self.crf(crfs)
+        self.bitrate(bitrates)
         self.preset(presets)
+        self.pass1_preset(presets)
         self.tune(tunes)
+        self.keyframes()
+        self.backend()
         self.arguments()
 
-        self.grid.attach(self.crf_label, 0, 4, 1, 1)
+        self.crf_spin.set_sensitive(self.codec.mode == 'CRF')
+        self.bitrate_spin.set_sensitive(self.codec.mode == '2-pass')
+
+        self.grid.attach(self.mode_label, 0, 8, 1, 1)
+        self.grid.attach_next_to(self.mode_cbtext, self.mode_label,
+                                 Gtk.PositionType.RIGHT, 1, 1)
+        self.grid.attach(self.crf_label, 0, 9, 1, 1)
         self.grid.attach_next_to(self.crf_spin, self.crf_label,
                                  Gtk.PositionType.RIGHT, 1, 1)
-        self.grid.attach(self.preset_label, 0, 5, 1, 1)
+        self.grid.attach(self.bitrate_label, 0, 10, 1, 1)
+        self.grid.attach_next_to(self.bitrate_spin, self.bitrate_label,
+                                 Gtk.PositionType.RIGHT, 1, 1)
+        self.grid.attach(self.preset_label, 0, 11, 1, 1)
         self.grid.attach_next_to(self.preset_cbtext, self.preset_label,
                                  Gtk.PositionType.RIGHT, 1, 1)
-        self.grid.attach(self.tune_label, 0, 6, 1, 1)
+        self.grid.attach(self.pass1_preset_label, 0, 12, 1, 1)
+        self.grid.attach_next_to(self.pass1_preset_cbtext,
+                                 self.pass1_preset_label,
+                                 Gtk.PositionType.RIGHT, 1, 1)
+        self.grid.attach(self.pass1_analysis_label, 0, 13, 1, 1)
+        self.grid.attach_next_to(self.pass1_analysis_cbtext,
+                                 self.pass1_analysis_label,
+                                 Gtk.PositionType.RIGHT, 1, 1)
+        self.grid.attach(self.tune_label, 0, 14, 1, 1)
         self.grid.attach_next_to(self.tune_cbtext, self.tune_label,
                                  Gtk.PositionType.RIGHT, 1, 1)
-        self.grid.attach(self.arguments_label, 0, 7, 2, 1)
-        self.grid.attach(self.arguments_entry, 0, 8, 2, 1)
+        self.grid.attach(self.keyframes_check, 0, 15, 2, 1)
+        self.grid.attach(self.backend_label, 0, 16, 1, 1)
+        self.grid.attach(self.backend_cbtext, 1, 16, 1, 1)
+        self.grid.attach(self.arguments_label, 0, 17, 2, 1)
+        self.grid.attach(self.arguments_entry, 0, 18, 2, 1)
 
         self.show_all()
 
@@ -736,18 +1180,45 @@ class X265Dialog(VideoCodecDialog):
                    'veryslow',
                    'placebo']
 
+        bitrates = Gtk.Adjustment(4000, 1, 200000, 100, 1000)
+
+        self.mode(['CRF', '2-pass'])
         self.crf(crfs)
+        self.bitrate(bitrates)
         self.preset(presets)
+        self.pass1_preset(presets)
+        self.keyframes()
+        self.backend()
         self.arguments()
 
-        self.grid.attach(self.crf_label, 0, 4, 1, 1)
+        self.crf_spin.set_sensitive(self.codec.mode == 'CRF')
+        self.bitrate_spin.set_sensitive(self.codec.mode == '2-pass')
+
+        self.grid.attach(self.mode_label, 0, 8, 1, 1)
+        self.grid.attach_next_to(self.mode_cbtext, self.mode_label,
+                                 Gtk.PositionType.RIGHT, 1, 1)
+        self.grid.attach(self.crf_label, 0, 9, 1, 1)
         self.grid.attach_next_to(self.crf_spin, self.crf_label,
                                  Gtk.PositionType.RIGHT, 1, 1)
-        self.grid.attach(self.preset_label, 0, 5, 1, 1)
+        self.grid.attach(self.bitrate_label, 0, 10, 1, 1)
+        self.grid.attach_next_to(self.bitrate_spin, self.bitrate_label,
+                                 Gtk.PositionType.RIGHT, 1, 1)
+        self.grid.attach(self.preset_label, 0, 11, 1, 1)
         self.grid.attach_next_to(self.preset_cbtext, self.preset_label,
                                  Gtk.PositionType.RIGHT, 1, 1)
-        self.grid.attach(self.arguments_label, 0, 6, 2, 1)
-        self.grid.attach(self.arguments_entry, 0, 7, 2, 1)
+        self.grid.attach(self.pass1_preset_label, 0, 12, 1, 1)
+        self.grid.attach_next_to(self.pass1_preset_cbtext,
+                                 self.pass1_preset_label,
+                                 Gtk.PositionType.RIGHT, 1, 1)
+        self.grid.attach(self.pass1_analysis_label, 0, 13, 1, 1)
+        self.grid.attach_next_to(self.pass1_analysis_cbtext,
+                                 self.pass1_analysis_label,
+                                 Gtk.PositionType.RIGHT, 1, 1)
+        self.grid.attach(self.keyframes_check, 0, 14, 2, 1)
+        self.grid.attach(self.backend_label, 0, 15, 1, 1)
+        self.grid.attach(self.backend_cbtext, 1, 15, 1, 1)
+        self.grid.attach(self.arguments_label, 0, 16, 2, 1)
+        self.grid.attach(self.arguments_entry, 0, 17, 2, 1)
 
         self.show_all()
 
@@ -0,0 +1,162 @@
+import copy
+import os
+import subprocess
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import numpy as np
+import vapoursynth as vs
+
+from pyhenkan.queue import Queue
+from pyhenkan.sample import encode_sample, get_sample
+from pyhenkan.vapoursynth import VapourSynth
+
+# Segments sampled per title and their length in frames
+SEGMENTS = 4
+LENGTH = 48
+# CRF values tried at once, spread over the codec's useful range, the
+# ones between the last on target and the next are tried after
+STEPS = 8
+# Side of the SSIM window
+WINDOW = 8
+
+
+def psnr(a, b, peak=255.0):
+    mse = np.mean((a - b) ** 2)
+    return 100.0 if mse == 0 else float(10 * np.log10(peak * peak / mse))
+
+
+def _box(x, size):
+    # Mean of every size x size window, from a summed area table
+    s = np.pad(x.cumsum(0).cumsum(1), ((1, 0), (1, 0)), 'constant')
+    return (s[size:, size:] - s[:-size, size:] - s[size:, :-size] +
+            s[:-size, :-size]) / (size * size)
+
+
+def ssim(a, b, peak=255.0, size=WINDOW):
+    c1 = (0.01 * peak) ** 2
+    c2 = (0.03 * peak) ** 2
+    mu_a = _box(a, size)
+    mu_b = _box(b, size)
+    var_a = _box(a * a, size) - mu_a * mu_a
+    var_b = _box(b * b, size) - mu_b * mu_b
+    cov = _box(a * b, size) - mu_a * mu_b
+    s = ((2 * mu_a * mu_b + c1) * (2 * cov + c2) /
+         ((mu_a * mu_a + mu_b * mu_b + c1) * (var_a + var_b + c2)))
+    return float(s.mean())
+
+
+METRICS = {'ssim': ssim, 'psnr': psnr}
+
+
+class CrfSearch:
+    def __init__(self, metric='ssim', target=0.98, segments=SEGMENTS,
+                 length=LENGTH):
+        # Lowest score of the worst segment
+        self.metric = metric
+        self.target = target
+        self.segments = segments
+        self.length = length
+        self.lock = Lock()
+        self.done = 0
+
+    def get_crfs(self, codec):
+        lo, hi = codec.get_crf_range()
+        step = max((hi - lo) // (STEPS - 1), 1)
+        return list(range(lo, hi + 1, step))
+
+    def search(self, mediafile, codec):
+        queue = Queue()
+
+        clip = VapourSynth(mediafile).get_clip()
+        sample, lengths = get_sample(clip, self.segments, self.length)
+        crfs = self.get_crfs(codec)
+
+        queue.set_text('Searching CRF...')
+        with tempfile.TemporaryDirectory(prefix='pyhenkan-') as tmpd:
+            scores = self._score_all(codec, crfs, sample, lengths, tmpd)
+            crf = self.pick(scores)
+            # The grid is coarse, try every CRF up to the next one tried
+            higher = [c for c in crfs if c > crf]
+            if scores[crf] >= self.target and higher:
+                refine = list(range(crf + 1, higher[0]))
+                if refine:
+                    scores.update(self._score_all(codec, refine, sample,
+                                                  lengths, tmpd))
+                    crf = self.pick(scores)
+        queue.set_text('Ready')
+        queue.set_progress(0)
+
+        for c in sorted(scores):
+            queue.log('CRF {}: {} {:.4f}'.format(c, self.metric, scores[c]))
+        return crf
+
+    def pick(self, scores):
+        # Quality drops as CRF rises, keep the last one on target
+        crf = min(scores)
+        for c in sorted(scores):
+            if scores[c] >= self.target:
+                crf = c
+        return crf
+
+    def _score_all(self, codec, crfs, sample, lengths, tmpd):
+        self.done = 0
+        with ThreadPoolExecutor(max_workers=len(crfs)) as executor:
+            futures = [executor.submit(self._score, codec, c, sample,
+                                       lengths, tmpd, len(crfs))
+                       for c in crfs]
+            return dict(zip(crfs, [f.result() for f in futures]))
+
+    def _score(self, codec, crf, sample, lengths, tmpd, total):
+        queue = Queue()
+
+        c = copy.deepcopy(codec)
+        c.mode = 'CRF'
+        c.crf = crf
+        path = encode_sample(c, sample, os.path.join(tmpd, str(crf)))
+
+        # Luma only, at 8 bits on both sides
+        ref = sample.resize.Point(format=vs.GRAY8)
+        size = ref.width * ref.height
+        cmd = ['ffmpeg', '-v', 'error', '-i', path, '-map', '0:v:0',
+               '-f', 'rawvideo', '-pix_fmt', 'gray', '-']
+        proc = queue.popen(cmd, stdout=subprocess.PIPE,
+                           stderr=subprocess.DEVNULL)
+        metric = METRICS[self.metric]
+        scores = []
+        for n in range(ref.num_frames):
+            data = proc.stdout.read(size)
+            if len(data) < size:
+                break
+            b = np.frombuffer(data, np.uint8).reshape(ref.height, ref.width)
+            frame = ref.get_frame(n)
+            a = np.asarray(frame.get_read_array(0), dtype=np.float64)
+            scores.append(metric(a, b.astype(np.float64)))
+        proc.stdout.close()
+        if proc.wait() != 0 or len(scores) < ref.num_frames:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+        with self.lock:
+            self.done += 1
+            done = self.done
+        queue.progress_update(done, total)
+        # Worst segment, a quiet one must not hide a busy one
+        means = []
+        start = 0
+        for length in lengths:
+            means.append(np.mean(scores[start:start + length]))
+            start += length
+        return float(min(means))
+
+    def apply(self, mediafiles):
+        for mf in mediafiles:
+            for t in mf.tracklist:
+                if t.type == 'Video' and t.enable and t.codec and \
+                        t.codec.mode == 'CRF':
+                    t.codec.crf = self.search(mf, t.codec)
+                    Queue().log('{}: CRF {}'.format(mf.bname,
+                                                    t.codec.crf))
+
+# vim: ts=4 sw=4 et:
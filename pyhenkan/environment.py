@@ -17,6 +17,12 @@ class Environment:
         self.vencs['AVC (libx264)'] = [codec.X264, False]
         self.vencs['HEVC (libx265)'] = [codec.X265, False]
 
+        self.vbins = OrderedDict()
+        self.vbins['VP8 (vpxenc)'] = [codec.Vp8, False]
+        self.vbins['VP9 (vpxenc)'] = [codec.Vp9, False]
+        self.vbins['AVC (x264)'] = [codec.X264, False]
+        self.vbins['HEVC (x265)'] = [codec.X265, False]
+
         self.aencs = OrderedDict()
         self.aencs['AAC (native)'] = [codec.Aac, False]
         self.aencs['AAC (libfaac)'] = [codec.Faac, False]
@@ -69,6 +75,8 @@ class Environment:
             codecs = getattr(self, attr)
             for c in codecs:
                 codecs[c][1] = codecs[c][0]().is_avail()
+        for c in self.vbins:
+            self.vbins[c][1] = self.vbins[c][0]().is_binary_avail()
 
     def check_plugins(self):
         for attr in [d + '_plugins' for d in ['source', 'crop', 'resize',
@@ -144,6 +152,9 @@ class EnvironmentWindow(Gtk.Window):
         vencs_label = Gtk.Label()
         vencs_label.set_markup('<b>Video encoders</b>')
         vencs_label.set_halign(Gtk.Align.START)
+        vbins_label = Gtk.Label()
+        vbins_label.set_markup('<b>Standalone video encoders</b>')
+        vbins_label.set_halign(Gtk.Align.START)
         aencs_label = Gtk.Label()
         aencs_label.set_markup('<b>Audio encoders</b>')
         aencs_label.set_halign(Gtk.Align.START)
@@ -155,7 +166,7 @@ class EnvironmentWindow(Gtk.Window):
         arsps_label.set_halign(Gtk.Align.START)
 
         i = 0
-        for attr in ['vencs', 'aencs', 'adecs', 'arsps']:
+        for attr in ['vencs', 'vbins', 'aencs', 'adecs', 'arsps']:
             label = eval(attr + '_label')
             codecs = getattr(self.env, attr)
 
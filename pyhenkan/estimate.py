@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from pyhenkan.budget import OVERHEAD, get_bitrate
+from pyhenkan.queue import Queue
+from pyhenkan.sample import encode_sample, get_sample
+from pyhenkan.scene import SceneDetector
+from pyhenkan.vapoursynth import VapourSynth
+
+# Share of every title encoded, in this many segments
+FRACTION = 0.02
+SEGMENTS = 8
+# Shortest segment in frames, encoders need a few to settle
+MIN_LENGTH = 24
+
+
+class Estimator:
+    def __init__(self, fraction=FRACTION, segments=SEGMENTS):
+        self.fraction = fraction
+        self.segments = segments
+
+    def get_cachepath(self, mediafile, codec):
+        key = json.dumps(mediafile.get_key() +
+                         [codec.get_settings(), self.fraction,
+                          self.segments], sort_keys=True)
+        cache = os.environ.get('XDG_CACHE_HOME',
+                               os.path.expanduser('~/.cache'))
+        name = hashlib.sha1(key.encode()).hexdigest() + '.json'
+        return os.path.join(cache, 'pyhenkan', 'estimates', name)
+
+    def get_sample(self, mediafile, codec):
+        # Seconds and bytes the sample took, along with its share of frames
+        path = self.get_cachepath(mediafile, codec)
+        if os.path.isfile(path):
+            with open(path) as f:
+                result = json.load(f)
+            # Older samples timed a single CRF pass whatever the mode
+            if 'passes' in result:
+                return result
+
+        clip = VapourSynth(mediafile).get_clip()
+        # The real encode finds the cuts in the cache
+        if (codec.chunks > 1 and codec.scenes) or codec.keyframes:
+            SceneDetector(mediafile).get_cuts(clip)
+
+        length = max(round(clip.num_frames * self.fraction / self.segments),
+                     MIN_LENGTH)
+        sample, lengths = get_sample(clip, self.segments, length)
+        with tempfile.TemporaryDirectory(prefix='pyhenkan-') as tmpd:
+            start = time.monotonic()
+            o = encode_sample(codec, sample, os.path.join(tmpd, 'sample'))
+            elapsed = time.monotonic() - start
+            size = os.path.getsize(o)
+        result = {'frames': sample.num_frames, 'total': clip.num_frames,
+                  'fps': [clip.fps_num, clip.fps_den], 'time': elapsed,
+                  'size': size, 'passes': len(codec.get_passes())}
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.part', 'w') as f:
+            json.dump(result, f)
+        os.replace(path + '.part', path)
+        return result
+
+    def estimate(self, mediafile):
+        # Wall time in seconds and size in bytes of the new file
+        seconds = 0
+        size = 0
+        for t in mediafile.tracklist:
+            if not t.enable or t.type == 'Menu':
+                continue
+            if t.type == 'Video' and t.codec:
+                s = self.get_sample(mediafile, t.codec)
+                scale = s['total'] / max(s['frames'], 1)
+                # The sample went through every pass already
+                seconds += s['time'] * scale
+                if t.codec.mode == '2-pass':
+                    # Rate control over a few seconds is no guide, the
+                    # target bitrate is
+                    fps = s['fps']
+                    duration = s['total'] * fps[1] / fps[0] if fps[0] else \
+                        t.get_duration()
+                    size += t.codec.bitrate * 125 * duration
+                else:
+                    size += s['size'] * scale
+            else:
+                # kbit/s to bytes
+                size += get_bitrate(t) * 125 * t.get_duration()
+        return seconds, size * (1 + OVERHEAD)
+
+    def estimate_jobs(self, jobs):
+        queue = Queue()
+
+        total = [0, 0]
+        for i, job in enumerate(jobs):
+            queue.set_text('Estimating {}...'.format(job.mediafile.bname))
+            try:
+                job.estimate = self.estimate(job.mediafile)
+            except Exception as e:
+                queue.notify('Estimate of {} failed: {}'.format(
+                    job.mediafile.bname, e))
+                continue
+            total[0] += job.estimate[0]
+            total[1] += job.estimate[1]
+            queue.view.set_estimate(job)
+            queue.progress_update(i + 1, len(jobs))
+        queue.set_text('Ready')
+        queue.set_progress(0)
+        # Jobs running side by side share the machine, times add up
+        queue.view.set_total_estimate(total[0], total[1])
+        return total
+
+# vim: ts=4 sw=4 et:
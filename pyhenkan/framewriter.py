@@ -0,0 +1,157 @@
+import ctypes
+import fcntl
+import os
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import vapoursynth as vs
+
+# Linux only, not exposed by fcntl before Python 3.10
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+# Room for a few 2160p 4:2:0 8bit frames
+PIPE_SIZE = 32 << 20
+# Most systems cap writev at 1024 buffers
+IOV_MAX = os.sysconf('SC_IOV_MAX') if 'SC_IOV_MAX' in os.sysconf_names \
+    else 1024
+
+SUBSAMPLING = {(1, 1): '420', (1, 0): '422', (0, 0): '444', (0, 1): '440',
+               (2, 0): '411', (2, 2): '410'}
+
+
+def enlarge_pipe(fd, size=PIPE_SIZE):
+    # Unprivileged users are capped by /proc/sys/fs/pipe-max-size
+    try:
+        with open('/proc/sys/fs/pipe-max-size') as f:
+            size = min(size, int(f.read()))
+    except (OSError, ValueError):
+        pass
+    try:
+        return fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError:
+        # Not a pipe, or not Linux
+        return 0
+
+
+def get_pix_fmt(fmt):
+    # FFmpeg name of a VapourSynth format, for rawvideo input
+    if fmt.sample_type != vs.INTEGER:
+        raise ValueError('Unsupported format: ' + fmt.name)
+    depth = '' if fmt.bits_per_sample == 8 else \
+        '{}le'.format(fmt.bits_per_sample)
+    if fmt.color_family == vs.GRAY:
+        return 'gray' + depth
+    if fmt.color_family == vs.RGB:
+        return 'gbrp' + depth
+    ss = SUBSAMPLING[(fmt.subsampling_w, fmt.subsampling_h)]
+    return 'yuv{}p{}'.format(ss, depth)
+
+
+def get_csp(fmt):
+    # Name of a raw YUV input for x264, x265 and vpxenc
+    ss = SUBSAMPLING.get((fmt.subsampling_w, fmt.subsampling_h))
+    if fmt.color_family != vs.YUV or fmt.sample_type != vs.INTEGER or \
+            ss not in ['420', '422', '444']:
+        raise ValueError('Unsupported format: ' + fmt.name)
+    return 'i' + ss
+
+
+def get_y4m_header(clip):
+    fmt = clip.format
+    if fmt.sample_type != vs.INTEGER or fmt.color_family not in [vs.GRAY,
+                                                                 vs.YUV]:
+        raise ValueError('Unsupported format for Y4M: ' + fmt.name)
+    if fmt.color_family == vs.GRAY:
+        c = 'mono' if fmt.bits_per_sample == 8 else \
+            'mono{}'.format(fmt.bits_per_sample)
+    else:
+        ss = SUBSAMPLING[(fmt.subsampling_w, fmt.subsampling_h)]
+        if fmt.bits_per_sample > 8:
+            c = '{0}p{1} XYSCSS={0}P{1}'.format(ss, fmt.bits_per_sample)
+        elif ss == '420':
+            c = '420jpeg XYSCSS=420JPEG'
+        else:
+            c = '{0} XYSCSS={0}'.format(ss)
+    header = 'YUV4MPEG2 W{} H{} F{}:{} Ip A0:0 C{}\n'.format(
+        clip.width, clip.height, clip.fps_num, clip.fps_den, c)
+    return header.encode()
+
+
+class FrameWriter:
+    def __init__(self, clip, stream, y4m=True, prefetch=0):
+        self.clip = clip
+        self.fd = stream.fileno()
+        self.stream = stream
+        self.y4m = y4m
+        # Frames requested ahead, VapourSynth renders them in parallel
+        self.prefetch = prefetch if prefetch else vs.get_core().num_threads
+        fmt = clip.format
+        # FFmpeg wants planar RGB as G, B, R
+        if fmt.color_family == vs.RGB:
+            self.planes = [1, 2, 0]
+        else:
+            self.planes = list(range(fmt.num_planes))
+        self.size = 0
+        enlarge_pipe(self.fd)
+
+    def write(self, progress_update=None):
+        clip = self.clip
+        # Anything buffered by the file object goes first
+        self.stream.flush()
+        if self.y4m:
+            self._writev([get_y4m_header(clip)])
+
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.prefetch) as executor:
+            n = 0
+            while n < clip.num_frames or pending:
+                while n < clip.num_frames and len(pending) < self.prefetch:
+                    pending.append(executor.submit(clip.get_frame, n))
+                    n += 1
+                frame = pending.popleft().result()
+                self._write_frame(frame)
+                if progress_update:
+                    progress_update(n - len(pending), clip.num_frames)
+
+    def _write_frame(self, frame):
+        fmt = frame.format
+        bufs = [b'FRAME\n'] if self.y4m else []
+        for p in self.planes:
+            width = frame.width >> (fmt.subsampling_w if p else 0)
+            height = frame.height >> (fmt.subsampling_h if p else 0)
+            row = width * fmt.bytes_per_sample
+            stride = frame.get_stride(p)
+            # A view on the frame memory, no copy
+            ptr = frame.get_read_ptr(p).value
+            data = (ctypes.c_ubyte * (stride * height)).from_address(ptr)
+            data = memoryview(data).cast('B')
+            if stride == row:
+                bufs.append(data)
+            else:
+                # Skip the padding at the end of every line
+                bufs += [data[y * stride:y * stride + row]
+                         for y in range(height)]
+        self._writev(bufs)
+
+    def _writev(self, bufs):
+        for i in range(0, len(bufs), IOV_MAX):
+            batch = bufs[i:i + IOV_MAX]
+            total = sum([len(b) for b in batch])
+            written = os.writev(self.fd, batch)
+            self.size += written
+            # Short writes only happen on signals, finish the batch
+            while written < total:
+                rest = []
+                skip = written
+                for b in batch:
+                    if skip >= len(b):
+                        skip -= len(b)
+                        continue
+                    rest.append(b[skip:])
+                    skip = 0
+                batch = rest
+                total -= written
+                written = os.writev(self.fd, batch)
+                self.size += written
+
+# vim: ts=4 sw=4 et:
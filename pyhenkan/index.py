@@ -0,0 +1,215 @@
+import copy
+import hashlib
+import os
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Lock
+
+from pyhenkan.queue import Queue
+
+# Blocks read to fingerprint a source, spread from start to end
+SAMPLES = 8
+BLOCK = 64 << 10
+# Default size cap of the cache in MB
+SIZE = 2048
+# Sources indexed at once, mostly bound by storage
+WORKERS = 2
+
+
+class IndexCache:
+    # Singleton
+    __instance = None
+    __init = False
+
+    def __new__(cls):
+        if IndexCache.__instance is None:
+            IndexCache.__instance = object.__new__(cls)
+        return IndexCache.__instance
+
+    def __init__(self):
+        if not IndexCache.__init:
+            IndexCache.__init = True
+            cache = os.environ.get('XDG_CACHE_HOME',
+                                   os.path.expanduser('~/.cache'))
+            self.path = os.path.join(cache, 'pyhenkan', 'indexes')
+            # Least recently used indexes go first past this size in MB
+            self.size = SIZE
+            self.hits = 0
+            self.misses = 0
+            # Guards the counters, the fingerprints and the locks
+            self.lock = Lock()
+            self.ids = {}
+            # One per index file, a source is indexed once at a time
+            self.locks = {}
+
+    def get_id(self, source):
+        st = os.stat(source)
+        key = (source, st.st_size, st.st_mtime_ns)
+        with self.lock:
+            if key in self.ids:
+                return self.ids[key]
+
+        # Size and mtime are not enough on shares with coarse timestamps
+        h = hashlib.sha1('{}:{}'.format(st.st_size,
+                                        st.st_mtime_ns).encode())
+        with open(source, 'rb') as f:
+            last = max(st.st_size - BLOCK, 0)
+            for i in range(SAMPLES):
+                f.seek(last * i // (SAMPLES - 1))
+                h.update(f.read(BLOCK))
+        with self.lock:
+            self.ids[key] = h.hexdigest()
+        return self.ids[key]
+
+    def get_path(self, source, ext):
+        os.makedirs(self.path, exist_ok=True)
+        return os.path.join(self.path, '{}.{}'.format(self.get_id(source),
+                                                      ext))
+
+    def get_lock(self, path):
+        with self.lock:
+            if path not in self.locks:
+                self.locks[path] = Lock()
+            return self.locks[path]
+
+    def lookup(self, source, ext):
+        path = self.get_path(source, ext)
+        hit = os.path.isfile(path)
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if hit:
+            # Recently used, last to be evicted
+            os.utime(path)
+        else:
+            Queue().log('Indexing {}...'.format(source))
+        return path
+
+    def get_files(self):
+        files = []
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        return sorted(files)
+
+    def get_usage(self):
+        if not os.path.isdir(self.path):
+            return 0
+        return sum([size for mtime, size, path in self.get_files()])
+
+    def evict(self, keep=None):
+        if not os.path.isdir(self.path):
+            return
+        files = self.get_files()
+        total = sum([size for mtime, size, path in files])
+        for mtime, size, path in files:
+            if total <= self.size << 20:
+                break
+            # Never the index just built, nor one being built
+            if path == keep or self.get_lock(path).locked():
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            Queue().log('Evicted {}'.format(os.path.basename(path)))
+
+    def get_stats(self):
+        size = self.get_usage()
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': size}
+
+    def get_report(self):
+        s = self.get_stats()
+        return 'Index cache: {} hits, {} misses, {:.0f} of {} MB'.format(
+            s['hits'], s['misses'], s['size'] / (1 << 20), self.size)
+
+
+class Indexer:
+    # Singleton
+    __instance = None
+    __init = False
+
+    def __new__(cls):
+        if Indexer.__instance is None:
+            Indexer.__instance = object.__new__(cls)
+        return Indexer.__instance
+
+    def __init__(self):
+        if not Indexer.__init:
+            Indexer.__init = True
+            self.executor = ThreadPoolExecutor(max_workers=WORKERS)
+            # Guards futures and the counters
+            self.lock = Lock()
+            # Sources waiting or being indexed
+            self.futures = {}
+            # Progress of the current batch
+            self.done = 0
+            self.total = 0
+
+    def get_key(self, mediafile):
+        return (mediafile.path, type(mediafile.filters[0]).__name__)
+
+    def submit(self, mediafile):
+        # Index in the background, long before a step opens the source
+        source = mediafile.filters[0]
+        if not source.index:
+            return None
+        key = self.get_key(mediafile)
+        with self.lock:
+            if key in self.futures:
+                return self.futures[key]
+            if self.done == self.total:
+                self.done = self.total = 0
+            self.total += 1
+            # Settings may still change in the GUI
+            future = self.executor.submit(self._index, key,
+                                          copy.deepcopy(source),
+                                          mediafile.path)
+            self.futures[key] = future
+        self._progress(mediafile.bname)
+        return future
+
+    def wait(self, mediafile):
+        # Only for this source, others keep indexing meanwhile
+        with self.lock:
+            future = self.futures.get(self.get_key(mediafile))
+        if future is None:
+            return
+        if future.cancel():
+            # Not started yet, the caller indexes it right away
+            self._finish(self.get_key(mediafile), mediafile.bname)
+            return
+        queue = Queue()
+        queue.set_text('Waiting for index...')
+        wait([future])
+
+    def _index(self, key, source, path):
+        try:
+            source.get_clip(path)
+        except Exception as e:
+            # The step opening it reports the error
+            Queue().log('Indexing {} failed: {}'.format(path, e))
+        finally:
+            self._finish(key, os.path.basename(path))
+
+    def _finish(self, key, name):
+        with self.lock:
+            if self.futures.pop(key, None) is None:
+                return
+            self.done += 1
+        self._progress(name)
+
+    def _progress(self, name):
+        with self.lock:
+            done, total = self.done, self.total
+        Queue().view.set_index(done, total, name)
+
+# vim: ts=4 sw=4 et:
@@ -0,0 +1,120 @@
+import json
+import os
+import sqlite3
+
+from threading import Lock
+
+
+class Journal:
+    # Singleton
+    __instance = None
+    __init = False
+
+    def __new__(cls):
+        if Journal.__instance is None:
+            Journal.__instance = object.__new__(cls)
+        return Journal.__instance
+
+    def __init__(self):
+        if not Journal.__init:
+            Journal.__init = True
+            data = os.environ.get('XDG_DATA_HOME',
+                                  os.path.expanduser('~/.local/share'))
+            self.path = os.path.join(data, 'pyhenkan', 'queue.sqlite')
+            # Jobs and steps are updated from worker threads
+            self.lock = Lock()
+            # Opened on first use so the path can still be changed
+            self.db = None
+
+    def _connect(self):
+        if self.db is not None:
+            return self.db
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        # Every status change must survive a crash or a power loss
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=FULL')
+        self.db.execute('PRAGMA foreign_keys=ON')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                            'path TEXT NOT NULL, '
+                            'settings TEXT NOT NULL, '
+                            'status TEXT NOT NULL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS steps ('
+                            'job INTEGER NOT NULL '
+                            'REFERENCES jobs(id) ON DELETE CASCADE, '
+                            'idx INTEGER NOT NULL, '
+                            'name TEXT NOT NULL, '
+                            'status TEXT NOT NULL, '
+                            'output TEXT NOT NULL, '
+                            'PRIMARY KEY (job, idx))')
+        return self.db
+
+    def add(self, job):
+        mf = job.mediafile
+        settings = json.dumps(mf.get_settings())
+        with self.lock, self._connect():
+            if job.id is None:
+                cursor = self.db.execute('INSERT INTO jobs (path, settings, '
+                                         'status) VALUES (?, ?, ?)',
+                                         (mf.path, settings, job.status))
+                job.id = cursor.lastrowid
+            else:
+                self.db.execute('UPDATE jobs SET settings = ?, status = ? '
+                                'WHERE id = ?', (settings, job.status, job.id))
+            for i, step in enumerate(job.steps):
+                self.db.execute('INSERT OR REPLACE INTO steps (job, idx, '
+                                'name, status, output) '
+                                'VALUES (?, ?, ?, ?, ?)',
+                                (job.id, i, step.name, step.status,
+                                 step.output))
+
+    def remove(self, i):
+        if i is None:
+            return
+        with self.lock, self._connect():
+            self.db.execute('DELETE FROM jobs WHERE id = ?', (i,))
+
+    def clear(self):
+        with self.lock, self._connect():
+            self.db.execute('DELETE FROM jobs')
+
+    def set_job_status(self, job):
+        if job.id is None:
+            return
+        # Finished jobs have nothing left to resume
+        if job.status == 'Done':
+            self.remove(job.id)
+            return
+        with self.lock, self._connect():
+            self.db.execute('UPDATE jobs SET status = ? WHERE id = ?',
+                            (job.status, job.id))
+
+    def set_step_status(self, step):
+        job = step.job
+        if job.id is None:
+            return
+        with self.lock, self._connect():
+            self.db.execute('UPDATE steps SET status = ? '
+                            'WHERE job = ? AND idx = ?',
+                            (step.status, job.id, job.steps.index(step)))
+
+    def load(self):
+        records = []
+        with self.lock:
+            self._connect()
+            jobs = self.db.execute('SELECT id, path, settings, status '
+                                   'FROM jobs ORDER BY id').fetchall()
+            for i, path, settings, status in jobs:
+                steps = {}
+                for idx, step, output in self.db.execute(
+                        'SELECT idx, status, output FROM steps '
+                        'WHERE job = ?', (i,)):
+                    steps[idx] = (step, output)
+                records.append({'id': i, 'path': path,
+                                'settings': json.loads(settings),
+                                'status': status, 'steps': steps})
+        return records
+
+# vim: ts=4 sw=4 et:
@@ -4,13 +4,17 @@ import re
 import shutil
 import subprocess
 
+from collections import OrderedDict
+
+import pyhenkan.plugin as plugin
 from pyhenkan.environment import Environment
+from pyhenkan.index import Indexer
+from pyhenkan.journal import Journal
 from pyhenkan.plugin import LWLibavSource, LibavSMASHSource, FFmpegSource
-from pyhenkan.queue import Queue
+from pyhenkan.queue import Job, Queue
 from pyhenkan.track import AudioTrack, TextTrack, VideoTrack
 
 from pymediainfo import MediaInfo
-from gi.repository import GLib
 
 
 class MediaFile:
@@ -26,6 +30,11 @@ class MediaFile:
         self.dimensions = [0, 0, 0, 0]
         self.fps = [0, 1, 0, 1]
         self.trim = [0, 0]
+        # VapourSynth settings of the job, 0 takes a share of the queue's
+        self.core = OrderedDict([('threads', 0), ('max_cache_size', 0),
+                                 ('prefetch', 0)])
+        # Let the filter optimizer rewrite the chain before it runs
+        self.optimize = False
 
         env = Environment()
         if env.source_plugins['LWLibavSource'][1]:
@@ -42,6 +51,8 @@ class MediaFile:
         f.dimensions = copy.copy(self.dimensions)
         f.fps = copy.copy(self.fps)
         f.trim = copy.copy(self.trim)
+        f.core = copy.copy(self.core)
+        f.optimize = self.optimize
         f.filters = [copy.deepcopy(f) for f in self.filters]
         for i in range(len(self.tracklist)):
             tc = self.tracklist[i]
@@ -55,6 +66,42 @@ class MediaFile:
         f.oname = copy.copy(self.oname)
         return f
 
+    def get_settings(self):
+        settings = OrderedDict()
+        settings['filters'] = [f.get_settings() for f in self.filters]
+        settings['dimensions'] = self.dimensions
+        settings['fps'] = self.fps
+        settings['trim'] = self.trim
+        settings['core'] = self.core
+        settings['optimize'] = self.optimize
+        settings['oname'] = self.oname
+        settings['tracks'] = [t.get_settings() for t in self.tracklist]
+        return settings
+
+    def get_key(self):
+        # Identifies the filtered and trimmed clip, for caches built on it
+        st = os.stat(self.path)
+        settings = self.get_settings()
+        return [self.path, st.st_size, st.st_mtime_ns, settings['filters'],
+                settings['trim'], settings['optimize']]
+
+    def set_settings(self, settings):
+        if 'filters' in settings:
+            self.filters = [plugin.from_settings(f)
+                            for f in settings['filters']]
+        for key in ['dimensions', 'fps', 'trim']:
+            if key in settings:
+                setattr(self, key, list(settings[key]))
+        if 'core' in settings:
+            self.core.update(settings['core'])
+        if 'optimize' in settings:
+            self.optimize = settings['optimize']
+        if 'oname' in settings:
+            self.oname = settings['oname']
+        tracks = settings.get('tracks', [])
+        for t, ts in zip(self.tracklist, tracks):
+            t.set_settings(ts)
+
     def compare(self, mediafile):
         if len(self.tracklist) != len(mediafile.tracklist):
             m = ('{} ({} tracks) and {} ({} tracks) differ from each '
@@ -67,26 +114,44 @@ class MediaFile:
 
         return m
 
-    def process(self):
+    def process(self, record=None):
         queue = Queue()
 
-        job = queue.tstore.append(None, [None, self.bname, self.oname, '',
-                                         'Waiting'])
+        job = Job(self)
 
+        # Transcodes are independent from each other, mux needs them all
+        deps = []
         for t in self.tracklist:
             if t.type not in ['Text', 'Menu'] and t.enable and t.codec:
-                future = queue.executor.submit(t.transcode)
-                queue.tstore.append(job, [future, '', '', t.codec.library,
-                                          'Waiting'])
-
-        future = queue.executor.submit(self.mux)
-        queue.tstore.append(job, [future, '', '', 'mux', 'Waiting'])
+                step = job.add_step(t.codec.library, t.transcode)
+                step.output = t.get_tmpfilepath()
+                step.resume = t.set_tmpfilepath
+                deps.append(step)
+
+        step = job.add_step('mux', self.mux, deps)
+        step.output = os.path.join(self.dname, self.oname)
+
+        # Skip the steps a previous session completed
+        if record:
+            job.id = record['id']
+            for i, step in enumerate(job.steps):
+                status, output = record['steps'].get(i, ('Waiting', ''))
+                if (status == 'Done' and output == step.output and
+                        os.path.isfile(output)):
+                    step.status = 'Done'
+                    if step.resume:
+                        step.resume(output)
+
+        # Indexing overlaps the encodes of the jobs ahead
+        Indexer().submit(self)
+        queue.add(job)
+        return job
 
     def mux(self):
         queue = Queue()
 
-        print('Mux...')
-        o = '/'.join([self.dname, self.oname])
+        queue.log('Mux...')
+        o = os.path.join(self.dname, self.oname)
 
         cmd = 'mkvmerge -o "{}" -D -A -S -B -T "{}"'.format(o, self.path)
 
@@ -115,36 +180,36 @@ class MediaFile:
             u = ' --segment-uid ' + self.uid
             cmd += u
 
-        print(cmd)
-
-        self.proc = subprocess.Popen(cmd, shell=True,
-                                     stdout=subprocess.PIPE,
-                                     universal_newlines=True)
+        queue.log(cmd)
 
-        GLib.idle_add(queue.pbar.set_fraction, 0)
-        GLib.idle_add(queue.pbar.set_text, 'Muxing...')
+        proc = queue.popen(cmd, shell=True, stdout=subprocess.PIPE,
+                           universal_newlines=True)
 
-        queue.update()
+        queue.set_progress(0)
+        queue.set_text('Muxing...')
 
-        while self.proc.poll() is None:
-            line = self.proc.stdout.readline()
+        while proc.poll() is None:
+            line = proc.stdout.readline()
             if 'Progress:' in line:
                 f = int(re.findall('[0-9]+', line)[0]) / 100
-                GLib.idle_add(queue.pbar.set_fraction, f)
-        if self.proc.poll() < 0:
-            GLib.idle_add(queue.pbar.set_text, 'Failed')
-        else:
-            GLib.idle_add(queue.pbar.set_text, 'Ready')
-        GLib.idle_add(queue.pbar.set_fraction, 0)
+                queue.set_progress(f)
+        # mkvmerge returns 1 on warnings, the output is still usable
+        if proc.poll() not in [0, 1]:
+            queue.set_text('Failed')
+            queue.set_progress(0)
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        queue.set_text('Ready')
+        queue.set_progress(0)
 
     def clean(self):
         queue = Queue()
 
-        print('Delete temporary files...')
-        shutil.rmtree(self.tmpd)
+        queue.log('Delete temporary files...')
+        if os.path.isdir(self.tmpd):
+            shutil.rmtree(self.tmpd)
 
-        GLib.add(queue.pbar.set_fraction, 0)
-        GLib.add(queue.pbar.set_text, 'Ready')
+        queue.set_progress(0)
+        queue.set_text('Ready')
 
     def parse(self):
         self.tracklist = []
@@ -196,9 +261,40 @@ class MediaFile:
                 tr.type = t.track_type
                 tr.format = t.format
                 tr.title = t.title if t.title else ''
+                tr.duration = float(t.duration) / 1000 if t.duration else 0
+                try:
+                    tr.bitrate = int(t.bit_rate) / 1000
+                except (TypeError, ValueError):
+                    tr.bitrate = 0
                 # We want the 3 letter code
                 tr.lang = t.other_language[3] if t.other_language else ''
 
                 self.tracklist.append(tr)
 
+
+def resume():
+    journal = Journal()
+    queue = Queue()
+    jobs = []
+    for record in journal.load():
+        if not os.path.isfile(record['path']):
+            journal.remove(record['id'])
+            continue
+        # Only interrupted jobs, a failed one would fail again every time
+        if record['status'] not in ['Waiting', 'Running', 'Stopped']:
+            queue.notify('Not resuming {}, it failed last time'.format(
+                os.path.basename(record['path'])))
+            journal.remove(record['id'])
+            continue
+        f = MediaFile(record['path'])
+        try:
+            f.set_settings(record['settings'])
+        except ValueError as e:
+            queue.notify('Not resuming {}: {}'.format(
+                os.path.basename(record['path']), e))
+            journal.remove(record['id'])
+            continue
+        jobs.append(f.process(record))
+    return jobs
+
 # vim: ts=4 sw=4 et:
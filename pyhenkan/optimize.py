@@ -0,0 +1,138 @@
+import copy
+
+from pyhenkan.plugin import (CropAbs, CropPlugin, CropRel, DebandPlugin,
+                             DenoisePlugin, ResizePlugin, SourcePlugin)
+
+
+def get_size(flt, width, height):
+    # Dimensions out of a filter, given the ones going in
+    if isinstance(flt, CropAbs):
+        return flt.args['width'], flt.args['height']
+    if isinstance(flt, CropRel):
+        return (width - flt.args['left'] - flt.args['right'],
+                height - flt.args['top'] - flt.args['bottom'])
+    if isinstance(flt, ResizePlugin):
+        return (flt.args['width'] if flt.args['width'] else width,
+                flt.args['height'] if flt.args['height'] else height)
+    return width, height
+
+
+def get_window(flt, width, height):
+    # Left, top, width and height of the source a crop keeps
+    if isinstance(flt, CropAbs):
+        return [flt.args['left'], flt.args['top'], flt.args['width'],
+                flt.args['height']]
+    w, h = get_size(flt, width, height)
+    return [flt.args['left'], flt.args['top'], w, h]
+
+
+def get_cost(filters, width, height):
+    # Pixels every filter reads or writes per frame, whichever is more
+    cost = 0
+    for f in filters:
+        if isinstance(f, SourcePlugin):
+            continue
+        w, h = get_size(f, width, height)
+        cost += max(w * h, width * height)
+        width, height = w, h
+    return cost
+
+
+class FilterOptimizer:
+    def __init__(self, width, height):
+        # Source dimensions, the chain is left alone when they are unknown
+        self.width = width
+        self.height = height
+        self.warnings = []
+        self.before = 0
+        self.after = 0
+
+    def optimize(self, filters):
+        self.warnings = []
+        if not self.width or not self.height:
+            self.before = self.after = 0
+            return list(filters)
+
+        self.before = get_cost(filters, self.width, self.height)
+        self._check_order(filters)
+
+        optimized = []
+        width, height = self.width, self.height
+        window = None
+        crop = None
+        for f in filters:
+            w, h = get_size(f, width, height)
+            if isinstance(f, CropPlugin):
+                if (w, h) == (width, height):
+                    # Keeps the whole frame
+                    continue
+                c = get_window(f, width, height)
+                if window:
+                    # Crops in a row make a single one
+                    c[0] += window[0]
+                    c[1] += window[1]
+                    crop = None
+                else:
+                    crop = f
+                window = c
+            elif isinstance(f, ResizePlugin):
+                if (w, h) == (width, height) and not f.args['format']:
+                    continue
+                f = copy.deepcopy(f)
+                f.args['width'], f.args['height'] = w, h
+                if window:
+                    # Crop as part of the resize, no intermediate frame
+                    for key, value in zip(['src_left', 'src_top',
+                                           'src_width', 'src_height'],
+                                          window):
+                        f.args[key] = value
+                    window = None
+                optimized.append(f)
+            else:
+                if window:
+                    optimized.append(crop if crop else self._crop(window))
+                    window = None
+                optimized.append(f)
+            width, height = w, h
+        if window:
+            optimized.append(crop if crop else self._crop(window))
+
+        self.after = get_cost(optimized, self.width, self.height)
+        return optimized
+
+    def _crop(self, window):
+        crop = CropAbs()
+        crop.args['width'], crop.args['height'] = window[2:4]
+        crop.args['left'], crop.args['top'] = window[0:2]
+        return crop
+
+    def _check_order(self, filters):
+        # Denoising or debanding a frame that is downscaled later on
+        width, height = self.width, self.height
+        sizes = []
+        for f in filters:
+            w, h = get_size(f, width, height)
+            sizes.append((width, height, w, h))
+            width, height = w, h
+        for i, f in enumerate(filters):
+            if not isinstance(f, (DenoisePlugin, DebandPlugin)):
+                continue
+            w, h = sizes[i][0:2]
+            for g, s in zip(filters[i + 1:], sizes[i + 1:]):
+                if isinstance(g, ResizePlugin) and s[2] * s[3] < w * h:
+                    self.warnings.append(
+                        '{} runs on {}x{}, {:.1f}x the pixels of the {} '
+                        'output at {}x{}'.format(
+                            type(f).__name__, w, h, w * h / (s[2] * s[3]),
+                            type(g).__name__, s[2], s[3]))
+                    break
+
+    def get_report(self):
+        lines = list(self.warnings)
+        if self.before:
+            saved = self.before - self.after
+            lines.append('Saves {} pixels per frame ({:.0%})'.format(
+                saved, saved / self.before))
+        return lines
+
+# vim: ts=4 sw=4 et:
@@ -2,6 +2,8 @@ from collections import OrderedDict
 
 import vapoursynth as vs
 
+from pyhenkan.index import IndexCache
+
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk
@@ -28,13 +30,17 @@ class Plugin:
         dlg.run()
         dlg.destroy()
 
+    def get_args(self, clip):
+        return self.args
+
     def get_line(self, clip):
         if clip != 'clip':
             args = ['"{}"'.format(clip)]
         else:
             args = [clip]
-        for key in self.args:
-            value = self.args[key]
+        kwargs = self.get_args(clip)
+        for key in kwargs:
+            value = kwargs[key]
             if type(value) is str:
                 arg = key + '="{}"'
             else:
@@ -51,20 +57,52 @@ class Plugin:
         f = getattr(u, self.function)
         return f(clip, **self.args)
 
+    def get_settings(self):
+        return OrderedDict([('plugin', type(self).__name__),
+                            ('args', OrderedDict(self.args))])
+
+
+def from_settings(settings):
+    name = settings.get('plugin')
+    if name not in PLUGINS:
+        raise ValueError('Unknown plugin {!r}'.format(name))
+    p = PLUGINS[name]()
+    p.args.update(settings.get('args', {}))
+    return p
+
 
 class SourcePlugin(Plugin):
-    def __init__(self, unit, function, dialog):
+    def __init__(self, unit, function, dialog, index=None):
         Plugin.__init__(self, unit, function, dialog)
 
+        # Extension of the index file, if the plugin writes one
+        self.index = index
+
         self.args['fpsnum'] = 0
         self.args['fpsden'] = 1
         # self.args['threads'] = 0
 
+    def get_args(self, source):
+        args = OrderedDict(self.args)
+        if self.index:
+            # Scripts share the central cache, not a file next to the source
+            args['cachefile'] = IndexCache().get_path(source, self.index)
+        return args
+
     def get_clip(self, source):
         core = vs.get_core()
         u = getattr(core, self.unit)
         f = getattr(u, self.function)
-        return f(source, **self.args)
+        if not self.index:
+            return f(source, **self.args)
+
+        cache = IndexCache()
+        path = cache.lookup(source, self.index)
+        # A second request for the same source waits and hits the cache
+        with cache.get_lock(path):
+            clip = f(source, cachefile=path, **self.args)
+        cache.evict(path)
+        return clip
 
 
 class LibavSMASHSource(SourcePlugin):
@@ -84,7 +122,7 @@ class LibavSMASHSource(SourcePlugin):
 class LWLibavSource(SourcePlugin):
     def __init__(self):
         SourcePlugin.__init__(self, 'lsmas', 'LWLibavSource',
-                              LWLibavSourceDialog)
+                              LWLibavSourceDialog, 'lwi')
 
         self.args['stream_index'] = -1
         # self.args['cache'] = 1
@@ -101,11 +139,10 @@ class LWLibavSource(SourcePlugin):
 class FFmpegSource(SourcePlugin):
     def __init__(self):
         SourcePlugin.__init__(self, 'ffms2', 'Source',
-                              FFMpegSourceDialog)
+                              FFMpegSourceDialog, 'ffindex')
 
         self.args['track'] = -1
         # self.args['cache'] = True
-        # self.args['cachefile'] = self.source + '.ffindex'
         # self.args['timecodes'] = ''
         # self.args['seekmode'] = 1
         # self.args['width'] = -1
@@ -283,6 +320,17 @@ class F3kdb(DebandPlugin):
         # self.args['random_param_grain'] = 1.0
 
 
+# Filters settings may name, templates and the journal included
+PLUGINS = OrderedDict([(p.__name__, p) for p in [LibavSMASHSource,
+                                                  LWLibavSource,
+                                                  FFmpegSource, CropAbs,
+                                                  CropRel, Bilinear, Bicubic,
+                                                  Point, Lanczos, Spline16,
+                                                  Spline36, FluxSmoothT,
+                                                  FluxSmoothST, RemoveGrain,
+                                                  TemporalSoften, F3kdb]])
+
+
 class PluginDialog(Gtk.Dialog):
     def __init__(self, plugin, parent):
         title = '{}.{}'.format(plugin.unit, plugin.function)
@@ -0,0 +1,230 @@
+import hashlib
+import json
+import os
+import shutil
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import numpy as np
+import vapoursynth as vs
+
+import gi
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import GdkPixbuf, GLib
+
+# Frames kept around, in MB of RGB pixels
+CACHE = 256
+# Frames fetched ahead and behind the one on screen
+RADIUS = 4
+# Thumbnails along the timeline and their height
+THUMBS = 32
+HEIGHT = 72
+# Size cap of the thumbnail cache in MB
+SIZE = 64
+
+
+def get_pixbuf(frame):
+    # VapourSynth RGB is planar, GdkPixbuf wants it packed
+    planes = [np.asarray(frame.get_read_array(p)) for p in range(3)]
+    rgb = np.dstack(planes)
+    height, width = rgb.shape[0:2]
+    data = GLib.Bytes.new(rgb.tobytes())
+    return GdkPixbuf.Pixbuf.new_from_bytes(data, GdkPixbuf.Colorspace.RGB,
+                                           False, 8, width, height,
+                                           width * 3)
+
+
+class FrameRenderer:
+    def __init__(self, clip, cache=CACHE, radius=RADIUS):
+        self.clip = clip.resize.Bilinear(format=vs.RGB24)
+        self.size = cache << 20
+        self.radius = radius
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(vs.get_core().num_threads, 2))
+        # Guards frames and pending
+        self.lock = Lock()
+        # Frame number to pixbuf, least recently used first
+        self.frames = OrderedDict()
+        self.used = 0
+        # Frames being rendered in the background
+        self.pending = {}
+        # Only the frame asked for last is shown
+        self.latest = None
+        self.closed = False
+
+    def request(self, n, callback):
+        # Never blocks, callback(n, pixbuf) runs on the main loop unless a
+        # newer request came in meanwhile, pixbuf is None on errors
+        with self.lock:
+            self.latest = n
+            pixbuf = self.frames.get(n)
+            if pixbuf is not None:
+                self.frames.move_to_end(n)
+            else:
+                # Prefetches around the old position would only delay it
+                for m in list(self.pending):
+                    if abs(m - n) > self.radius and self.pending[m].cancel():
+                        del self.pending[m]
+                future = self.pending.get(n)
+                if future is None:
+                    future = self.executor.submit(self._render, n)
+                    self.pending[n] = future
+        if pixbuf is not None:
+            callback(n, pixbuf)
+            self.prefetch(n)
+            return
+        future.add_done_callback(lambda f: self._deliver(n, f, callback))
+
+    def _deliver(self, n, future, callback):
+        if future.cancelled() or self.closed or n != self.latest:
+            return
+        e = future.exception()
+        if e:
+            print('Preview of frame {} failed: {}'.format(n, e))
+            # Still answered, the window stops waiting for it
+            GLib.idle_add(self._show, n, None, callback)
+            return
+        GLib.idle_add(self._show, n, future.result(), callback)
+        self.prefetch(n)
+
+    def _show(self, n, pixbuf, callback):
+        # A newer frame may have been requested since
+        if not self.closed and n == self.latest:
+            callback(n, pixbuf)
+
+    def prefetch(self, n):
+        # Closest frames first, ahead before behind
+        frames = []
+        for i in range(1, self.radius + 1):
+            frames += [n + i, n - i]
+        with self.lock:
+            if self.closed:
+                return
+            for m in frames:
+                if 0 <= m < self.clip.num_frames and \
+                        m not in self.frames and m not in self.pending:
+                    self.pending[m] = self.executor.submit(self._render, m)
+
+    def _render(self, n):
+        try:
+            pixbuf = get_pixbuf(self.clip.get_frame(n))
+        except Exception:
+            with self.lock:
+                self.pending.pop(n, None)
+            raise
+        size = pixbuf.get_rowstride() * pixbuf.get_height()
+        with self.lock:
+            # Cached before it stops being pending, never rendered twice
+            self.pending.pop(n, None)
+            if n not in self.frames:
+                self.frames[n] = pixbuf
+                self.used += size
+            # Keep the newest frame even if it alone is over the limit
+            while self.used > self.size and len(self.frames) > 1:
+                m, old = self.frames.popitem(last=False)
+                self.used -= old.get_rowstride() * old.get_height()
+        return pixbuf
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+            self.frames.clear()
+            self.used = 0
+        self.executor.shutdown(wait=False)
+
+
+class Thumbnailer:
+    def __init__(self, mediafile, clip, count=THUMBS, height=HEIGHT,
+                 size=SIZE):
+        # Built off the main loop, the key needs the source on disk
+        self.mediafile = mediafile
+        self.size = size
+        width = max(round(clip.width * height / clip.height / 2) * 2, 2)
+        self.clip = clip.resize.Bilinear(width, height, format=vs.RGB24)
+        last = clip.num_frames - 1
+        self.frames = sorted(set([round(last * i / max(count - 1, 1))
+                                  for i in range(count)]))
+        cache = os.environ.get('XDG_CACHE_HOME',
+                               os.path.expanduser('~/.cache'))
+        self.root = os.path.join(cache, 'pyhenkan', 'thumbnails')
+        self.path = self.get_cachepath()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(vs.get_core().num_threads, 2))
+        self.futures = []
+        self.closed = False
+
+    def get_cachepath(self):
+        # Thumbnails of the filtered and trimmed clip
+        key = json.dumps(self.mediafile.get_key() +
+                         [self.clip.width, self.clip.height], sort_keys=True)
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.root, name)
+
+    def get_dirs(self):
+        dirs = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                size = sum([os.path.getsize(os.path.join(path, f))
+                            for f in os.listdir(path)])
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            dirs.append((mtime, size, path))
+        return sorted(dirs)
+
+    def evict(self):
+        # Every filter change makes a new set, least recently shown go first
+        dirs = self.get_dirs()
+        total = sum([size for mtime, size, path in dirs])
+        for mtime, size, path in dirs:
+            if total <= self.size << 20:
+                break
+            if path == self.path:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def start(self, callback):
+        # callback(i, n, pixbuf) runs on the main loop as thumbnails come in,
+        # in no particular order
+        os.makedirs(self.path, exist_ok=True)
+        # Recently shown, last to be evicted
+        os.utime(self.path)
+        self.evict()
+        for i, n in enumerate(self.frames):
+            self.futures.append(self.executor.submit(self._thumbnail, i, n,
+                                                     callback))
+
+    def _thumbnail(self, i, n, callback):
+        if self.closed:
+            return
+        path = os.path.join(self.path, '{}.png'.format(n))
+        try:
+            if os.path.isfile(path):
+                pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
+            else:
+                pixbuf = get_pixbuf(self.clip.get_frame(n))
+                pixbuf.savev(path + '.part', 'png', [], [])
+                os.replace(path + '.part', path)
+        except Exception as e:
+            print('Thumbnail of frame {} failed: {}'.format(n, e))
+            return
+        GLib.idle_add(self._show, i, n, pixbuf, callback)
+
+    def _show(self, i, n, pixbuf, callback):
+        if not self.closed:
+            callback(i, n, pixbuf)
+
+    def close(self):
+        self.closed = True
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown(wait=False)
+
+# vim: ts=4 sw=4 et:
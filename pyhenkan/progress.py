@@ -0,0 +1,181 @@
+import time
+
+from threading import Lock, Thread
+
+
+def _int(value, default=0):
+    # N/A and missing fields keep the previous value
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return default
+
+
+def _float(value, default=0.0):
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+class FFmpegProgress:
+    # Parses the key=value blocks written by ffmpeg -progress
+    def __init__(self, duration=0, frames=0, callback=None):
+        # Expected length in seconds and frames, either may be unknown
+        self.duration = duration
+        self.frames = frames
+        # Called with self at the end of every block
+        self.callback = callback
+        self.fields = {}
+        self.frame = 0
+        self.fps = 0.0
+        # kbit/s
+        self.bitrate = 0.0
+        self.speed = 0.0
+        self.out_time_us = 0
+        self.done = False
+        self.thread = None
+
+    def feed(self, line):
+        key, sep, value = line.partition('=')
+        if not sep:
+            return
+        key = key.strip()
+        if key != 'progress':
+            self.fields[key] = value.strip()
+            return
+
+        f = self.fields
+        self.frame = _int(f.get('frame'), self.frame)
+        self.fps = _float(f.get('fps'), self.fps)
+        self.bitrate = _float(f.get('bitrate', '').replace('kbits/s', ''),
+                              self.bitrate)
+        self.speed = _float(f.get('speed', '').rstrip('x'), self.speed)
+        # Older ffmpeg only has out_time_ms, in microseconds all the same,
+        # N/A at the start and after some seeks
+        self.out_time_us = _int(f.get('out_time_us', f.get('out_time_ms')),
+                                self.out_time_us)
+        self.done = value.strip() == 'end'
+        if self.callback:
+            self.callback(self)
+
+    def read(self, stream):
+        for line in stream:
+            if isinstance(line, bytes):
+                line = line.decode(errors='replace')
+            self.feed(line)
+
+    def start(self, stream):
+        # For pipes nobody else reads, ffmpeg would block on a full one
+        self.thread = Thread(target=self.read, args=(stream,), daemon=True)
+        self.thread.start()
+
+    def join(self):
+        if self.thread:
+            self.thread.join()
+
+    @property
+    def fraction(self):
+        if self.done:
+            return 1.0
+        if self.frames:
+            return min(self.frame / self.frames, 1.0)
+        if self.duration:
+            return min(self.out_time_us / 1000000 / self.duration, 1.0)
+        return 0.0
+
+    @property
+    def eta(self):
+        # Seconds left, None until there is enough to go by
+        if self.done:
+            return 0.0
+        if self.frames and self.fps > 0:
+            return max(self.frames - self.frame, 0) / self.fps
+        if self.duration and self.speed > 0:
+            left = self.duration - self.out_time_us / 1000000
+            return max(left, 0) / self.speed
+        return None
+
+
+class _Entry:
+    def __init__(self):
+        self.fraction = 0.0
+        self.frames = None
+        self.time = None
+        # Frames per second between the last two updates
+        self.fps = 0.0
+        # Smoothed fraction per second
+        self.rate = 0.0
+
+
+class ProgressAggregator:
+    # Samples the progress of every running step at a fixed rate and hands
+    # the merged figures to a single callback, however often they change
+    def __init__(self, callback, interval=0.25, smoothing=0.2):
+        self.callback = callback
+        self.interval = interval
+        # Weight of the latest rate in the ETA moving average
+        self.smoothing = smoothing
+        self.lock = Lock()
+        self.entries = {}
+        self.changed = False
+        self.thread = None
+
+    def update(self, key, fraction, frames=None):
+        now = time.monotonic()
+        with self.lock:
+            e = self.entries.get(key)
+            if e is None:
+                e = self.entries[key] = _Entry()
+            if fraction < e.fraction:
+                # A new stage of the step started over
+                e.__init__()
+            if e.time is not None and now > e.time:
+                dt = now - e.time
+                if frames is not None and e.frames is not None:
+                    e.fps = max(frames - e.frames, 0) / dt
+                rate = max(fraction - e.fraction, 0) / dt
+                a = self.smoothing if e.rate else 1.0
+                e.rate = a * rate + (1 - a) * e.rate
+            e.fraction = fraction
+            e.frames = frames
+            e.time = now
+            self.changed = True
+            if self.thread is None:
+                self.thread = Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def remove(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.changed = True
+
+    def sample(self):
+        with self.lock:
+            return self._sample()
+
+    def _sample(self):
+        entries = list(self.entries.values())
+        if not entries:
+            return 0.0, 0.0, None
+        fraction = sum([e.fraction for e in entries]) / len(entries)
+        fps = sum([e.fps for e in entries])
+        # Steps run side by side, the slowest one decides
+        etas = [(1 - e.fraction) / e.rate for e in entries if e.rate > 0]
+        eta = max(etas) if etas else None
+        return fraction, fps, eta
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.changed:
+                    if not self.entries:
+                        self.thread = None
+                        return
+                    continue
+                self.changed = False
+                fraction, fps, eta = self._sample()
+            self.callback(fraction, fps, eta)
+
+# vim: ts=4 sw=4 et:
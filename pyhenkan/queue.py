@@ -1,13 +1,160 @@
+import os
+import signal
 import subprocess
+import traceback
 
-from concurrent.futures import ThreadPoolExecutor
-from threading import Lock
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from threading import Event, Lock, RLock, Thread, local
+
+import vapoursynth as vs
 
 import gi
 gi.require_version('Gtk', '3.0')
 gi.require_version('Notify', '0.7')
 from gi.repository import GLib, GObject, Gtk, Notify
 
+from pyhenkan.journal import Journal
+from pyhenkan.progress import ProgressAggregator
+
+
+class Job:
+    def __init__(self, mediafile):
+        # Journal id
+        self.id = None
+        self.mediafile = mediafile
+        self.steps = []
+        self.status = 'Waiting'
+        # Seconds and bytes, from sample encodes
+        self.estimate = None
+        self.executor = None
+        self.future = None
+        self.row = None
+        self.lock = RLock()
+
+    def add_step(self, name, function, deps=[]):
+        step = Step(self, name, function, deps)
+        self.steps.append(step)
+        return step
+
+    def start(self, executor):
+        queue = Queue()
+
+        self.executor = executor
+        # Resolved once every step has either run or been abandoned
+        self.future = Future()
+        self.future.set_running_or_notify_cancel()
+        queue.set_status(self, 'Running')
+        queue.notify('Processing ' + self.mediafile.bname)
+
+        self._submit_ready()
+        # Every step may already be done when resuming
+        self._finish()
+        return self.future
+
+    def cancel(self, status='Failed'):
+        queue = Queue()
+
+        with self.lock:
+            queue.set_status(self, status)
+            for step in self.steps:
+                if step.status != 'Done':
+                    queue.set_status(step, status)
+        # Free the cores now, the steps notice their processes are gone
+        for step in self.steps:
+            queue.kill(step)
+
+    def _submit_ready(self):
+        with self.lock:
+            ready = []
+            if self.status == 'Running':
+                for step in self.steps:
+                    if step.status == 'Waiting' and step.future is None \
+                            and step.is_ready():
+                        step.future = self.executor.submit(step.run)
+                        ready.append(step)
+        # Callbacks may fire right away, register them outside the lock
+        for step in ready:
+            step.future.add_done_callback(partial(self._on_step_done, step))
+
+    def _on_step_done(self, step, future):
+        queue = Queue()
+
+        stopped = []
+        with self.lock:
+            e = future.exception()
+            if e is not None:
+                traceback.print_exception(type(e), e, e.__traceback__)
+            if step.status == 'Running':
+                queue.set_status(step, 'Done' if e is None else 'Failed')
+            if step.status == 'Failed' and self.status == 'Running':
+                queue.set_status(self, 'Failed')
+            if self.status == 'Failed':
+                for s in self.steps:
+                    if s.status == 'Waiting':
+                        # Dependent steps will never run
+                        queue.set_status(s, 'Failed')
+                    elif s.status == 'Running':
+                        # Their output would be thrown away
+                        queue.set_status(s, 'Stopped')
+                        stopped.append(s)
+        # The steps notice their processes are gone
+        for s in stopped:
+            queue.kill(s)
+
+        self._submit_ready()
+        self._finish()
+
+    def _finish(self):
+        queue = Queue()
+
+        with self.lock:
+            if self.future.done():
+                return
+            if any([s.future and not s.future.done() for s in self.steps]):
+                return
+            if self.status == 'Running':
+                self.mediafile.clean()
+                queue.set_status(self, 'Done')
+            self.future.set_result(self.status)
+
+
+class Step:
+    def __init__(self, job, name, function, deps=[]):
+        self.job = job
+        self.name = name
+        self.function = function
+        # Steps that must be done before this one can start
+        self.deps = list(deps)
+        self.status = 'Waiting'
+        # Expected output, journaled so a later session can skip the step
+        self.output = ''
+        # Called with the output when the step is skipped
+        self.resume = None
+        # Latest FFmpegProgress of the running process
+        self.progress = None
+        self.future = None
+        self.row = None
+
+    def is_ready(self):
+        return all([d.status == 'Done' for d in self.deps])
+
+    def run(self):
+        queue = Queue()
+
+        # Cancelled before a worker picked it up
+        if self.status != 'Waiting':
+            return
+        queue.set_status(self, 'Running')
+        queue.local.step = self
+        try:
+            self.function()
+        finally:
+            queue.local.step = None
+            # Leftovers of a failed step
+            queue.kill(self)
+
 
 class Queue:
     # Singleton
@@ -22,229 +169,596 @@ class Queue:
     def __init__(self):
         if not Queue.__init:
             Queue.__init = True
-            # Set up single worker thread
+            # Jobs are only dispatched while the queue is not idle
             self.idle = True
-            self.executor = ThreadPoolExecutor(max_workers=1)
-            # Initialize a thread lock and acquire it
+            # Set once the last job is over
+            self.finished = Event()
+            self.finished.set()
+            # Number of jobs processed simultaneously
+            self.workers = 1
+            # VapourSynth threads and frame cache in MB split across running
+            # jobs, no memory budget leaves the cache size alone
+            self.threads = os.cpu_count()
+            self.memory = 0
+            # Steps of a job run concurrently, leave room for several per job
+            self.executor = ThreadPoolExecutor(max_workers=4 * os.cpu_count())
+            # Guards waitlist and running
             self.lock = Lock()
-            self.lock.acquire()
-            # Lock the queue
-            future = self.executor.submit(self.wait)
-            # Keep a list of all potential locks
-            self.waitlist = [future]
-            # Running proc
-            self.proc = None
+            # Jobs waiting for a free worker, in order
+            self.waitlist = deque()
+            # Jobs currently being processed
+            self.running = []
+            # Child processes of each step, in their own process groups
+            self.procs = {}
+            # Step run by the current thread
+            self.local = local()
+            # Remote workers video is encoded on, if any
+            self.pool = None
             # Shutdown after jobs
             self.shutdown = False
+            # Reports status and progress, the GUI or the CLI replace it
+            self.view = QueueView()
+            # Merges the progress of running steps into one view refresh
+            self.progress = ProgressAggregator(self._on_progress)
+
+    def progress_update(self, current, total, step=None):
+        # Current and total are frames
+        if step is None:
+            step = self.get_step()
+        self.progress.update(step, current / total if total else 0, current)
+
+    def set_progress(self, fraction):
+        step = self.get_step()
+        if step is None and not fraction:
+            # Nothing ends work done outside of steps but a reset
+            self.progress.remove(None)
+        else:
+            self.progress.update(step, fraction)
+
+    def set_step_progress(self, progress, step=None):
+        if step is None:
+            step = self.get_step()
+        if step is not None:
+            step.progress = progress
+        frames = progress.frame if progress.frames else None
+        self.progress.update(step, progress.fraction, frames)
+
+    def _on_progress(self, fraction, fps, eta):
+        self.view.set_progress(round(fraction, 2))
+        self.view.set_rate(fps, eta)
+
+    def set_text(self, text):
+        self.view.set_text(text)
+
+    def notify(self, text):
+        self.view.notify(text)
+
+    def log(self, text):
+        self.view.log(text)
+
+    def set_workers(self, workers):
+        self.workers = workers
+        self._schedule()
+
+    def get_share(self, mediafile):
+        # Settings left at 0 get an even share of the budget
+        with self.lock:
+            jobs = max(len(self.running), 1)
+        share = OrderedDict(mediafile.core)
+        if not share['threads']:
+            share['threads'] = max(self.threads // jobs, 1)
+        if not share['max_cache_size']:
+            share['max_cache_size'] = self.memory // jobs
+        if not share['prefetch']:
+            share['prefetch'] = share['threads']
+        return share
+
+    def set_threads(self, threads):
+        self.threads = threads
+        self.set_core()
+
+    def set_memory(self, memory):
+        self.memory = memory
+        self.set_core()
+
+    def set_core(self):
+        # The one core previews, samples and estimates share, per job shares
+        # only apply to the scripts piped to the encoders
+        core = vs.get_core()
+        core.num_threads = self.threads
+        if self.memory:
+            core.max_cache_size = self.memory
+
+    def set_status(self, obj, status):
+        # Only touch the row of the job or step that changed
+        obj.status = status
+        if isinstance(obj, Job):
+            Journal().set_job_status(obj)
+        else:
+            Journal().set_step_status(obj)
+            if status != 'Running':
+                self.progress.remove(obj)
+        self.view.set_status(obj)
+
+    def add(self, job):
+        Journal().add(job)
+        self.view.add_job(job)
+        with self.lock:
+            self.waitlist.append(job)
+        self._schedule()
+
+    def start(self):
+        self.log('Start processing...')
+        self.idle = False
+        self.finished.clear()
+        self._schedule()
+        self._check_finished()
+
+    def stop(self):
+        self.idle = True
+        self.log('Stop processing...')
+        if self.pool:
+            self.pool.cancel()
+
+        # Stop running jobs, waiting ones stay queued, neither failed so
+        # the next session resumes both
+        with self.lock:
+            running = list(self.running)
+        for job in running:
+            job.cancel('Stopped')
+        # Processes started outside of any step
+        self.kill(None)
+
+    def delete(self, job):
+        with self.lock:
+            if job in self.waitlist:
+                self.waitlist.remove(job)
+        if job.status == 'Running':
+            job.cancel()
+        Journal().remove(job.id)
+        self.view.remove_job(job)
+
+    def clear(self):
+        with self.lock:
+            self.waitlist.clear()
+            running = list(self.running)
+        for job in running:
+            job.cancel()
+        Journal().clear()
+        self.view.clear()
+
+    def wait(self):
+        self.finished.wait()
+
+    def get_step(self):
+        return getattr(self.local, 'step', None)
+
+    def popen(self, cmd, step=None, **kwargs):
+        if step is None:
+            step = self.get_step()
+        # A session of its own, so the whole process tree can be killed
+        proc = subprocess.Popen(cmd, start_new_session=True, **kwargs)
+        with self.lock:
+            self.procs.setdefault(step, []).append(proc)
+            cancelled = step is not None and step.status != 'Running'
+        if cancelled:
+            self.kill(step)
+        return proc
+
+    def kill(self, step):
+        with self.lock:
+            procs = self.procs.pop(step, [])
+        for proc in procs:
+            if proc.poll() is None:
+                self._signal(proc, signal.SIGTERM)
+                Thread(target=self._reap, args=(proc,), daemon=True).start()
+
+    def _signal(self, proc, sig):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def _reap(self, proc):
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self._signal(proc, signal.SIGKILL)
+            proc.wait()
+
+    def _schedule(self):
+        with self.lock:
+            jobs = []
+            while (not self.idle and self.waitlist and
+                   len(self.running) < self.workers):
+                job = self.waitlist.popleft()
+                self.running.append(job)
+                jobs.append(job)
+        # Jobs may complete right away, start them outside the lock
+        for job in jobs:
+            job.start(self.executor).add_done_callback(self._on_job_done)
+
+    def _on_job_done(self, future):
+        with self.lock:
+            self.running = [j for j in self.running if j.future is not future]
+        if not self._check_finished():
+            self._schedule()
+
+    def _check_finished(self):
+        with self.lock:
+            if self.running or (self.waitlist and not self.idle):
+                return False
+            stopped = self.idle
+            # Mark as idle if it was the last job
+            self.idle = True
+
+        self.finished.set()
+        if not stopped:
+            self.view.finished()
+            # Shutdown
+            if self.shutdown:
+                subprocess.run(['systemctl', 'poweroff'])
+        return True
+
+
+def format_eta(seconds):
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    return '{}:{:02d}:{:02d}'.format(h, m, s)
+
+
+def format_size(size):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1000:
+            break
+        size /= 1000
+    else:
+        unit = 'TB'
+    return '{:.1f} {}'.format(size, unit)
+
+
+class QueueView:
+    def add_job(self, job):
+        pass
+
+    def remove_job(self, job):
+        pass
+
+    def clear(self):
+        pass
+
+    def set_status(self, obj):
+        pass
+
+    def set_progress(self, fraction):
+        pass
+
+    def set_rate(self, fps, eta):
+        pass
+
+    def set_estimate(self, job):
+        pass
+
+    def set_total_estimate(self, seconds, size):
+        pass
+
+    def set_index(self, done, total, name):
+        pass
+
+    def set_text(self, text):
+        pass
+
+    def notify(self, text):
+        pass
+
+    def log(self, text):
+        print(text)
+
+    def finished(self):
+        pass
 
-            # GUI
-            expander_crpixbuf = Gtk.CellRendererPixbuf()
-            expander_crpixbuf.set_property('is-expander', True)
-            expander_tvcolumn = Gtk.TreeViewColumn('', expander_crpixbuf)
-
-            input_crtext = Gtk.CellRendererText()
-            input_tvcolumn = Gtk.TreeViewColumn('Input', input_crtext, text=1)
-
-            output_crtext = Gtk.CellRendererText()
-            output_tvcolumn = Gtk.TreeViewColumn('Output', output_crtext,
-                                                 text=2)
-
-            codec_crtext = Gtk.CellRendererText()
-            codec_tvcolumn = Gtk.TreeViewColumn('Codec', codec_crtext, text=3)
-
-            status_crtext = Gtk.CellRendererText()
-            status_tvcolumn = Gtk.TreeViewColumn('Status', status_crtext,
-                                                 text=4)
-
-            self.tstore = Gtk.TreeStore(GObject.TYPE_PYOBJECT,
-                                        str, str, str, str)
-
-            tview = Gtk.TreeView(self.tstore)
-            tview.append_column(expander_tvcolumn)
-            tview.append_column(input_tvcolumn)
-            tview.append_column(output_tvcolumn)
-            tview.append_column(codec_tvcolumn)
-            tview.append_column(status_tvcolumn)
-
-            self.tselection = tview.get_selection()
-
-            scrwin = Gtk.ScrolledWindow()
-            scrwin.set_policy(Gtk.PolicyType.AUTOMATIC,
-                              Gtk.PolicyType.ALWAYS)
-            scrwin.add(tview)
-
-            self.start_button = Gtk.Button()
-            self.start_button.set_label('Start')
-            self.start_button.connect('clicked', self.on_start_clicked)
-            self.start_button.set_sensitive(False)
-
-            self.stop_button = Gtk.Button()
-            self.stop_button.set_label('Stop')
-            self.stop_button.connect('clicked', self.on_stop_clicked)
-            self.stop_button.set_sensitive(False)
-
-            self.delete_button = Gtk.Button()
-            self.delete_button.set_label('Delete')
-            self.delete_button.connect('clicked', self.on_delete_clicked)
-            self.delete_button.set_sensitive(False)
-
-            self.clear_button = Gtk.Button()
-            self.clear_button.set_label('Clear')
-            self.clear_button.connect('clicked', self.on_clear_clicked)
-            self.clear_button.set_sensitive(False)
-
-            vsep = Gtk.Separator(orientation=Gtk.Orientation.VERTICAL)
-
-            shutdown_label = Gtk.Label('Shutdown')
-            shutdown_check = Gtk.CheckButton()
-            shutdown_check.set_active(self.shutdown)
-            shutdown_check.connect('toggled', self.on_shutdown_toggled)
-
-            hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL,
-                           spacing=6)
-            hbox.pack_start(self.start_button, True, True, 0)
-            hbox.pack_start(self.stop_button, True, True, 0)
-            hbox.pack_start(self.delete_button, True, True, 0)
-            hbox.pack_start(self.clear_button, True, True, 0)
-            hbox.pack_start(vsep, False, True, 0)
-            hbox.pack_start(shutdown_check, False, True, 0)
-            hbox.pack_start(shutdown_label, False, True, 0)
-
-            self.pbar = Gtk.ProgressBar()
-            self.pbar.set_property('margin', 6)
-            self.pbar.set_text('Ready')
-            self.pbar.set_show_text(True)
-
-            self.vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL,
-                                spacing=6)
-            self.vbox.set_property('margin', 6)
-            self.vbox.pack_start(scrwin, True, True, 0)
-            self.vbox.pack_start(hbox, False, True, 0)
-
-            # Notifications
-            Notify.init('pyhenkan')
-
-    def progress_update(self, current, total):
-        f = round(current / total, 2)
-        GLib.idle_add(self.pbar.set_fraction, f)
+
+class GtkQueueView(QueueView):
+    def __init__(self, queue, estimator=None):
+        self.queue = queue
+        self.estimator = estimator
+
+        expander_crpixbuf = Gtk.CellRendererPixbuf()
+        expander_crpixbuf.set_property('is-expander', True)
+        expander_tvcolumn = Gtk.TreeViewColumn('', expander_crpixbuf)
+
+        input_crtext = Gtk.CellRendererText()
+        input_tvcolumn = Gtk.TreeViewColumn('Input', input_crtext, text=1)
+
+        output_crtext = Gtk.CellRendererText()
+        output_tvcolumn = Gtk.TreeViewColumn('Output', output_crtext, text=2)
+
+        codec_crtext = Gtk.CellRendererText()
+        codec_tvcolumn = Gtk.TreeViewColumn('Codec', codec_crtext, text=3)
+
+        status_crtext = Gtk.CellRendererText()
+        status_tvcolumn = Gtk.TreeViewColumn('Status', status_crtext, text=4)
+
+        estimate_crtext = Gtk.CellRendererText()
+        estimate_tvcolumn = Gtk.TreeViewColumn('Estimate', estimate_crtext,
+                                               text=5)
+
+        self.tstore = Gtk.TreeStore(GObject.TYPE_PYOBJECT, str, str, str, str,
+                                    str)
+
+        tview = Gtk.TreeView(self.tstore)
+        tview.append_column(expander_tvcolumn)
+        tview.append_column(input_tvcolumn)
+        tview.append_column(output_tvcolumn)
+        tview.append_column(codec_tvcolumn)
+        tview.append_column(status_tvcolumn)
+        tview.append_column(estimate_tvcolumn)
+
+        self.tselection = tview.get_selection()
+
+        scrwin = Gtk.ScrolledWindow()
+        scrwin.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.ALWAYS)
+        scrwin.add(tview)
+
+        self.start_button = Gtk.Button()
+        self.start_button.set_label('Start')
+        self.start_button.connect('clicked', self.on_start_clicked)
+        self.start_button.set_sensitive(False)
+
+        self.stop_button = Gtk.Button()
+        self.stop_button.set_label('Stop')
+        self.stop_button.connect('clicked', self.on_stop_clicked)
+        self.stop_button.set_sensitive(False)
+
+        self.delete_button = Gtk.Button()
+        self.delete_button.set_label('Delete')
+        self.delete_button.connect('clicked', self.on_delete_clicked)
+        self.delete_button.set_sensitive(False)
+
+        self.clear_button = Gtk.Button()
+        self.clear_button.set_label('Clear')
+        self.clear_button.connect('clicked', self.on_clear_clicked)
+        self.clear_button.set_sensitive(False)
+
+        self.estimate_button = Gtk.Button()
+        self.estimate_button.set_label('Estimate')
+        self.estimate_button.connect('clicked', self.on_estimate_clicked)
+        self.estimate_button.set_sensitive(False)
+        self.estimate_label = Gtk.Label()
+
+        vsep1 = Gtk.Separator(orientation=Gtk.Orientation.VERTICAL)
+
+        workers_label = Gtk.Label('Workers')
+        workers_adj = Gtk.Adjustment(queue.workers, 1, os.cpu_count(), 1, 1)
+        workers_spin = Gtk.SpinButton()
+        workers_spin.set_adjustment(workers_adj)
+        workers_spin.set_numeric(True)
+        workers_spin.connect('value_changed', self.on_workers_changed)
+
+        vsep2 = Gtk.Separator(orientation=Gtk.Orientation.VERTICAL)
+
+        threads_label = Gtk.Label('Threads')
+        threads_adj = Gtk.Adjustment(queue.threads, 1, 4 * os.cpu_count(), 1,
+                                     1)
+        threads_spin = Gtk.SpinButton()
+        threads_spin.set_adjustment(threads_adj)
+        threads_spin.set_numeric(True)
+        threads_spin.connect('value_changed', self.on_threads_changed)
+
+        memory_label = Gtk.Label('Cache (MB)')
+        memory_adj = Gtk.Adjustment(queue.memory, 0, 1 << 20, 256, 1024)
+        memory_spin = Gtk.SpinButton()
+        memory_spin.set_adjustment(memory_adj)
+        memory_spin.set_numeric(True)
+        memory_spin.connect('value_changed', self.on_memory_changed)
+
+        vsep3 = Gtk.Separator(orientation=Gtk.Orientation.VERTICAL)
+
+        shutdown_label = Gtk.Label('Shutdown')
+        shutdown_check = Gtk.CheckButton()
+        shutdown_check.set_active(queue.shutdown)
+        shutdown_check.connect('toggled', self.on_shutdown_toggled)
+
+        hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
+        hbox.pack_start(self.start_button, True, True, 0)
+        hbox.pack_start(self.stop_button, True, True, 0)
+        hbox.pack_start(self.delete_button, True, True, 0)
+        hbox.pack_start(self.clear_button, True, True, 0)
+        if estimator:
+            hbox.pack_start(self.estimate_button, True, True, 0)
+            hbox.pack_start(self.estimate_label, False, True, 0)
+        hbox.pack_start(vsep1, False, True, 0)
+        hbox.pack_start(workers_label, False, True, 0)
+        hbox.pack_start(workers_spin, False, True, 0)
+        hbox.pack_start(vsep2, False, True, 0)
+        hbox.pack_start(threads_label, False, True, 0)
+        hbox.pack_start(threads_spin, False, True, 0)
+        hbox.pack_start(memory_label, False, True, 0)
+        hbox.pack_start(memory_spin, False, True, 0)
+        hbox.pack_start(vsep3, False, True, 0)
+        hbox.pack_start(shutdown_check, False, True, 0)
+        hbox.pack_start(shutdown_label, False, True, 0)
+
+        self.text = 'Ready'
+        self.rate = ''
+        self.pbar = Gtk.ProgressBar()
+        self.pbar.set_property('margin', 6)
+        self.pbar.set_text(self.text)
+        self.pbar.set_show_text(True)
+
+        # Background indexing, only shown while sources are being indexed
+        self.index_pbar = Gtk.ProgressBar()
+        self.index_pbar.set_property('margin', 6)
+        self.index_pbar.set_show_text(True)
+        self.index_pbar.set_no_show_all(True)
+
+        self.vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        self.vbox.set_property('margin', 6)
+        self.vbox.pack_start(scrwin, True, True, 0)
+        self.vbox.pack_start(hbox, False, True, 0)
+
+        # Notifications
+        Notify.init('pyhenkan')
+
+    def add_job(self, job):
+        mf = job.mediafile
+        job.row = self.tstore.append(None, [job, mf.bname, mf.oname, '',
+                                            job.status, ''])
+        for step in job.steps:
+            step.row = self.tstore.append(job.row, [step, '', '', step.name,
+                                                    step.status, ''])
+
+        if self.queue.idle:
+            GLib.idle_add(self.start_button.set_sensitive, True)
+            GLib.idle_add(self.estimate_button.set_sensitive, True)
+            GLib.idle_add(self.delete_button.set_sensitive, True)
+            GLib.idle_add(self.clear_button.set_sensitive, True)
+
+    def remove_job(self, job):
+        GLib.idle_add(self._remove_row, job)
+
+    def clear(self):
+        GLib.idle_add(self._clear_rows)
+
+    def set_status(self, obj):
+        GLib.idle_add(self._set_row_status, obj)
+
+    def set_progress(self, fraction):
+        GLib.idle_add(self.pbar.set_fraction, fraction)
+
+    def set_rate(self, fps, eta):
+        rate = []
+        if fps:
+            rate.append('{:.1f} fps'.format(fps))
+        if eta is not None:
+            rate.append('ETA ' + format_eta(eta))
+        self.rate = ', '.join(rate)
+        GLib.idle_add(self._update_text)
+
+    def set_estimate(self, job):
+        GLib.idle_add(self._set_row_estimate, job)
+
+    def set_total_estimate(self, seconds, size):
+        text = '{}, {}'.format(format_eta(seconds), format_size(size))
+        GLib.idle_add(self.estimate_label.set_text, text)
+        GLib.idle_add(self.estimate_button.set_sensitive, True)
+
+    def set_index(self, done, total, name):
+        GLib.idle_add(self._set_index, done, total, name)
+
+    def set_text(self, text):
+        self.text = text
+        self.rate = ''
+        GLib.idle_add(self._update_text)
+
+    def notify(self, text):
+        GLib.idle_add(self._notify, text)
+
+    def finished(self):
+        GLib.idle_add(self.start_button.set_sensitive, False)
+        GLib.idle_add(self.stop_button.set_sensitive, False)
+        GLib.idle_add(self.delete_button.set_sensitive, True)
+        GLib.idle_add(self.clear_button.set_sensitive, True)
+        GLib.idle_add(self._notify, 'Jobs done')
 
     def on_start_clicked(self, button):
+        GLib.idle_add(self.start_button.set_sensitive, False)
         GLib.idle_add(self.stop_button.set_sensitive, True)
         GLib.idle_add(self.delete_button.set_sensitive, False)
         GLib.idle_add(self.clear_button.set_sensitive, False)
-        print('Start processing...')
-        self.idle = False
-        self.lock.release()
+        self.queue.start()
 
     def on_stop_clicked(self, button):
-        self.idle = True
-        print('Stop processing...')
-        # Wait for the process to terminate
-        while self.proc.poll() is None:
-            self.proc.terminate()
-
-        for job in self.tstore:
-            status = self.tstore.get_value(job.iter, 4)
-            if status == 'Running':
-                for step in job.iterchildren():
-                    future = self.tstore.get_value(step.iter, 0)
-                    # Cancel and mark steps as failed
-                    if not future.done():
-                        GLib.idle_add(self.tstore.set_value, step.iter, 4,
-                                      'Failed')
-                        future.cancel()
-                # Mark job as failed
-                GLib.idle_add(self.tstore.set_value, job.iter, 4, 'Failed')
+        self.queue.stop()
 
         self.pbar.set_fraction(0)
-        self.pbar.set_text('Ready')
+        self.text = 'Ready'
+        self.rate = ''
+        self._update_text()
+        self.start_button.set_sensitive(bool(self.queue.waitlist))
         self.stop_button.set_sensitive(False)
+        self.delete_button.set_sensitive(True)
         self.clear_button.set_sensitive(True)
 
     def on_delete_clicked(self, button):
-        job = self.tselection.get_selected()[1]
+        row = self.tselection.get_selected()[1]
+        if row is None:
+            return
         # If child, select parent instead
-        if self.tstore.iter_depth(job) == 1:
-            job = self.tstore.iter_parent(job)
-        status = self.tstore.get_value(job, 4)
-        while self.tstore.iter_has_child(job):
-            step = self.tstore.iter_nth_child(job, 0)
-            future = self.tstore.get_value(step, 0)
-            # Cancel pending step
-            if not future.done():
-                future.cancel()
-            GLib.idle_add(self.tstore.remove, step)
-        # Cancel associated wait job
-        if status not in ['Done', 'Failed']:
-            i = self.tstore.get_path(job).get_indices()[0]
-            self.waitlist[i].cancel()
-        # Delete job
-        GLib.idle_add(self.tstore.remove, job)
-
-        if not len(self.tstore):
+        if self.tstore.iter_depth(row) == 1:
+            row = self.tstore.iter_parent(row)
+        self.queue.delete(self.tstore.get_value(row, 0))
+
+        if len(self.tstore) <= 1:
             GLib.idle_add(self.start_button.set_sensitive, False)
             GLib.idle_add(self.delete_button.set_sensitive, False)
             GLib.idle_add(self.clear_button.set_sensitive, False)
 
     def on_clear_clicked(self, button):
-        for job in self.tstore:
-            # Cancel jobs before clearing them
-            for step in job.iterchildren():
-                future = self.tstore.get_value(step.iter, 0)
-                future.cancel()
-            for future in self.waitlist:
-                future.cancel()
-        # Clear queue
-        self.tstore.clear()
+        self.queue.clear()
 
         GLib.idle_add(self.start_button.set_sensitive, False)
         GLib.idle_add(self.delete_button.set_sensitive, False)
         GLib.idle_add(self.clear_button.set_sensitive, False)
 
+    def on_estimate_clicked(self, button):
+        # Sample encodes take a while, keep the window responsive
+        button.set_sensitive(False)
+        jobs = list(self.queue.waitlist)
+        Thread(target=self.estimator.estimate_jobs, args=(jobs,),
+               daemon=True).start()
+
+    def on_workers_changed(self, spin):
+        self.queue.set_workers(spin.get_value_as_int())
+
+    def on_threads_changed(self, spin):
+        self.queue.set_threads(spin.get_value_as_int())
+
+    def on_memory_changed(self, spin):
+        self.queue.set_memory(spin.get_value_as_int())
+
     def on_shutdown_toggled(self, check):
-        self.shutdown = check.get_active()
+        self.queue.shutdown = check.get_active()
+
+    def _set_row_status(self, obj):
+        if obj.row is not None:
+            self.tstore.set_value(obj.row, 4, obj.status)
+
+    def _set_row_estimate(self, job):
+        if job.row is not None and job.estimate:
+            seconds, size = job.estimate
+            text = '{}, {}'.format(format_eta(seconds), format_size(size))
+            self.tstore.set_value(job.row, 5, text)
+
+    def _set_index(self, done, total, name):
+        if done == total:
+            self.index_pbar.hide()
+            return
+        self.index_pbar.set_fraction(done / total)
+        self.index_pbar.set_text('Indexing {} ({}/{})'.format(name, done,
+                                                               total))
+        self.index_pbar.show()
+
+    def _remove_row(self, job):
+        row = job.row
+        job.row = None
+        for step in job.steps:
+            step.row = None
+        self.tstore.remove(row)
+
+    def _clear_rows(self):
+        for row in self.tstore:
+            job = row[0]
+            job.row = None
+            for step in job.steps:
+                step.row = None
+        self.tstore.clear()
 
-    def wait(self):
-        if self.idle:
-            self.lock.acquire()
-
-    def update(self):
-        for job in self.tstore:
-            status = self.tstore.get_value(job.iter, 4)
-            filename = self.tstore.get_value(job.iter, 1)
-            new_status = self._mark_steps(job)
-            GLib.idle_add(self.tstore.set_value, job.iter, 4, new_status)
-            if new_status == 'Done' and not job.next:
-                # Mark as idle if it was the last job
-                self.idle = True
-                GLib.idle_add(self.start_button.set_sensitive, False)
-                GLib.idle_add(self.stop_button.set_sensitive, False)
-                GLib.idle_add(self.clear_button.set_sensitive, True)
-                GLib.idle_add(self._notify, 'Jobs done')
-                # Shutdown
-                if self.shutdown:
-                    subprocess.run(['systemctl', 'poweroff'])
-            elif new_status == 'Running' and new_status != status:
-                GLib.idle_add(self._notify, 'Processing ' + filename)
-
-    def _mark_steps(self, job):
-        for step in job.iterchildren():
-            future = self.tstore.get_value(step.iter, 0)
-            status = self.tstore.get_value(step.iter, 4)
-            if status == 'Failed':
-                return 'Failed'
-            elif future.done():
-                # Mark done steps as such
-                GLib.idle_add(self.tstore.set_value, step.iter, 4, 'Done')
-                if not step.next:
-                    # Mark job as done if all steps are
-                    return 'Done'
-            elif future.running():
-                # Mark running step as such
-                GLib.idle_add(self.tstore.set_value, step.iter, 4, 'Running')
-                return 'Running'
-            else:
-                return 'Waiting'
+    def _update_text(self):
+        if self.rate:
+            self.pbar.set_text('{} ({})'.format(self.text, self.rate))
+        else:
+            self.pbar.set_text(self.text)
 
     def _notify(self, text):
         n = Notify.Notification.new('pyhenkan', text, 'dialog-information')
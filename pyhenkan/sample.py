@@ -0,0 +1,41 @@
+import subprocess
+
+from pyhenkan.framewriter import FrameWriter
+from pyhenkan.queue import Queue
+
+
+def get_sample(clip, segments, length):
+    # Evenly spread segments spliced together, the whole clip if short
+    if clip.num_frames <= segments * length:
+        return clip, [clip.num_frames]
+    starts = [round((k + 0.5) * clip.num_frames / segments - length / 2)
+              for k in range(segments)]
+    sample = clip[starts[0]:starts[0] + length]
+    for s in starts[1:]:
+        sample += clip[s:s + length]
+    return sample, [length] * segments
+
+
+def encode_sample(codec, clip, path):
+    queue = Queue()
+
+    # In the mode of the real encode, first pass preset included
+    for n in codec.get_passes():
+        cmd = codec.get_cmd(path, [], clip, n)
+        proc = queue.popen(cmd, stdin=subprocess.PIPE,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+        FrameWriter(clip, proc.stdin, not codec.rawvideo).write()
+        proc.stdin.close()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    remux = codec.get_remux_cmd(path, clip)
+    if remux:
+        proc = queue.popen(remux, stdout=subprocess.DEVNULL)
+        # mkvmerge returns 1 on warnings
+        if proc.wait() not in [0, 1]:
+            raise subprocess.CalledProcessError(proc.returncode, remux)
+    return '.'.join([path, codec.container])
+
+# vim: ts=4 sw=4 et:
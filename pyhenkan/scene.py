@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import vapoursynth as vs
+
+from pyhenkan.queue import Queue
+
+# Analysis resolution, plenty to tell shots apart
+WIDTH = 64
+HEIGHT = 36
+# Mean absolute luma difference, out of 255, above which a frame is a cut
+THRESHOLD = 30
+# Frames analysed at once, keeps memory bounded on long sources
+BATCH = 512
+
+
+class SceneDetector:
+    def __init__(self, mediafile, threshold=THRESHOLD, min_length=0,
+                 prefetch=0):
+        self.mediafile = mediafile
+        self.threshold = threshold
+        # Shortest scene in frames, defaults to one second
+        self.min_length = min_length
+        # Frames requested at once, defaults to one per core
+        self.prefetch = prefetch if prefetch else os.cpu_count()
+
+    def get_cachepath(self):
+        # Cuts are frame numbers of the filtered and trimmed clip
+        key = json.dumps(self.mediafile.get_key() +
+                         [self.threshold, self.min_length], sort_keys=True)
+        cache = os.environ.get('XDG_CACHE_HOME',
+                               os.path.expanduser('~/.cache'))
+        name = hashlib.sha1(key.encode()).hexdigest() + '.json'
+        return os.path.join(cache, 'pyhenkan', 'scenes', name)
+
+    def get_cuts(self, clip):
+        path = self.get_cachepath()
+        if os.path.isfile(path):
+            with open(path) as f:
+                return json.load(f)
+
+        cuts = self.detect(clip)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.part', 'w') as f:
+            json.dump(cuts, f)
+        os.replace(path + '.part', path)
+        return cuts
+
+    def detect(self, clip):
+        queue = Queue()
+        queue.set_text('Detecting scenes...')
+
+        min_length = self.min_length
+        if min_length <= 0:
+            min_length = max(1, round(clip.fps_num / max(clip.fps_den, 1)))
+
+        small = clip.resize.Bilinear(WIDTH, HEIGHT, format=vs.GRAY8)
+
+        cuts = [0]
+        last = None
+        with ThreadPoolExecutor(max_workers=self.prefetch) as executor:
+            for start in range(0, small.num_frames, BATCH):
+                end = min(start + BATCH, small.num_frames)
+                planes = list(executor.map(lambda n: self._luma(small, n),
+                                           range(start, end)))
+                if last is not None:
+                    planes.insert(0, last)
+                last = planes[-1]
+
+                # One score per frame against its predecessor
+                stack = np.stack(planes).astype(np.int16)
+                scores = np.abs(np.diff(stack, axis=0)).mean(axis=(1, 2))
+                offset = start if start else 1
+                for i in np.flatnonzero(scores > self.threshold):
+                    n = int(i) + offset
+                    if n - cuts[-1] >= min_length:
+                        cuts.append(n)
+
+                queue.progress_update(end, small.num_frames)
+
+        queue.set_text('Ready')
+        queue.set_progress(0)
+        return cuts
+
+    def _luma(self, clip, n):
+        frame = clip.get_frame(n)
+        # Copy, the frame buffer is released with the frame
+        return np.array(frame.get_read_array(0), copy=True)
+
+# vim: ts=4 sw=4 et:
@@ -1,14 +1,14 @@
 import os
-import tempfile
-import vapoursynth as vs
+
+from threading import Thread
 
 from pyhenkan.mediafile import MediaFile
-from pyhenkan.plugin import Bilinear, ImageMagickWrite, ImageMagickHDRIWrite
+from pyhenkan.preview import FrameRenderer, Thumbnailer
 from pyhenkan.vapoursynth import VapourSynth
 
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk
+from gi.repository import GLib, Gtk
 
 
 class ScriptCreatorWindow(Gtk.Window):
@@ -145,14 +145,12 @@ class PreviewWindow(Gtk.Window):
 
         self.mediafile = mediafile
         self.vs = vs
-        self.tempdir = tempfile.gettempdir()
-        basename = '/'.join([self.tempdir, 'pyhenkan-preview'])
-        self.png = basename + '%d.png'
-        self.vpy = basename + '.vpy'
-
-        # Initialize the preview at the middle of the video
-        num_frames = self.vs.get_clip().num_frames
-        frame = round((num_frames - 1) / 2)
+        # Frames go straight from VapourSynth to the image, no file
+        self.renderer = None
+        self.thumbnailer = None
+        # Bumped on every reload, results of older ones are dropped
+        self.loads = 0
+        self.connect('destroy', self.on_destroy)
 
         self.image = Gtk.Image()
 
@@ -161,24 +159,35 @@ class PreviewWindow(Gtk.Window):
         scrwin.set_min_content_height(480)
         scrwin.add(self.image)
 
-        adj = Gtk.Adjustment(frame, 0, num_frames - 1, 1, 10)
+        # Thumbnails along the timeline, a click jumps to their frame
+        self.strip = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+        self.strip.set_spacing(2)
+        self.strip.set_property('margin', 6)
+        self.thumbs = []
+
+        strip_scrwin = Gtk.ScrolledWindow()
+        strip_scrwin.set_policy(Gtk.PolicyType.AUTOMATIC,
+                                Gtk.PolicyType.NEVER)
+        strip_scrwin.add(self.strip)
+
+        # The real range is only known once the clip is evaluated
+        adj = Gtk.Adjustment(0, 0, 0, 1, 10)
 
         self.spin = Gtk.SpinButton()
         self.spin.set_adjustment(adj)
         self.spin.set_numeric(True)
+        self.spin.set_sensitive(False)
         self.spin.connect('value-changed', self.on_spin_changed)
 
         self.scale = Gtk.Scale.new_with_range(Gtk.Orientation.HORIZONTAL,
-                                              0, num_frames - 1, 1)
+                                              0, 1, 1)
         self.scale.set_property('hexpand', True)
         self.scale.set_property('halign', Gtk.Align.FILL)
         self.scale.set_draw_value(False)
-        self.scale.set_value(frame)
+        self.scale.set_sensitive(False)
         self.scale.connect('value-changed', self.on_scale_changed)
 
-        # Add a mark every 500 frame
-        for i in range(0, num_frames, 500):
-            self.scale.add_mark(i, Gtk.PositionType.TOP, str(i))
+        self.spinner = Gtk.Spinner()
 
         refresh_button = Gtk.Button('Refresh')
         refresh_button.connect('clicked', self.on_refresh_clicked)
@@ -188,16 +197,98 @@ class PreviewWindow(Gtk.Window):
         hbox.set_property('margin', 6)
         hbox.pack_start(self.spin, False, True, 0)
         hbox.pack_start(self.scale, True, True, 0)
+        hbox.pack_start(self.spinner, False, True, 0)
         hbox.pack_start(refresh_button, False, True, 0)
 
         vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
         vbox.pack_start(scrwin, True, True, 0)
+        vbox.pack_start(strip_scrwin, False, True, 0)
         vbox.pack_start(hbox, False, True, 0)
 
         self.add(vbox)
 
+        self._load()
+
+    def _load(self):
+        # Indexing and heavy filters take a while, keep the window alive
+        self.loads += 1
+        self.spinner.start()
+        Thread(target=self._build, args=(self.loads,), daemon=True).start()
+
+    def _build(self, load):
+        try:
+            clip = self.vs.get_clip()
+            renderer = FrameRenderer(clip)
+            thumbnailer = Thumbnailer(self.mediafile, clip)
+        except Exception as e:
+            print('Preview failed: {}'.format(e))
+            GLib.idle_add(self._on_loaded, load, None, None)
+            return
+        GLib.idle_add(self._on_loaded, load, renderer, thumbnailer)
+
+    def _on_loaded(self, load, renderer, thumbnailer):
+        if load != self.loads:
+            if renderer:
+                renderer.close()
+                thumbnailer.close()
+            return
+        self.spinner.stop()
+        if renderer is None:
+            return
+        if self.renderer:
+            self.renderer.close()
+            self.thumbnailer.close()
+        first = self.renderer is None
+        self.renderer = renderer
+        self.thumbnailer = thumbnailer
+        self._populate_strip()
+
+        num_frames = renderer.clip.num_frames
+        if first:
+            # Initialize the preview at the middle of the video
+            frame = round((num_frames - 1) / 2)
+        else:
+            frame = min(self.spin.get_value_as_int(), num_frames - 1)
+
+        self.spin.get_adjustment().set_upper(num_frames - 1)
+        self.scale.set_range(0, num_frames - 1)
+        self.scale.clear_marks()
+        # Add a mark every 500 frame
+        for i in range(0, num_frames, 500):
+            self.scale.add_mark(i, Gtk.PositionType.TOP, str(i))
+        self.spin.set_sensitive(True)
+        self.scale.set_sensitive(True)
+
+        self.spin.set_value(frame)
+        self.scale.set_value(frame)
         self.set_frame(frame)
 
+    def _populate_strip(self):
+        for child in self.strip.get_children():
+            self.strip.remove(child)
+        self.thumbs = []
+
+        clip = self.thumbnailer.clip
+        for n in self.thumbnailer.frames:
+            image = Gtk.Image()
+            # Keeps its place until the thumbnail comes in
+            image.set_size_request(clip.width, clip.height)
+            ebox = Gtk.EventBox()
+            ebox.add(image)
+            ebox.set_tooltip_text('Frame {}'.format(n))
+            ebox.connect('button-press-event', self.on_thumb_clicked, n)
+            self.strip.pack_start(ebox, False, False, 0)
+            self.thumbs.append(image)
+        self.strip.show_all()
+
+        self.thumbnailer.start(self._on_thumb)
+
+    def _on_thumb(self, i, n, pixbuf):
+        self.thumbs[i].set_from_pixbuf(pixbuf)
+
+    def on_thumb_clicked(self, ebox, event, n):
+        self.spin.set_value(n)
+
     def on_scale_changed(self, scale):
         value = int(scale.get_value())
         if self.spin.get_value_as_int() != value:
@@ -211,29 +302,25 @@ class PreviewWindow(Gtk.Window):
             self.set_frame(value)
 
     def on_refresh_clicked(self, button):
-        self.set_frame(self.spin.get_value_as_int())
+        # Filters may have changed, cached frames are stale
+        self._load()
+
+    def on_destroy(self, widget):
+        self.loads += 1
+        if self.renderer:
+            self.renderer.close()
+            self.thumbnailer.close()
 
     def set_frame(self, frame):
-        filters = self.mediafile.filters
-        bilinear = Bilinear()
-        bilinear.args['format'] = vs.RGB24
-        imhdriw = ImageMagickHDRIWrite()
-        imw = imhdriw if imhdriw.is_avail() else ImageMagickWrite()
-        imw.args['imgformat'] = 'PNG'
-        imw.args['filename'] = self.png
-
-        # Add the necessary filters
-        filters += [bilinear, imw]
-
-        clip = self.vs.get_clip()[frame]
-        clip.set_output()
-        with open(os.devnull, 'wb') as f:
-            clip.output(f)
-
-        # Remove the filters
-        filters.pop()
-        filters.pop()
-
-        self.image.set_from_file(self.png.replace('%d', str(frame)))
+        if self.renderer is None:
+            return
+        self.spinner.start()
+        # Only the last frame asked for comes back
+        self.renderer.request(frame, self._on_frame)
+
+    def _on_frame(self, frame, pixbuf):
+        self.spinner.stop()
+        if pixbuf:
+            self.image.set_from_pixbuf(pixbuf)
 
 # vim: ts=4 sw=4 et:
@@ -1,12 +1,16 @@
 import os
-import re
 import subprocess
 
+from collections import OrderedDict
+
+import pyhenkan.codec as codec
+from pyhenkan.chunk import ChunkEncoder
+from pyhenkan.index import Indexer
+from pyhenkan.progress import FFmpegProgress
 from pyhenkan.queue import Queue
+from pyhenkan.scene import SceneDetector
 from pyhenkan.vapoursynth import VapourSynth
 
-from gi.repository import GLib
-
 
 class Track:
     def __init__(self):
@@ -19,6 +23,9 @@ class Track:
         self.format = ''
         self.title = ''
         self.lang = ''
+        # Seconds and kbit/s of the source track, if known
+        self.duration = 0
+        self.bitrate = 0
 
     def compare(self, track):
         m = ('{} (track {}: {}) and {} (track {}: {}) have different {}.\n'
@@ -41,6 +48,38 @@ class Track:
 
         return m
 
+    def get_settings(self):
+        settings = OrderedDict()
+        settings['enable'] = self.enable
+        settings['title'] = self.title
+        settings['lang'] = self.lang
+        settings['default'] = self.default
+        c = getattr(self, 'codec', None)
+        settings['codec'] = c.get_settings() if c else None
+        return settings
+
+    def set_settings(self, settings):
+        for key in ['enable', 'title', 'lang', 'default']:
+            if key in settings:
+                setattr(self, key, settings[key])
+        if settings.get('codec') and self.type in ['Video', 'Audio']:
+            self.codec = codec.from_settings(settings['codec'])
+        elif 'codec' in settings and self.type in ['Video', 'Audio']:
+            self.codec = None
+
+    def get_duration(self):
+        # Seconds actually encoded
+        trim = self.file.trim
+        fps = self.file.fps
+        if trim != [0, 0] and fps[0]:
+            return (trim[1] + 1 - trim[0]) * fps[1] / fps[0]
+        return self.duration
+
+    def set_tmpfilepath(self, path):
+        # Transcoded files only hold the one track
+        self.tmpfilepath = path
+        self.id = 0
+
 
 class VideoTrack(Track):
     def __init__(self):
@@ -54,40 +93,48 @@ class VideoTrack(Track):
     def transcode(self):
         queue = Queue()
 
-        if not os.path.isdir(self.file.tmpd):
-            os.mkdir(self.file.tmpd)
+        os.makedirs(self.file.tmpd, exist_ok=True)
 
-        print('Encode video...')
-        o = '/'.join([self.file.tmpd, self.file.name])
+        queue.log('Encode video...')
+        o = self.get_tmpfilepath()
+        o = o[:o.rindex('.')]
 
-        cmd = self.codec.get_cmd(o)
-        print(' '.join(cmd))
+        vs = VapourSynth(self.file)
+        share = vs.get_share()
+        # Other sources are still being indexed, only this one matters
+        Indexer().wait(self.file)
+        clip = vs.get_clip()
 
-        queue.proc = subprocess.Popen(cmd,
-                                      stdin=subprocess.PIPE,
-                                      stdout=subprocess.DEVNULL,
-                                      stderr=subprocess.DEVNULL)
+        cuts = []
+        if (self.codec.chunks > 1 and self.codec.scenes) or \
+                self.codec.keyframes:
+            sd = SceneDetector(self.file, prefetch=share['prefetch'])
+            cuts = sd.get_cuts(clip)
 
         # Progress
-        GLib.idle_add(queue.pbar.set_fraction, 0)
-        GLib.idle_add(queue.pbar.set_text, 'Encoding video...')
-
-        queue.update()
-
-        clip = VapourSynth(self.file).get_clip()
-        clip.output(queue.proc.stdin, y4m=True,
-                    progress_update=queue.progress_update)
-        queue.proc.communicate()
-
-        if queue.proc.returncode < 0:
-            GLib.idle_add(queue.pbar.set_text, 'Failed')
-        else:
-            GLib.idle_add(queue.pbar.set_text, 'Ready')
-        GLib.idle_add(queue.pbar.set_fraction, 0)
+        queue.set_progress(0)
+        queue.set_text('Encoding video...')
+
+        # A single chunk when not split, on a worker or right here
+        encoder = ChunkEncoder(self.codec, clip, o, cuts,
+                               vs.get_work(share),
+                               share['prefetch'],
+                               self.file.get_key())
+        try:
+            encoder.encode()
+        except Exception:
+            queue.set_text('Failed')
+            queue.set_progress(0)
+            raise
+        queue.set_text('Ready')
+        queue.set_progress(0)
 
         # Update path and id
-        self.tmpfilepath = '.'.join([o, self.codec.container])
-        self.id = 0
+        self.set_tmpfilepath('.'.join([o, self.codec.container]))
+
+    def get_tmpfilepath(self):
+        o = '/'.join([self.file.tmpd, self.file.name])
+        return '.'.join([o, self.codec.container])
 
 
 class AudioTrack(Track):
@@ -98,6 +145,14 @@ class AudioTrack(Track):
         self.rate = 0
         self.depth = 0
 
+    def set_settings(self, settings):
+        super().set_settings(settings)
+        # Keep the source layout unless told otherwise
+        if self.codec and 'channel' not in (settings.get('codec') or {}):
+            self.codec.channel = self.channel
+        if self.codec and 'rate' not in (settings.get('codec') or {}):
+            self.codec.rate = self.rate
+
     def compare(self, track):
         m = super().compare(track)
 
@@ -119,49 +174,39 @@ class AudioTrack(Track):
     def transcode(self):
         queue = Queue()
 
-        if not os.path.isdir(self.file.tmpd):
-            os.mkdir(self.file.tmpd)
+        os.makedirs(self.file.tmpd, exist_ok=True)
 
-        print('Encode audio...')
-        o = '_'.join([self.file.name, str(self.id)])
-        o = '/'.join([self.file.tmpd, o])
+        queue.log('Encode audio...')
+        o = self.get_tmpfilepath()
+        o = o[:o.rindex('.')]
 
         cmd = ' '.join(self.codec.get_cmd(self, o))
-        print(cmd)
+        queue.log(cmd)
 
-        queue.proc = subprocess.Popen(cmd, shell=True,
-                                      stdout=subprocess.DEVNULL,
-                                      stderr=subprocess.PIPE,
-                                      universal_newlines=True)
+        proc = queue.popen(cmd, shell=True, stdout=subprocess.PIPE,
+                           stderr=subprocess.DEVNULL, universal_newlines=True)
 
         # Progress
-        GLib.idle_add(queue.pbar.set_fraction, 0)
-        GLib.idle_add(queue.pbar.set_text, 'Encoding audio...')
-
-        queue.update()
-
-        while queue.proc.poll() is None:
-            line = queue.proc.stderr.readline()
-            # Get the clip duration
-            if 'Duration:' in line:
-                d = re.findall('[0-9]{2}:[0-9]{2}:[0-9]{2}', line)[0]
-                h, m, s = d.split(':')
-                total = int(h) * 3600 + int(m) * 60 + int(s)
-            # Get the current timestamp
-            if 'time=' in line:
-                t = re.findall('[0-9]{2}:[0-9]{2}:[0-9]{2}', line)[0]
-                h, m, s = t.split(':')
-                current = int(h) * 3600 + int(m) * 60 + int(s)
-                queue.progress_update(current, total)
-        if queue.proc.poll() < 0:
-            GLib.idle_add(queue.pbar.set_text, 'Failed')
-        else:
-            GLib.idle_add(queue.pbar.set_text, 'Ready')
-        GLib.idle_add(queue.pbar.set_fraction, 0)
+        queue.set_progress(0)
+        queue.set_text('Encoding audio...')
+
+        progress = FFmpegProgress(duration=self.get_duration(),
+                                  callback=queue.set_step_progress)
+        progress.read(proc.stdout)
+        if proc.wait() != 0:
+            queue.set_text('Failed')
+            queue.set_progress(0)
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        queue.set_text('Ready')
+        queue.set_progress(0)
 
         # Update path and id
-        self.tmpfilepath = '.'.join([o, self.codec.container])
-        self.id = 0
+        self.set_tmpfilepath('.'.join([o, self.codec.container]))
+
+    def get_tmpfilepath(self):
+        o = '_'.join([self.file.name, str(self.id)])
+        o = '/'.join([self.file.tmpd, o])
+        return '.'.join([o, self.codec.container])
 
 
 class TextTrack(Track):
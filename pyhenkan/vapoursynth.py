@@ -1,9 +1,16 @@
+from collections import OrderedDict
+from threading import Thread
+
 import pyhenkan.plugin as plugin
+from pyhenkan.autocrop import AutoCrop
 from pyhenkan.environment import Environment
+from pyhenkan.index import IndexCache
+from pyhenkan.optimize import FilterOptimizer
+from pyhenkan.queue import Queue
 
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gio, Gtk
+from gi.repository import Gio, GLib, Gtk
 
 
 class VapourSynth:
@@ -15,20 +22,36 @@ class VapourSynth:
         dlg.run()
         dlg.destroy()
 
-    def get_script(self):
-        script = ['import vapoursynth as vs', 'core = vs.get_core()']
-        script.append(self.mediafile.filters[0].get_line(self.mediafile.path))
-        for f in self.mediafile.filters[1:]:
-            script.append(f.get_line('clip'))
-        script.append('clip.set_output()')
-        return '\n'.join(script)
+    def get_share(self):
+        return Queue().get_share(self.mediafile)
+
+    def get_optimizer(self):
+        d = self.mediafile.dimensions
+        return FilterOptimizer(d[2], d[3])
+
+    def get_filters(self):
+        filters = self.mediafile.filters
+        if self.mediafile.optimize:
+            filters = self.get_optimizer().optimize(filters)
+        return filters
+
+    def get_work(self, share):
+        # What a remote worker rebuilds the clip from, settings only
+        return OrderedDict([('source', self.mediafile.path),
+                            ('filters', [f.get_settings()
+                                         for f in self.get_filters()]),
+                            ('trim', list(self.mediafile.trim)),
+                            ('threads', share['threads']),
+                            ('max_cache_size', share['max_cache_size'])])
 
     def get_clip(self):
-        clip = self.mediafile.filters[0].get_clip(self.mediafile.path)
-        for f in self.mediafile.filters[1:]:
+        # The core is sized by the queue, never per job
+        filters = self.get_filters()
+        clip = filters[0].get_clip(self.mediafile.path)
+        for f in filters[1:]:
             clip = f.get_clip(clip)
         t = self.mediafile.trim
-        if t != [0, 1]:
+        if t != [0, 0]:
             clip = clip[t[0]:t[1] + 1]
         return clip
 
@@ -50,8 +73,13 @@ class VapourSynthDialog(Gtk.Dialog):
         add_button.set_image(add_image)
         add_button.connect('clicked', self.on_add_clicked)
 
+        # Appends a crop of the borders found on sampled frames
+        self.autocrop_button = Gtk.Button('Auto Crop')
+        self.autocrop_button.connect('clicked', self.on_autocrop_clicked)
+
         hbar = self.get_header_bar()
         hbar.pack_start(add_button)
+        hbar.pack_end(self.autocrop_button)
 
         self.grid = Gtk.Grid()
         self.grid.set_column_spacing(6)
@@ -61,8 +89,53 @@ class VapourSynthDialog(Gtk.Dialog):
         self.scrwin = Gtk.ScrolledWindow()
         self.scrwin.add(self.grid)
 
+        core = mediafile.core
+        core_grid = Gtk.Grid()
+        core_grid.set_column_spacing(6)
+        core_grid.set_row_spacing(6)
+        core_grid.set_property('margin', 6)
+        labels = [('prefetch', 'Prefetch')]
+        if Queue().pool:
+            # Local jobs share one core, only workers build one per job
+            labels = [('threads', 'Threads'),
+                      ('max_cache_size', 'Cache (MB)')] + labels
+        for i, (key, text) in enumerate(labels):
+            label = Gtk.Label(text)
+            label.set_halign(Gtk.Align.START)
+            # 0 takes a share of the queue budget
+            adj = Gtk.Adjustment(core[key], 0, 1 << 20, 1, 10)
+            spin = Gtk.SpinButton()
+            spin.set_adjustment(adj)
+            spin.set_numeric(True)
+            spin.set_property('hexpand', True)
+            spin.connect('value_changed', self.on_core_changed, key)
+            core_grid.attach(label, 2 * i, 0, 1, 1)
+            core_grid.attach(spin, 2 * i + 1, 0, 1, 1)
+
+        optimize_check = Gtk.CheckButton('Optimize filter chain')
+        optimize_check.set_active(mediafile.optimize)
+        optimize_check.connect('toggled', self.on_optimize_toggled)
+        core_grid.attach(optimize_check, 0, 1, 6, 1)
+
+        self.report_label = Gtk.Label()
+        self.report_label.set_halign(Gtk.Align.START)
+        self.report_label.set_line_wrap(True)
+        core_grid.attach(self.report_label, 0, 2, 6, 1)
+
+        index_label = Gtk.Label(IndexCache().get_report())
+        index_label.set_halign(Gtk.Align.START)
+        core_grid.attach(index_label, 0, 3, 6, 1)
+
+        self.autocrop_label = Gtk.Label()
+        self.autocrop_label.set_halign(Gtk.Align.START)
+        core_grid.attach(self.autocrop_label, 0, 4, 6, 1)
+
+        hsep = Gtk.Separator(orientation=Gtk.Orientation.HORIZONTAL)
+
         box = self.get_content_area()
         box.pack_start(self.scrwin, True, True, 0)
+        box.pack_start(hsep, False, True, 0)
+        box.pack_start(core_grid, False, True, 0)
 
         self._populate_grid()
 
@@ -172,8 +245,18 @@ class VapourSynthDialog(Gtk.Dialog):
         else:
             self.scrwin.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.ALWAYS)
 
+        self._update_report()
         self.show_all()
 
+    def _update_report(self):
+        if not self.mediafile.optimize:
+            self.report_label.set_text('')
+            return
+        # Filters being added have no plugin yet
+        optimizer = VapourSynth(self.mediafile).get_optimizer()
+        optimizer.optimize([f for f in self.filters if f is not None])
+        self.report_label.set_text('\n'.join(optimizer.get_report()))
+
     def on_add_clicked(self, button):
         self.filters.append(None)
 
@@ -237,7 +320,42 @@ class VapourSynthDialog(Gtk.Dialog):
 
         self._populate_grid()
 
+    def on_core_changed(self, spin, key):
+        self.mediafile.core[key] = spin.get_value_as_int()
+
+    def on_optimize_toggled(self, check):
+        self.mediafile.optimize = check.get_active()
+        self._update_report()
+
     def on_conf_clicked(self, button, i):
         self.filters[i].show_dialog(self)
+        self._update_report()
+
+    def on_autocrop_clicked(self, button):
+        # Filters being added have no plugin yet
+        if None in self.filters:
+            return
+        self.autocrop_button.set_sensitive(False)
+        self.autocrop_label.set_text('Detecting borders...')
+        Thread(target=self._autocrop, daemon=True).start()
+
+    def _autocrop(self):
+        autocrop = AutoCrop()
+        try:
+            clip = VapourSynth(self.mediafile).get_clip()
+            crop = autocrop.detect(clip)
+        except Exception as e:
+            GLib.idle_add(self._on_autocrop, None, str(e))
+            return
+        text = autocrop.get_text(crop, clip.width, clip.height)
+        GLib.idle_add(self._on_autocrop, crop, text)
+
+    def _on_autocrop(self, crop, text):
+        self.autocrop_button.set_sensitive(True)
+        self.autocrop_label.set_text(text)
+        if crop:
+            AutoCrop().add(self.filters, crop)
+            self._populate_grid()
+            self._update_report()
 
 # vim: ts=4 sw=4 et:
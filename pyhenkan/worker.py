@@ -0,0 +1,480 @@
+import argparse
+import hmac
+import json
+import os
+import secrets
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import deque
+from threading import Condition, Event, Lock, Thread
+
+import vapoursynth as vs
+
+import pyhenkan.plugin as plugin
+from pyhenkan.framewriter import FrameWriter
+from pyhenkan.plugin import SourcePlugin
+from pyhenkan.progress import FFmpegProgress
+from pyhenkan.queue import Queue
+
+# Seconds between heartbeats, a worker silent for three is dead
+HEARTBEAT = 5
+TIMEOUT = 3 * HEARTBEAT
+# Encoded files are streamed back in blocks of this size
+BLOCK = 1 << 20
+# Seconds before a failed worker is tried again, doubled on every failure
+BACKOFF = 5
+MAX_BACKOFF = 300
+# Failed attempts at a piece of work before its job fails
+RETRIES = 5
+# Largest message accepted before the peer is authenticated
+HANDSHAKE = 4096
+# Programs a dispatcher may run, looked up in the worker's PATH
+ENCODERS = ['ffmpeg', 'x264', 'x265', 'vpxenc']
+REMUXERS = ['mkvmerge']
+# Hosts a worker listens on unless told to accept the network
+LOOPBACK = ['127.0.0.1', 'localhost', '::1']
+
+
+class WorkerError(Exception):
+    pass
+
+
+def send(sock, msg, payload=b''):
+    # Length prefixed JSON header, then the raw payload if any
+    msg = dict(msg, size=len(payload))
+    header = json.dumps(msg).encode()
+    sock.sendall(struct.pack('!I', len(header)) + header + payload)
+
+
+def recv(sock, limit=None):
+    size, = struct.unpack('!I', _recv_exactly(sock, 4))
+    if limit is not None and size > limit:
+        raise ConnectionError('Message too large')
+    msg = json.loads(_recv_exactly(sock, size).decode())
+    if limit is not None and msg.get('size', 0) > limit:
+        raise ConnectionError('Message too large')
+    payload = _recv_exactly(sock, msg.get('size', 0))
+    return msg, payload
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        block = sock.recv(size - len(data))
+        if not block:
+            raise ConnectionError('Connection closed')
+        data += block
+    return bytes(data)
+
+
+def get_secret(path=None):
+    # Shared by the dispatcher and its workers, created on first use
+    secret = os.environ.get('PYHENKAN_SECRET')
+    if secret:
+        return secret.encode()
+    if path is None:
+        config = os.environ.get('XDG_CONFIG_HOME',
+                                os.path.expanduser('~/.config'))
+        path = os.path.join(config, 'pyhenkan', 'secret')
+    try:
+        with open(path, 'rb') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    secret = secrets.token_hex(32).encode()
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # Created meanwhile by another process
+        return get_secret(path)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(secret)
+    return secret
+
+
+def get_digest(secret, nonce):
+    return hmac.new(secret, nonce.encode(), 'sha256').hexdigest()
+
+
+def challenge(sock, secret):
+    # Worker side, nothing else is read before the peer proves the secret
+    nonce = secrets.token_hex(16)
+    send(sock, {'type': 'challenge', 'nonce': nonce})
+    msg, payload = recv(sock, HANDSHAKE)
+    digest = msg.get('digest', '') if msg.get('type') == 'auth' else ''
+    if not hmac.compare_digest(str(digest), get_digest(secret, nonce)):
+        send(sock, {'type': 'error', 'text': 'Authentication failed'})
+        raise WorkerError('Authentication failed')
+    send(sock, {'type': 'welcome'})
+
+
+def authenticate(sock, secret):
+    # Dispatcher side
+    msg, payload = recv(sock, HANDSHAKE)
+    if msg.get('type') != 'challenge':
+        raise WorkerError('Unexpected handshake')
+    send(sock, {'type': 'auth', 'digest': get_digest(secret, msg['nonce'])})
+    msg, payload = recv(sock, HANDSHAKE)
+    if msg.get('type') != 'welcome':
+        raise WorkerError(msg.get('text', 'Authentication failed'))
+
+
+def check_name(name):
+    # Files live in the work directory, never anywhere else
+    if not isinstance(name, str) or name in ['', '.', '..'] or \
+            os.path.basename(name) != name:
+        raise WorkerError('Refused file name {!r}'.format(name))
+    return name
+
+
+def check_work(msg):
+    # The secret is shared, still only run what a dispatcher would send
+    cmds = msg.get('cmds', [msg.get('cmd')])
+    for cmd in cmds:
+        if not cmd or cmd[0] not in ENCODERS:
+            raise WorkerError('Refused to run {}'.format(cmd and cmd[0]))
+    remux = msg.get('remux')
+    if remux and remux[0] not in REMUXERS:
+        raise WorkerError('Refused to run {}'.format(remux[0]))
+    check_name(msg.get('output'))
+    for name in msg.get('files', {}):
+        check_name(name)
+
+
+def get_clip(msg):
+    # Rebuilt from plugin settings, nothing a dispatcher sends is executed
+    filters = [plugin.from_settings(f) for f in msg['filters']]
+    sources = [isinstance(f, SourcePlugin) for f in filters]
+    if not sources or sources != [True] + [False] * (len(sources) - 1):
+        raise WorkerError('Filter chains start with their only source')
+    core = vs.get_core()
+    if msg.get('threads'):
+        core.num_threads = msg['threads']
+    if msg.get('max_cache_size'):
+        core.max_cache_size = msg['max_cache_size']
+    clip = filters[0].get_clip(msg['source'])
+    for f in filters[1:]:
+        clip = f.get_clip(clip)
+    t = msg.get('trim', [0, 0])
+    if t != [0, 0]:
+        clip = clip[t[0]:t[1] + 1]
+    return clip
+
+
+def get_default_address():
+    run = os.environ.get('XDG_RUNTIME_DIR', tempfile.gettempdir())
+    return 'unix:' + os.path.join(run, 'pyhenkan-worker.sock')
+
+
+def is_unix(address):
+    return address.startswith('unix:') or '/' in address
+
+
+def connect(address):
+    if is_unix(address):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(TIMEOUT)
+        sock.connect(address.split('unix:', 1)[-1])
+        return sock
+    host, port = address.rsplit(':', 1)
+    return socket.create_connection((host, int(port)), TIMEOUT)
+
+
+class WorkerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # Heartbeats and progress are sent from different threads
+        self.lock = Lock()
+        try:
+            challenge(self.request, self.server.secret)
+        except (ConnectionError, OSError, ValueError, WorkerError) as e:
+            print('Rejected {}: {}'.format(self.client_address, e))
+            return
+        while True:
+            try:
+                msg, payload = recv(self.request)
+            except (ConnectionError, OSError):
+                return
+            if msg['type'] == 'ping':
+                self.send({'type': 'pong'})
+            elif msg['type'] == 'encode':
+                try:
+                    self.encode(msg)
+                except OSError as e:
+                    # The dispatcher is gone, it will reassign the work
+                    print('Connection lost: {}'.format(e))
+                    return
+
+    def send(self, msg, payload=b''):
+        with self.lock:
+            send(self.request, msg, payload)
+
+    def encode(self, msg):
+        print('Encode frames {} to {}...'.format(msg['start'], msg['end']))
+        with tempfile.TemporaryDirectory(prefix='pyhenkan-') as tmpd:
+            stop = Event()
+            beat = Thread(target=self._heartbeat, args=(stop,), daemon=True)
+            beat.start()
+            self.proc = None
+            try:
+                check_work(msg)
+                clip = get_clip(msg)[msg['start']:msg['end']]
+
+                files = msg.get('files', {})
+                for name in files:
+                    path = os.path.join(tmpd, name)
+                    with open(path, 'w') as f:
+                        f.write(files[name])
+
+                # One command per pass, every pass reads the whole chunk
+                cmds = msg.get('cmds', [msg.get('cmd')])
+                self.sent = 0
+                self.total = clip.num_frames * len(cmds)
+                for k, cmd in enumerate(cmds):
+                    self.offset = k * clip.num_frames
+                    self._run(cmd, clip, msg, tmpd)
+
+                remux = msg.get('remux')
+                if remux:
+                    print(' '.join(remux))
+                    ret = subprocess.call(remux, cwd=tmpd,
+                                          stdout=subprocess.DEVNULL)
+                    # mkvmerge returns 1 on warnings
+                    if ret not in [0, 1]:
+                        raise subprocess.CalledProcessError(ret, remux)
+            except Exception as e:
+                proc = self.proc
+                if proc and proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+                stop.set()
+                if isinstance(e, OSError):
+                    raise
+                self.send({'type': 'error', 'text': str(e)})
+                return
+            finally:
+                stop.set()
+
+            with open(os.path.join(tmpd, msg['output']), 'rb') as f:
+                block = f.read(BLOCK)
+                while block:
+                    self.send({'type': 'data'}, block)
+                    block = f.read(BLOCK)
+            self.send({'type': 'done'})
+
+    def _run(self, cmd, clip, msg, tmpd):
+        print(' '.join(cmd))
+        # Standalone encoders have no machine readable progress
+        standalone = msg.get('standalone', False)
+        proc = subprocess.Popen(cmd, cwd=tmpd, stdin=subprocess.PIPE,
+                                stdout=subprocess.DEVNULL
+                                if standalone else subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+        self.proc = proc
+        progress = FFmpegProgress(frames=clip.num_frames,
+                                  callback=lambda p: self._progress(
+                                      p.frame, p.frames))
+        if not standalone:
+            progress.start(proc.stdout)
+        writer = FrameWriter(clip, proc.stdin, msg.get('y4m', True),
+                             msg.get('prefetch', 0))
+        writer.write(self._progress if standalone else None)
+        proc.stdin.close()
+        proc.wait()
+        progress.join()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    def _heartbeat(self, stop):
+        while not stop.wait(HEARTBEAT):
+            try:
+                self.send({'type': 'heartbeat'})
+            except OSError:
+                return
+
+    def _progress(self, current, total):
+        # No need to flood the dispatcher
+        now = time.monotonic()
+        if current == total or now - self.sent >= 0.5:
+            self.sent = now
+            try:
+                self.send({'type': 'progress',
+                           'current': self.offset + current,
+                           'total': self.total})
+            except OSError:
+                # Gone, stop feeding the encoder
+                self.proc.kill()
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn,
+                          socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(address, secret, public=False):
+    if is_unix(address):
+        path = address.split('unix:', 1)[-1]
+        if os.path.exists(path):
+            os.remove(path)
+        server = ThreadingUnixServer(path, WorkerHandler)
+        # Only the owner gets past the filesystem
+        os.chmod(path, 0o600)
+    else:
+        host, port = address.rsplit(':', 1)
+        host = host.strip('[]') or '127.0.0.1'
+        if host not in LOOPBACK and not public:
+            raise ValueError('{} is reachable from the network, pass '
+                             '--public to listen on it'.format(host))
+        server = ThreadingTCPServer((host, int(port)), WorkerHandler)
+    server.secret = secret
+    print('Listening on {}'.format(address))
+    with server:
+        server.serve_forever()
+
+
+class WorkerPool:
+    def __init__(self, addresses, secret=None):
+        self.secret = secret if secret else get_secret()
+        # An address may be listed several times to run as many encodes
+        self.addresses = list(addresses)
+        self.free = deque(self.addresses)
+        # Slots that failed, with the time they are tried again
+        self.dead = []
+        # Consecutive failures of each address, the backoff doubles with them
+        self.failures = {}
+        self.cond = Condition()
+        # Open connections, shut down when the queue is stopped
+        self.socks = set()
+
+    def acquire(self):
+        queue = Queue()
+
+        with self.cond:
+            while True:
+                if self.free:
+                    return self.free.popleft()
+                if queue.idle:
+                    raise WorkerError('Queue stopped')
+                # Probe a dead worker again once its backoff is over
+                now = time.monotonic()
+                self.dead.sort()
+                if self.dead and self.dead[0][0] <= now:
+                    return self.dead.pop(0)[1]
+                self.cond.wait(self.dead[0][0] - now if self.dead else None)
+
+    def release(self, address, alive=True):
+        with self.cond:
+            if alive:
+                self.failures[address] = 0
+                self.free.append(address)
+            else:
+                failures = self.failures.get(address, 0) + 1
+                self.failures[address] = failures
+                delay = min(BACKOFF * 2 ** (failures - 1), MAX_BACKOFF)
+                self.dead.append((time.monotonic() + delay, address))
+            self.cond.notify_all()
+
+    def cancel(self):
+        with self.cond:
+            socks = list(self.socks)
+            # Wake up the jobs waiting for a slot, they give up
+            self.cond.notify_all()
+        for sock in socks:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def encode(self, work, path, progress):
+        queue = Queue()
+
+        attempts = 0
+        while True:
+            address = self.acquire()
+            try:
+                self._run(address, work, path, progress)
+            except OSError as e:
+                # Dead or unreachable, hand the work to another worker
+                queue.log('Lost worker {}: {}'.format(address, e))
+                self.release(address, False)
+                attempts += 1
+                if queue.idle or attempts >= RETRIES:
+                    raise
+                progress(0)
+                continue
+            except Exception:
+                self.release(address)
+                raise
+            self.release(address)
+            return
+
+    def _run(self, address, work, path, progress):
+        sock = connect(address)
+        with self.cond:
+            self.socks.add(sock)
+        try:
+            # Any message, heartbeats included, resets the timeout
+            sock.settimeout(TIMEOUT)
+            authenticate(sock, self.secret)
+            send(sock, dict(work, type='encode'))
+            with open(path + '.part', 'wb') as f:
+                while True:
+                    msg, payload = recv(sock)
+                    if msg['type'] == 'progress':
+                        progress(msg['current'])
+                    elif msg['type'] == 'data':
+                        f.write(payload)
+                    elif msg['type'] == 'done':
+                        break
+                    elif msg['type'] == 'error':
+                        raise WorkerError('{}: {}'.format(address,
+                                                          msg['text']))
+            os.replace(path + '.part', path)
+        finally:
+            with self.cond:
+                self.socks.discard(sock)
+            sock.close()
+            if os.path.exists(path + '.part'):
+                os.remove(path + '.part')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='pyhenkan-worker',
+                                     description='Encode chunks for remote '
+                                     'pyhenkan queues.')
+    parser.add_argument('address', nargs='?',
+                        default=get_default_address(),
+                        help='HOST:PORT or unix:PATH to listen on, defaults '
+                        'to a socket in $XDG_RUNTIME_DIR')
+    parser.add_argument('--public', action='store_true',
+                        help='allow listening on an address other than '
+                        'the loopback')
+    parser.add_argument('--secret-file', metavar='PATH',
+                        help='file holding the secret shared with '
+                        'dispatchers, defaults to '
+                        '~/.config/pyhenkan/secret or $PYHENKAN_SECRET')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    try:
+        serve(args.address, get_secret(args.secret_file), args.public)
+    except ValueError as e:
+        parser.error(str(e))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# vim: ts=4 sw=4 et:
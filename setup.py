@@ -25,6 +25,7 @@ setup(
     keywords='audio video conversion',
     install_requires=[
         'lxml',
+        'numpy',
         'pygobject',
         'pymediainfo',
         'setuptools',
@@ -34,7 +35,10 @@ setup(
         ('/usr/share/pixmaps', ['data/pyhenkan.svg']),
     ],
     entry_points={'gui_scripts': [
-        'pyhenkan = pyhenkan',
+        'pyhenkan = pyhenkan:main',
+    ],
+        'console_scripts': [
+        'pyhenkan-worker = pyhenkan.worker:main',
     ],
     },
 )
@@ -0,0 +1,139 @@
+import time
+
+from threading import Event
+
+import pytest
+
+# pyhenkan loads its GUI and VapourSynth as soon as it is imported
+pytest.importorskip('gi')
+pytest.importorskip('vapoursynth')
+
+import pyhenkan.progress as progress
+
+from pyhenkan.progress import ProgressAggregator
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+        # The sampling thread still sleeps for real
+        self.sleep = time.sleep
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(progress, 'time', c)
+    return c
+
+
+@pytest.fixture
+def aggregator(clock):
+    # Never samples on its own during a test
+    return ProgressAggregator(lambda *args: None, interval=3600)
+
+
+def test_empty(aggregator):
+    assert aggregator.sample() == (0.0, 0.0, None)
+
+
+def test_no_eta_from_one_update(aggregator):
+    aggregator.update('a', 0.1, 10)
+    assert aggregator.sample() == (0.1, 0.0, None)
+
+
+def test_eta(clock, aggregator):
+    aggregator.update('a', 0.0, 0)
+    clock.now = 1.0
+    aggregator.update('a', 0.1, 24)
+    fraction, fps, eta = aggregator.sample()
+    assert fraction == 0.1
+    assert fps == 24.0
+    assert eta == pytest.approx(9.0)
+
+
+def test_eta_smoothing(clock, aggregator):
+    aggregator.update('a', 0.0)
+    clock.now = 1.0
+    aggregator.update('a', 0.1)
+    # Twice as fast for a second, only a fifth of that counts
+    clock.now = 2.0
+    aggregator.update('a', 0.3)
+    rate = 0.2 * 0.2 + 0.8 * 0.1
+    assert aggregator.sample()[2] == pytest.approx(0.7 / rate)
+
+
+def test_stall(clock, aggregator):
+    aggregator.update('a', 0.0)
+    clock.now = 1.0
+    aggregator.update('a', 0.5)
+    clock.now = 2.0
+    aggregator.update('a', 0.5)
+    # The rate drops but the ETA does not jump to infinity
+    assert aggregator.sample()[2] == pytest.approx(0.5 / 0.4)
+
+
+def test_same_time(clock, aggregator):
+    aggregator.update('a', 0.0, 0)
+    aggregator.update('a', 0.5, 100)
+    assert aggregator.sample() == (0.5, 0.0, None)
+
+
+def test_restart(clock, aggregator):
+    aggregator.update('a', 0.0, 0)
+    clock.now = 1.0
+    aggregator.update('a', 0.9, 100)
+    # Second pass, nothing carries over from the first one
+    clock.now = 2.0
+    aggregator.update('a', 0.1, 10)
+    assert aggregator.sample() == (0.1, 0.0, None)
+
+
+def test_several_steps(clock, aggregator):
+    aggregator.update('video', 0.0, 0)
+    aggregator.update('audio', 0.0)
+    clock.now = 1.0
+    aggregator.update('video', 0.1, 30)
+    aggregator.update('audio', 0.5)
+    fraction, fps, eta = aggregator.sample()
+    assert fraction == pytest.approx(0.3)
+    assert fps == 30.0
+    # The slowest step decides
+    assert eta == pytest.approx(9.0)
+
+
+def test_remove(aggregator):
+    aggregator.update('a', 0.2)
+    aggregator.update('b', 0.4)
+    aggregator.remove('a')
+    aggregator.remove('c')
+    assert aggregator.sample() == (0.4, 0.0, None)
+
+
+def test_callback():
+    samples = []
+    done = Event()
+
+    def callback(*args):
+        samples.append(args)
+        if args[0] == 0.99:
+            done.set()
+
+    aggregator = ProgressAggregator(callback, interval=0.01)
+    for i in range(100):
+        aggregator.update('a', i / 100)
+    assert done.wait(5)
+    # Throttled, only the latest figures are handed over
+    assert len(samples) < 100
+    aggregator.remove('a')
+    thread = aggregator.thread
+    if thread:
+        thread.join(5)
+    # Told the last step is gone, then stops until the next update
+    assert samples[-1] == (0.0, 0.0, None)
+    assert aggregator.thread is None
+
+# vim: ts=4 sw=4 et:
@@ -0,0 +1,126 @@
+from types import SimpleNamespace
+
+import pytest
+
+# pyhenkan loads its GUI and VapourSynth as soon as it is imported
+pytest.importorskip('gi')
+vs = pytest.importorskip('vapoursynth')
+np = pytest.importorskip('numpy')
+
+from pyhenkan.autocrop import AutoCrop
+from pyhenkan.plugin import CropRel, Spline36
+
+
+class Clip:
+    def __init__(self, frames, subsampling=(1, 1), bits=8,
+                 sample_type=None):
+        self.frames = frames
+        self.format = SimpleNamespace(
+            sample_type=vs.INTEGER if sample_type is None else sample_type,
+            bits_per_sample=bits, subsampling_w=subsampling[0],
+            subsampling_h=subsampling[1])
+        self.height, self.width = frames[0].shape
+        self.num_frames = len(frames)
+
+    def get_frame(self, n):
+        return SimpleNamespace(get_read_array=lambda plane: self.frames[n])
+
+
+def frame(left, right, top, bottom, width=64, height=48, picture=200,
+          border=0, dtype=np.uint8):
+    luma = np.full((height, width), border, dtype=dtype)
+    luma[top:height - bottom, left:width - right] = picture
+    return luma
+
+
+def crop(left, right, top, bottom):
+    return dict(left=left, right=right, top=top, bottom=bottom)
+
+
+def test_420():
+    clip = Clip([frame(5, 3, 7, 9)] * 10)
+    assert AutoCrop().detect(clip) == crop(4, 2, 6, 8)
+
+
+def test_422():
+    clip = Clip([frame(5, 3, 7, 9)] * 10, (1, 0))
+    assert AutoCrop().detect(clip) == crop(4, 2, 7, 9)
+
+
+def test_444():
+    clip = Clip([frame(5, 3, 7, 9)] * 10, (0, 0))
+    assert AutoCrop().detect(clip) == crop(5, 3, 7, 9)
+
+
+def test_no_border():
+    clip = Clip([frame(0, 0, 0, 0)] * 10)
+    assert AutoCrop().detect(clip) == crop(0, 0, 0, 0)
+
+
+def test_black():
+    clip = Clip([frame(0, 0, 0, 0, picture=0)] * 10)
+    assert AutoCrop().detect(clip) == crop(0, 0, 0, 0)
+
+
+def test_widest_picture():
+    # A dark scene shrinks the picture of some frames
+    frames = [frame(8, 8, 8, 8)] * 5 + [frame(20, 8, 8, 20)] * 5
+    assert AutoCrop().detect(Clip(frames)) == crop(8, 8, 8, 8)
+
+
+def test_skips_black_frames():
+    frames = [frame(8, 8, 8, 8)] * 5 + [frame(0, 0, 0, 0, picture=0)] * 5
+    assert AutoCrop().detect(Clip(frames)) == crop(8, 8, 8, 8)
+
+
+def test_skips_first_and_last_frames():
+    # A logo on a full frame at both ends
+    frames = ([frame(0, 0, 0, 0)] + [frame(8, 8, 8, 8)] * 100 +
+              [frame(0, 0, 0, 0)])
+    assert AutoCrop().detect(Clip(frames)) == crop(8, 8, 8, 8)
+
+
+def test_high_bit_depth():
+    # Grey in 8 bits, close to black in 10
+    frames = [frame(8, 8, 8, 8, picture=800, border=64, dtype=np.uint16)]
+    assert AutoCrop().detect(Clip(frames * 10, bits=10)) == crop(8, 8, 8, 8)
+
+
+def test_float():
+    frames = [frame(8, 8, 8, 8, picture=0.8, border=0.05,
+                    dtype=np.float32)]
+    clip = Clip(frames * 10, (0, 0), 32, vs.FLOAT)
+    assert AutoCrop().detect(clip) == crop(8, 8, 8, 8)
+
+
+def test_variable_format():
+    clip = Clip([frame(0, 0, 0, 0)])
+    clip.format = None
+    with pytest.raises(ValueError):
+        AutoCrop().detect(clip)
+
+
+def test_add():
+    filters = [Spline36()]
+    AutoCrop().add(filters, crop(2, 2, 0, 0))
+    assert len(filters) == 2
+    assert isinstance(filters[1], CropRel)
+    assert dict(filters[1].args) == crop(2, 2, 0, 0)
+    # Merged with the crop already there
+    AutoCrop().add(filters, crop(0, 2, 4, 4))
+    assert len(filters) == 2
+    assert dict(filters[1].args) == crop(2, 4, 4, 4)
+
+
+def test_add_nothing():
+    filters = [Spline36()]
+    AutoCrop().add(filters, crop(0, 0, 0, 0))
+    assert len(filters) == 1
+
+
+def test_text():
+    assert AutoCrop().get_text(crop(4, 2, 6, 8), 64, 48) == (
+        'CropRel left=4 right=2 top=6 bottom=8, '
+        'CropAbs width=58 height=34 left=4 top=6')
+
+# vim: ts=4 sw=4 et:
@@ -0,0 +1,157 @@
+from types import SimpleNamespace
+
+import pytest
+
+# pyhenkan loads its GUI and VapourSynth as soon as it is imported
+pytest.importorskip('gi')
+pytest.importorskip('vapoursynth')
+np = pytest.importorskip('numpy')
+
+import pyhenkan.budget as budget
+
+from pyhenkan.budget import SizeBudget, get_bitrate
+
+
+class Track:
+    def __init__(self, type, duration, codec=None, enable=True, **kwargs):
+        self.type = type
+        self.duration = duration
+        self.codec = codec
+        self.enable = enable
+        self.bitrate = 0
+        self.channel = 2
+        self.rate = 48000
+        self.depth = 16
+        self.file = None
+        self.__dict__.update(kwargs)
+
+    def get_duration(self):
+        return self.duration
+
+
+class MediaFile:
+    def __init__(self, name, tracks, frames=0, fps=(0, 1), complexity=1.0):
+        self.bname = name
+        self.tracklist = tracks
+        for t in tracks:
+            t.file = self
+        self.clip = SimpleNamespace(num_frames=frames, fps_num=fps[0],
+                                    fps_den=fps[1], complexity=complexity)
+
+
+class VapourSynth:
+    def __init__(self, mf):
+        self.mf = mf
+
+    def get_clip(self):
+        return self.mf.clip
+
+
+@pytest.fixture(autouse=True)
+def clips(monkeypatch):
+    monkeypatch.setattr(budget, 'VapourSynth', VapourSynth)
+    monkeypatch.setattr(SizeBudget, 'get_complexity',
+                        lambda self, clip: clip.complexity)
+
+
+def video(duration=0):
+    return Track('Video', duration, SimpleNamespace(bitrate=0))
+
+
+def audio(duration, bitrate, **kwargs):
+    return Track('Audio', duration, SimpleNamespace(bitrate=bitrate),
+                 **kwargs)
+
+
+def test_bitrate_of_lossy():
+    assert get_bitrate(audio(10, 128)) == 128
+
+
+def test_bitrate_of_lossless():
+    t = Track('Audio', 10, SimpleNamespace(channel=0, rate=0), depth=24)
+    assert get_bitrate(t) == pytest.approx(2 * 48000 * 24 * 0.6 / 1000)
+    t.codec.channel = 6
+    t.depth = 0
+    assert get_bitrate(t) == pytest.approx(6 * 48000 * 16 * 0.6 / 1000)
+
+
+def test_bitrate_of_muxed():
+    assert get_bitrate(Track('Text', 10, bitrate=3)) == 3
+
+
+def test_split_by_complexity():
+    a = MediaFile('a.mkv', [video(), audio(600, 128)], 14400, (24, 1), 4.0)
+    b = MediaFile('b.mkv', [video(), audio(300, 128)], 9000, (30, 1), 16.0)
+    bitrates = SizeBudget(100).split([a, b])
+    # 100 MB less 1% and the audio, the weights are equal
+    left = 100 * 8000 * 0.99 - 128 * 900
+    assert bitrates == [(a.tracklist[0], int(left / 2 / 600)),
+                        (b.tracklist[0], int(left / 2 / 300))]
+
+
+def test_split_fills_budget():
+    files = [MediaFile(str(i), [video()], 24 * 60 * (i + 1), (24, 1), i + 1)
+             for i in range(4)]
+    bitrates = SizeBudget(500, overhead=0).split(files)
+    total = sum([b * (i + 1) * 60 for i, (t, b) in enumerate(bitrates)])
+    assert total == pytest.approx(500 * 8000, rel=0.001)
+    # Busier files get more bits per second
+    rates = [b for t, b in bitrates]
+    assert rates == sorted(rates)
+
+
+def test_split_track_duration():
+    # No frame rate, the track's duration is used
+    mf = MediaFile('a.mkv', [video(100)])
+    assert SizeBudget(1, overhead=0).split([mf]) == [(mf.tracklist[0], 80)]
+
+
+def test_split_skips_tracks():
+    mf = MediaFile('a.mkv', [video(100), audio(100, 64),
+                             audio(100, 500, enable=False),
+                             Track('Menu', 100)])
+    assert SizeBudget(1, overhead=0).split([mf]) == [(mf.tracklist[0], 16)]
+
+
+def test_split_video_without_codec():
+    # Muxed as is, takes its own bitrate off the budget
+    mf = MediaFile('a.mkv', [Track('Video', 100, bitrate=40), video(100)])
+    assert SizeBudget(1, overhead=0).split([mf]) == [(mf.tracklist[1], 40)]
+
+
+def test_split_too_small():
+    mf = MediaFile('a.mkv', [video(100), audio(100, 128)])
+    with pytest.raises(ValueError):
+        SizeBudget(1).split([mf])
+
+
+def test_split_unknown_duration():
+    mf = MediaFile('a.mkv', [video()])
+    with pytest.raises(ValueError, match='a.mkv'):
+        SizeBudget(1).split([mf])
+
+
+def test_split_minimum():
+    mf = MediaFile('a.mkv', [video(10 ** 9)])
+    assert SizeBudget(1).split([mf]) == [(mf.tracklist[0], 1)]
+
+
+def test_measure():
+    frames = [np.zeros((90, 160), dtype=np.uint8) for _ in range(3)]
+    frames[1][:, 80:] = 255
+    frames[2][:, :] = 255
+
+    class Clip:
+        num_frames = 3
+
+        def get_frame(self, n):
+            return SimpleNamespace(get_read_array=lambda plane: frames[n])
+
+    b = SizeBudget(1)
+    clip = Clip()
+    # Flat and still, flat but changing, detailed
+    assert b._measure(clip, 2) == 0
+    assert b._measure(clip, 0) == pytest.approx(127.5)
+    assert b._measure(clip, 1) == pytest.approx(255 / 159 + 127.5)
+
+# vim: ts=4 sw=4 et:
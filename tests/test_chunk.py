@@ -0,0 +1,65 @@
+import pytest
+
+# pyhenkan loads its GUI and VapourSynth as soon as it is imported
+pytest.importorskip('gi')
+pytest.importorskip('vapoursynth')
+
+from pyhenkan.chunk import plan_chunks
+
+
+def test_even_split():
+    assert plan_chunks(100, 4) == [(0, 25), (25, 50), (50, 75), (75, 100)]
+
+
+def test_uneven_split():
+    assert plan_chunks(10, 3) == [(0, 4), (4, 8), (8, 10)]
+
+
+def test_single_chunk():
+    assert plan_chunks(100, 1) == [(0, 100)]
+    assert plan_chunks(100, 0) == [(0, 100)]
+
+
+def test_more_chunks_than_frames():
+    assert plan_chunks(2, 4) == [(0, 1), (1, 2)]
+
+
+def test_chunk_size():
+    # A size wins over the chunk count
+    assert plan_chunks(100, 2, 30) == [(0, 30), (30, 60), (60, 90),
+                                       (90, 100)]
+
+
+def test_snap_to_cut():
+    assert plan_chunks(100, 4, cuts=[20, 57, 80]) == [(0, 20), (20, 57),
+                                                      (57, 80), (80, 100)]
+
+
+def test_snap_to_nearest_cut():
+    assert plan_chunks(100, 2, cuts=[40, 45, 62]) == [(0, 45), (45, 100)]
+
+
+def test_ignore_far_cuts():
+    # Further than half a chunk from the split point
+    assert plan_chunks(100, 2, cuts=[10, 90]) == [(0, 50), (50, 100)]
+
+
+def test_ignore_cuts_out_of_range():
+    assert plan_chunks(100, 2, cuts=[0, 100, 120]) == [(0, 50), (50, 100)]
+
+
+def test_cut_used_once():
+    # The next split point only looks past the last start
+    assert plan_chunks(40, 4, cuts=[15]) == [(0, 15), (15, 20), (20, 30),
+                                             (30, 40)]
+
+
+def test_ranges_cover_every_frame():
+    ranges = plan_chunks(1001, 7, cuts=[3, 140, 299, 500, 501, 870])
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == 1001
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+    assert all(start < end for start, end in ranges)
+
+# vim: ts=4 sw=4 et:
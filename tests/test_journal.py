@@ -0,0 +1,221 @@
+import os
+
+from collections import deque
+from types import SimpleNamespace
+
+import pytest
+
+# pyhenkan loads its GUI and VapourSynth as soon as it is imported
+pytest.importorskip('gi')
+pytest.importorskip('vapoursynth')
+
+import pyhenkan.mediafile as mediafile
+
+from pyhenkan.index import Indexer
+from pyhenkan.journal import Journal
+from pyhenkan.mediafile import MediaFile, resume
+from pyhenkan.queue import Queue, QueueView
+
+
+class Track:
+    def __init__(self, type, tmpfilepath, calls):
+        self.type = type
+        self.enable = True
+        self.codec = SimpleNamespace(library=type.lower())
+        self.path = tmpfilepath
+        self.tmpfilepath = ''
+        self.calls = calls
+
+    def get_tmpfilepath(self):
+        return self.path
+
+    def set_tmpfilepath(self, path):
+        self.tmpfilepath = path
+
+    def transcode(self):
+        self.calls.append(self.type)
+        open(self.path, 'w').close()
+        self.tmpfilepath = self.path
+
+    def get_settings(self):
+        return {}
+
+    def set_settings(self, settings):
+        pass
+
+
+class View(QueueView):
+    def __init__(self):
+        self.notes = []
+
+    def notify(self, text):
+        self.notes.append(text)
+
+    def log(self, text):
+        pass
+
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    j = Journal()
+    monkeypatch.setattr(j, 'path', str(tmp_path / 'queue.sqlite'))
+    monkeypatch.setattr(j, 'db', None)
+    yield j
+    if j.db is not None:
+        j.db.close()
+
+
+@pytest.fixture
+def queue(journal, monkeypatch):
+    q = Queue()
+    monkeypatch.setattr(q, 'waitlist', deque())
+    monkeypatch.setattr(q, 'view', View())
+    # Nothing to index, the tracks are fake
+    monkeypatch.setattr(Indexer, 'submit', lambda self, mf: None)
+    return q
+
+
+@pytest.fixture
+def make(tmp_path, monkeypatch):
+    calls = []
+
+    def make(path=str(tmp_path / 'in.mkv')):
+        if not os.path.exists(path):
+            open(path, 'w').close()
+        mf = MediaFile.__new__(MediaFile)
+        mf.path = path
+        mf.dname, mf.bname = os.path.split(path)
+        mf.tmpd = str(tmp_path / 'in.tmp')
+        mf.oname = 'out.mkv'
+        mf.filters = []
+        mf.dimensions = [0, 0, 0, 0]
+        mf.fps = [0, 1, 0, 1]
+        mf.trim = [0, 0]
+        mf.core = {}
+        mf.optimize = False
+        mf.tracklist = [Track('Video', str(tmp_path / 'video.mkv'), calls),
+                        Track('Audio', str(tmp_path / 'audio.mka'), calls)]
+
+        def mux():
+            calls.append('mux')
+            open(os.path.join(mf.dname, mf.oname), 'w').close()
+        mf.mux = mux
+        return mf
+
+    make.calls = calls
+    # Files resumed from the journal are not parsed again
+    monkeypatch.setattr(mediafile, 'MediaFile', lambda path: make(path))
+    return make
+
+
+def run(queue):
+    queue.start()
+    assert queue.finished.wait(10)
+
+
+def test_add(journal, queue, make):
+    job = make().process()
+    records = journal.load()
+    assert len(records) == 1
+    r = records[0]
+    assert r['id'] == job.id
+    assert r['path'] == job.mediafile.path
+    assert r['status'] == 'Waiting'
+    assert r['settings']['oname'] == 'out.mkv'
+    assert r['steps'] == {0: ('Waiting', job.steps[0].output),
+                          1: ('Waiting', job.steps[1].output),
+                          2: ('Waiting', job.steps[2].output)}
+
+
+def test_status(journal, queue, make):
+    job = make().process()
+    queue.set_status(job.steps[1], 'Done')
+    queue.set_status(job, 'Stopped')
+    r = journal.load()[0]
+    assert r['status'] == 'Stopped'
+    assert r['steps'][1][0] == 'Done'
+    # Nothing left to resume
+    queue.set_status(job, 'Done')
+    assert journal.load() == []
+
+
+def test_skip_done(journal, queue, make):
+    job = make().process()
+    queue.set_status(job.steps[0], 'Done')
+    queue.set_status(job.steps[1], 'Done')
+    open(job.steps[0].output, 'w').close()
+    record = journal.load()[0]
+
+    mf = make()
+    job = mf.process(record)
+    assert job.id == record['id']
+    assert job.steps[0].status == 'Done'
+    assert mf.tracklist[0].tmpfilepath == job.steps[0].output
+    # Its output is gone, encoded again
+    assert job.steps[1].status == 'Waiting'
+    assert job.steps[2].status == 'Waiting'
+
+
+def test_skip_changed_output(journal, queue, make):
+    job = make().process()
+    queue.set_status(job.steps[0], 'Done')
+    open(job.steps[0].output, 'w').close()
+    record = journal.load()[0]
+
+    mf = make()
+    mf.tracklist[0].path += '.new'
+    job = mf.process(record)
+    assert job.steps[0].status == 'Waiting'
+
+
+def test_resume(journal, queue, make):
+    job = make().process()
+    queue.set_status(job.steps[0], 'Done')
+    queue.set_status(job.steps[1], 'Running')
+    queue.set_status(job, 'Running')
+    open(job.steps[0].output, 'w').close()
+    queue.waitlist.clear()
+
+    jobs = resume()
+    assert len(jobs) == 1
+    run(queue)
+    # The video was encoded last time
+    assert make.calls == ['Audio', 'mux']
+    assert jobs[0].status == 'Done'
+    assert journal.load() == []
+
+
+def test_resume_done(journal, queue, make):
+    # Interrupted right before the job was marked done
+    job = make().process()
+    for step in job.steps:
+        queue.set_status(step, 'Done')
+        open(step.output, 'w').close()
+    queue.waitlist.clear()
+
+    jobs = resume()
+    run(queue)
+    assert make.calls == []
+    assert jobs[0].status == 'Done'
+
+
+def test_resume_failed(journal, queue, make):
+    job = make().process()
+    queue.set_status(job, 'Failed')
+    queue.waitlist.clear()
+
+    assert resume() == []
+    assert len(queue.view.notes) == 1
+    assert journal.load() == []
+
+
+def test_resume_missing_source(journal, queue, make, tmp_path):
+    mf = make(str(tmp_path / 'gone.mkv'))
+    mf.process()
+    os.remove(mf.path)
+    queue.waitlist.clear()
+
+    assert resume() == []
+    assert journal.load() == []
+
+# vim: ts=4 sw=4 et:
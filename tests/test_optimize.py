@@ -0,0 +1,125 @@
+import pytest
+
+# pyhenkan loads its GUI and VapourSynth as soon as it is imported
+pytest.importorskip('gi')
+pytest.importorskip('vapoursynth')
+
+from pyhenkan.optimize import FilterOptimizer, get_cost
+from pyhenkan.plugin import (CropAbs, CropRel, FluxSmoothT, LWLibavSource,
+                             Point, Spline36)
+
+
+def make(cls, **args):
+    p = cls()
+    p.args.update(args)
+    return p
+
+
+def test_cost_skips_source():
+    filters = [LWLibavSource(), make(Spline36, width=1280, height=720)]
+    assert get_cost(filters, 1920, 1080) == 1920 * 1080
+
+
+def test_crop_into_resize():
+    crop = make(CropRel, top=140, bottom=140)
+    resize = make(Spline36, width=1280, height=534)
+    o = FilterOptimizer(1920, 1080)
+    filters = o.optimize([LWLibavSource(), crop, resize])
+    assert len(filters) == 2
+    assert isinstance(filters[0], LWLibavSource)
+    r = filters[1]
+    assert isinstance(r, Spline36)
+    assert r.args['width'] == 1280
+    assert r.args['height'] == 534
+    assert r.args['src_left'] == 0
+    assert r.args['src_top'] == 140
+    assert r.args['src_width'] == 1920
+    assert r.args['src_height'] == 800
+    # The chain it was given is left alone
+    assert 'src_top' not in resize.args
+    assert o.before == 1920 * 1080 + 1920 * 800
+    assert o.after == 1920 * 1080
+    assert o.get_report() == ['Saves 1536000 pixels per frame (43%)']
+
+
+def test_crops_in_a_row():
+    filters = FilterOptimizer(1920, 1080).optimize([
+        make(CropRel, left=10, right=10, top=20, bottom=20),
+        make(CropAbs, width=1000, height=800, left=5, top=6),
+        FluxSmoothT()])
+    assert len(filters) == 2
+    c = filters[0]
+    assert isinstance(c, CropAbs)
+    assert (c.args['left'], c.args['top']) == (15, 26)
+    assert (c.args['width'], c.args['height']) == (1000, 800)
+    assert isinstance(filters[1], FluxSmoothT)
+
+
+def test_single_crop_kept():
+    crop = make(CropRel, left=8, right=8)
+    f = FluxSmoothT()
+    assert FilterOptimizer(1920, 1080).optimize([crop, f]) == [crop, f]
+
+
+def test_trailing_crop():
+    crop = make(CropAbs, width=1280, height=720)
+    assert FilterOptimizer(1920, 1080).optimize([crop]) == [crop]
+
+
+def test_resize_keeps_format():
+    # Same size, but converts the format
+    resize = make(Point, format=1)
+    filters = FilterOptimizer(1920, 1080).optimize([resize])
+    assert len(filters) == 1
+    assert filters[0].args['format'] == 1
+    assert filters[0].args['width'] == 1920
+    assert filters[0].args['height'] == 1080
+
+
+def test_resize_keeps_one_side():
+    filters = FilterOptimizer(1920, 1080).optimize([
+        make(Spline36, height=720)])
+    assert filters[0].args['width'] == 1920
+    assert filters[0].args['height'] == 720
+
+
+def test_all_identity():
+    source = LWLibavSource()
+    o = FilterOptimizer(1920, 1080)
+    filters = o.optimize([
+        source, make(CropRel), make(CropAbs, width=1920, height=1080),
+        make(Spline36), make(Point, width=1920, height=1080)])
+    assert filters == [source]
+    assert o.before == 4 * 1920 * 1080
+    assert o.after == 0
+    # Only the filters count, decoding the source is not saved
+    assert o.get_report() == ['Saves 8294400 pixels per frame (100%)']
+
+
+def test_unknown_size():
+    filters = [make(CropRel), make(Spline36)]
+    o = FilterOptimizer(0, 0)
+    assert o.optimize(filters) == filters
+    assert o.get_report() == []
+
+
+def test_nothing_to_save():
+    o = FilterOptimizer(1920, 1080)
+    o.optimize([FluxSmoothT()])
+    assert o.get_report() == ['Saves 0 pixels per frame (0%)']
+
+
+def test_denoise_before_downscale():
+    o = FilterOptimizer(1920, 1080)
+    o.optimize([FluxSmoothT(), make(Spline36, width=960, height=540)])
+    assert o.warnings == [
+        'FluxSmoothT runs on 1920x1080, 4.0x the pixels of the Spline36 '
+        'output at 960x540']
+
+
+def test_denoise_after_downscale():
+    o = FilterOptimizer(1920, 1080)
+    o.optimize([make(Spline36, width=960, height=540), FluxSmoothT()])
+    assert o.warnings == []
+
+# vim: ts=4 sw=4 et:
@@ -0,0 +1,133 @@
+import pytest
+
+# pyhenkan loads its GUI and VapourSynth as soon as it is imported
+pytest.importorskip('gi')
+pytest.importorskip('vapoursynth')
+
+from pyhenkan.progress import FFmpegProgress
+
+
+def feed(progress, block):
+    for line in block.strip().splitlines():
+        progress.feed(line)
+
+
+def test_block():
+    p = FFmpegProgress(frames=1000)
+    feed(p, '''
+frame=250
+fps=50.0
+bitrate=1234.5kbits/s
+out_time_us=10000000
+speed=2.0x
+progress=continue
+''')
+    assert p.frame == 250
+    assert p.fps == 50.0
+    assert p.bitrate == 1234.5
+    assert p.speed == 2.0
+    assert p.out_time_us == 10000000
+    assert not p.done
+    assert p.fraction == 0.25
+    assert p.eta == 15.0
+
+
+def test_callback_once_per_block():
+    blocks = []
+    p = FFmpegProgress(callback=lambda p: blocks.append(p.frame))
+    feed(p, '''
+frame=1
+progress=continue
+frame=2
+progress=continue
+''')
+    assert blocks == [1, 2]
+
+
+def test_end():
+    p = FFmpegProgress(frames=1000)
+    feed(p, '''
+frame=999
+progress=end
+''')
+    assert p.done
+    assert p.fraction == 1.0
+    assert p.eta == 0.0
+
+
+def test_duration():
+    # Audio has no frames to go by
+    p = FFmpegProgress(duration=40)
+    feed(p, '''
+out_time_us=10000000
+speed=5.0x
+progress=continue
+''')
+    assert p.fraction == 0.25
+    assert p.eta == 6.0
+
+
+def test_out_time_ms():
+    # Older ffmpeg, microseconds despite the name
+    p = FFmpegProgress(duration=40)
+    feed(p, '''
+out_time_ms=20000000
+progress=continue
+''')
+    assert p.out_time_us == 20000000
+    assert p.fraction == 0.5
+
+
+def test_not_available():
+    p = FFmpegProgress(duration=10)
+    feed(p, '''
+frame=120
+fps=24.0
+bitrate=800.0kbits/s
+out_time_us=5000000
+speed=1.5x
+progress=continue
+frame=N/A
+fps=N/A
+bitrate=N/A
+out_time_us=N/A
+speed=N/A
+progress=continue
+''')
+    assert p.frame == 120
+    assert p.fps == 24.0
+    assert p.bitrate == 800.0
+    assert p.out_time_us == 5000000
+    assert p.speed == 1.5
+    assert p.fraction == 0.5
+
+
+def test_unknown_length():
+    p = FFmpegProgress()
+    feed(p, '''
+frame=10
+out_time_us=1000000
+progress=continue
+''')
+    assert p.fraction == 0.0
+    assert p.eta is None
+
+
+def test_garbage():
+    p = FFmpegProgress(frames=100)
+    feed(p, '''
+not a field
+frame=-5
+progress=continue
+''')
+    assert p.frame == 0
+    assert p.fraction == 0.0
+
+
+def test_read_bytes():
+    p = FFmpegProgress(frames=100)
+    p.read([b'frame=50\n', b'progress=end\n'])
+    assert p.frame == 50
+    assert p.done
+
+# vim: ts=4 sw=4 et:
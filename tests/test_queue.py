@@ -0,0 +1,131 @@
+import subprocess
+import time
+
+from collections import deque
+from threading import Barrier, Event, Lock
+
+import pytest
+
+# pyhenkan loads its GUI and VapourSynth as soon as it is imported
+pytest.importorskip('gi')
+pytest.importorskip('vapoursynth')
+
+from pyhenkan.journal import Journal
+from pyhenkan.queue import Job, Queue, QueueView
+
+
+class MediaFile:
+    def __init__(self, path):
+        self.path = path
+        self.bname = 'in.mkv'
+        self.cleaned = False
+
+    def get_settings(self):
+        return {}
+
+    def clean(self):
+        self.cleaned = True
+
+
+class View(QueueView):
+    def log(self, text):
+        pass
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    journal = Journal()
+    monkeypatch.setattr(journal, 'path', str(tmp_path / 'queue.sqlite'))
+    monkeypatch.setattr(journal, 'db', None)
+    q = Queue()
+    monkeypatch.setattr(q, 'waitlist', deque())
+    monkeypatch.setattr(q, 'running', [])
+    monkeypatch.setattr(q, 'procs', {})
+    monkeypatch.setattr(q, 'view', View())
+    yield q
+    q.stop()
+    if journal.db is not None:
+        journal.db.close()
+
+
+@pytest.fixture
+def job(tmp_path):
+    return Job(MediaFile(str(tmp_path / 'in.mkv')))
+
+
+def run(queue, job):
+    queue.add(job)
+    queue.start()
+    assert queue.finished.wait(10)
+    return job.future.result()
+
+
+def test_order(queue, job):
+    done = []
+    lock = Lock()
+
+    def step(name):
+        def run():
+            with lock:
+                done.append(name)
+        return run
+
+    a = job.add_step('a', step('a'))
+    b = job.add_step('b', step('b'))
+    c = job.add_step('c', step('c'), [a])
+    job.add_step('mux', step('mux'), [b, c])
+    assert run(queue, job) == 'Done'
+    assert done.index('c') > done.index('a')
+    assert done[-1] == 'mux'
+    assert [s.status for s in job.steps] == ['Done'] * 4
+    assert job.mediafile.cleaned
+    # Nothing left to resume
+    assert Journal().load() == []
+
+
+def test_parallel(queue, job):
+    # Never gets through unless both steps run at once
+    barrier = Barrier(2, timeout=5)
+    a = job.add_step('a', barrier.wait)
+    b = job.add_step('b', barrier.wait)
+    job.add_step('mux', lambda: None, [a, b])
+    assert run(queue, job) == 'Done'
+
+
+def test_resumed_steps(queue, job):
+    done = []
+    a = job.add_step('a', lambda: done.append('a'))
+    job.add_step('mux', lambda: done.append('mux'), [a])
+    a.status = 'Done'
+    assert run(queue, job) == 'Done'
+    assert done == ['mux']
+
+
+def test_failure(queue, job):
+    started = Event()
+    muxed = []
+
+    def fail():
+        started.wait(5)
+        raise RuntimeError('Broken')
+
+    def encode():
+        proc = queue.popen(['sleep', '60'])
+        started.set()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, 'sleep')
+
+    a = job.add_step('audio', fail)
+    v = job.add_step('video', encode)
+    job.add_step('mux', lambda: muxed.append(True), [a, v])
+    start = time.monotonic()
+    assert run(queue, job) == 'Failed'
+    # The video encode was killed, not waited for
+    assert time.monotonic() - start < 10
+    assert [s.status for s in job.steps] == ['Failed', 'Stopped', 'Failed']
+    assert not muxed
+    assert not job.mediafile.cleaned
+    # Not resumed, it would fail again
+    assert Journal().load()[0]['status'] == 'Failed'
+
+# vim: ts=4 sw=4 et:
@@ -0,0 +1,337 @@
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+# pyhenkan loads its GUI and VapourSynth as soon as it is imported, the
+# workers as well
+pytest.importorskip('gi')
+vs = pytest.importorskip('vapoursynth')
+
+import pyhenkan.worker as worker
+
+from pyhenkan.chunk import ChunkEncoder
+from pyhenkan.codec import X264
+from pyhenkan.plugin import LWLibavSource
+from pyhenkan.queue import Queue, QueueView
+from pyhenkan.worker import WorkerError, WorkerPool
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET = 'test'
+# Length of the test source, in frames
+FRAMES = 300
+
+
+def can_encode():
+    if not shutil.which('ffmpeg'):
+        return False
+    encoders = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL).stdout
+    return b'libx264' in encoders and hasattr(vs.get_core(), 'lsmas')
+
+
+needs_encoders = pytest.mark.skipif(
+    not can_encode(), reason='needs ffmpeg with libx264 and L-SMASH Works')
+
+
+class Worker:
+    def __init__(self, path, log, env):
+        self.address = 'unix:' + path
+        self.path = path
+        self.log = log
+        with open(log, 'w') as f:
+            # A session of its own, its encoders are killed along with it
+            self.proc = subprocess.Popen(
+                [sys.executable, '-m', 'pyhenkan.worker', self.address],
+                env=env, stdout=f, stderr=subprocess.STDOUT,
+                start_new_session=True)
+
+    def wait(self, timeout=60):
+        end = time.monotonic() + timeout
+        while not os.path.exists(self.path):
+            if self.proc.poll() is not None or time.monotonic() > end:
+                pytest.fail('Worker did not start:\n' + self.get_log())
+            time.sleep(0.1)
+
+    def get_log(self):
+        with open(self.log) as f:
+            return f.read()
+
+    def get_encodes(self):
+        return self.get_log().count('Encode frames')
+
+    def signal(self, sig):
+        try:
+            os.killpg(self.proc.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def kill(self):
+        self.signal(signal.SIGCONT)
+        self.signal(signal.SIGKILL)
+        self.proc.wait()
+
+
+class View(QueueView):
+    def __init__(self):
+        self.lines = []
+
+    def log(self, text):
+        self.lines.append(text)
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    q = Queue()
+    # A stopped queue gives up on the first lost worker
+    monkeypatch.setattr(q, 'idle', False)
+    monkeypatch.setattr(q, 'view', View())
+    monkeypatch.setattr(q, 'pool', None)
+    return q
+
+
+@pytest.fixture
+def spawn(tmp_path):
+    env = dict(os.environ, PYHENKAN_SECRET=SECRET, PYTHONUNBUFFERED='1',
+               XDG_CACHE_HOME=str(tmp_path / 'cache'),
+               XDG_CONFIG_HOME=str(tmp_path / 'config'),
+               XDG_DATA_HOME=str(tmp_path / 'data'))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [p for p in [os.environ.get('PYTHONPATH')] if p])
+    workers = []
+
+    def spawn(n):
+        new = []
+        for i in range(len(workers), len(workers) + n):
+            new.append(Worker(str(tmp_path / 'worker{}.sock'.format(i)),
+                              str(tmp_path / 'worker{}.log'.format(i)),
+                              env))
+        workers.extend(new)
+        for w in new:
+            w.wait()
+        return new
+
+    yield spawn
+    for w in workers:
+        w.kill()
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = str(tmp_path / 'source.mkv')
+    subprocess.run(['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i',
+                    'testsrc2=size=640x360:rate=25', '-frames:v',
+                    str(FRAMES), '-pix_fmt', 'yuv420p', '-c:v', 'ffv1',
+                    path], check=True)
+    return path
+
+
+def get_work(**kwargs):
+    # Refused before the source is even opened
+    work = dict(source='source.mkv',
+                filters=[LWLibavSource().get_settings()], trim=[0, 0],
+                threads=1, max_cache_size=0, cmds=[['sh', '-c', 'true']],
+                remux=None, files={}, output='out.mp4', start=0, end=1,
+                y4m=True, prefetch=0, standalone=False)
+    work.update(kwargs)
+    return work
+
+
+def get_clip(path, tmp_path):
+    return vs.get_core().lsmas.LWLibavSource(
+        path, cachefile=str(tmp_path / (os.path.basename(path) + '.lwi')))
+
+
+def encode(pool, source, tmp_path, chunks, preset='ultrafast'):
+    queue = Queue()
+    queue.pool = pool
+    codec = X264()
+    codec.preset = preset
+    codec.chunks = chunks
+    work = dict(source=source, filters=[LWLibavSource().get_settings()],
+                trim=[0, 0], threads=1, max_cache_size=0)
+    output = str(tmp_path / 'out')
+    ChunkEncoder(codec, get_clip(source, tmp_path), output,
+                 source=work).encode()
+    return output + '.' + codec.container
+
+
+def test_refused_command(queue, spawn, tmp_path):
+    w, = spawn(1)
+    pool = WorkerPool([w.address], SECRET.encode())
+    with pytest.raises(WorkerError, match='Refused to run sh'):
+        pool.encode(get_work(), str(tmp_path / 'out.mp4'), lambda c: None)
+    # Still alive, the work was at fault
+    assert pool.failures[w.address] == 0
+    assert list(pool.free) == [w.address]
+    assert not os.path.exists(tmp_path / 'out.mp4.part')
+
+
+@pytest.mark.parametrize('name', ['../out.mp4', '/etc/passwd', '..', ''])
+def test_refused_output(queue, spawn, tmp_path, name):
+    w, = spawn(1)
+    pool = WorkerPool([w.address], SECRET.encode())
+    work = get_work(cmds=[['ffmpeg', '-version']], output=name)
+    with pytest.raises(WorkerError, match='Refused file name'):
+        pool.encode(work, str(tmp_path / 'out.mp4'), lambda c: None)
+
+
+def test_refused_file(queue, spawn, tmp_path):
+    w, = spawn(1)
+    pool = WorkerPool([w.address], SECRET.encode())
+    work = get_work(cmds=[['ffmpeg', '-version']],
+                    files={'../../.bashrc': 'exit\n'})
+    with pytest.raises(WorkerError, match='Refused file name'):
+        pool.encode(work, str(tmp_path / 'out.mp4'), lambda c: None)
+
+
+def test_wrong_secret(queue, spawn, tmp_path):
+    w, = spawn(1)
+    pool = WorkerPool([w.address], b'wrong')
+    with pytest.raises(WorkerError, match='Authentication failed'):
+        pool.encode(get_work(), str(tmp_path / 'out.mp4'), lambda c: None)
+    assert pool.failures[w.address] == 0
+
+
+def test_stalled_worker(queue, spawn, tmp_path, monkeypatch):
+    monkeypatch.setattr(worker, 'TIMEOUT', 1)
+    a, b = spawn(2)
+    # Still accepts connections, but never says a word
+    a.signal(signal.SIGSTOP)
+    pool = WorkerPool([a.address, b.address], SECRET.encode())
+    start = time.monotonic()
+    # Handed over to the other worker, which answers
+    with pytest.raises(WorkerError, match=re.escape(b.address)):
+        pool.encode(get_work(), str(tmp_path / 'out.mp4'), lambda c: None)
+    assert time.monotonic() - start >= 1
+    assert pool.failures == {a.address: 1, b.address: 0}
+    assert [d[1] for d in pool.dead] == [a.address]
+    assert queue.view.lines[0].startswith('Lost worker ' + a.address)
+
+
+def test_killed_worker(queue, spawn, tmp_path):
+    a, b = spawn(2)
+    a.kill()
+    pool = WorkerPool([a.address, b.address], SECRET.encode())
+    with pytest.raises(WorkerError, match=re.escape(b.address)):
+        pool.encode(get_work(), str(tmp_path / 'out.mp4'), lambda c: None)
+    assert pool.failures == {a.address: 1, b.address: 0}
+
+
+class RecordingPool(WorkerPool):
+    def __init__(self, addresses):
+        WorkerPool.__init__(self, addresses, SECRET.encode())
+        self.delays = []
+
+    def release(self, address, alive=True):
+        now = time.monotonic()
+        WorkerPool.release(self, address, alive)
+        if not alive:
+            self.delays.append(self.dead[-1][0] - now)
+
+
+def test_backoff(queue, tmp_path, monkeypatch):
+    monkeypatch.setattr(worker, 'BACKOFF', 0.05)
+    monkeypatch.setattr(worker, 'MAX_BACKOFF', 0.15)
+    a = 'unix:' + str(tmp_path / 'a.sock')
+    b = 'unix:' + str(tmp_path / 'b.sock')
+    pool = RecordingPool([a, b])
+    progress = []
+    start = time.monotonic()
+    with pytest.raises(OSError):
+        pool.encode(get_work(), str(tmp_path / 'out.mp4'), progress.append)
+    elapsed = time.monotonic() - start
+    # Doubled on every failure of the same worker, up to the maximum
+    assert pool.delays == pytest.approx([0.05, 0.05, 0.1, 0.1, 0.15],
+                                        abs=0.01)
+    # Gave up after the fifth attempt, both workers were tried in turn
+    assert pool.failures == {a: 3, b: 2}
+    assert len(queue.view.lines) == 5
+    assert elapsed >= 0.05 + 0.1
+    # Progress started over on every retry
+    assert progress == [0] * 4
+
+
+def test_backoff_reset(queue, spawn, tmp_path, monkeypatch):
+    monkeypatch.setattr(worker, 'BACKOFF', 0.05)
+    w, = spawn(1)
+    pool = WorkerPool([w.address], SECRET.encode())
+    pool.release(pool.acquire(), False)
+    pool.release(pool.acquire(), False)
+    assert pool.failures[w.address] == 2
+    # Back up, the next failure waits the shortest time again
+    with pytest.raises(WorkerError):
+        pool.encode(get_work(), str(tmp_path / 'out.mp4'), lambda c: None)
+    assert pool.failures[w.address] == 0
+    assert list(pool.free) == [w.address]
+
+
+def test_stopped_queue(queue, tmp_path):
+    a = 'unix:' + str(tmp_path / 'a.sock')
+    pool = WorkerPool([a, a], SECRET.encode())
+    queue.idle = True
+    # Lost workers are not tried again
+    with pytest.raises(OSError):
+        pool.encode(get_work(), str(tmp_path / 'out.mp4'), lambda c: None)
+    assert pool.failures == {a: 1}
+    pool.acquire()
+    # No slot left, waiting for one would never end
+    with pytest.raises(WorkerError, match='Queue stopped'):
+        pool.acquire()
+
+
+@needs_encoders
+def test_chunks(queue, spawn, source, tmp_path):
+    workers = spawn(3)
+    pool = WorkerPool([w.address for w in workers], SECRET.encode())
+    output = encode(pool, source, tmp_path, 3)
+    assert get_clip(output, tmp_path).num_frames == FRAMES
+    # One chunk each, side by side
+    assert [w.get_encodes() for w in workers] == [1, 1, 1]
+    assert not [f for f in os.listdir(tmp_path) if f.startswith('out_')]
+
+
+class StallingPool(WorkerPool):
+    # Stops a worker as soon as it is half way through a chunk
+    def __init__(self, addresses, victim):
+        WorkerPool.__init__(self, addresses, SECRET.encode())
+        self.victim = victim
+        self.stopped = None
+
+    def _run(self, address, work, path, progress):
+        def stall(current):
+            if address == self.victim.address and self.stopped is None:
+                self.victim.signal(signal.SIGSTOP)
+                self.stopped = time.monotonic()
+            progress(current)
+        WorkerPool._run(self, address, work, path, stall)
+
+
+@needs_encoders
+def test_stalled_worker_mid_chunk(queue, spawn, source, tmp_path,
+                                  monkeypatch):
+    # Longer than a heartbeat, a live worker is never silent for that long
+    monkeypatch.setattr(worker, 'TIMEOUT', worker.HEARTBEAT + 1)
+    # Not probed again before the other worker is free
+    monkeypatch.setattr(worker, 'BACKOFF', 600)
+    a, b = spawn(2)
+    pool = StallingPool([a.address, b.address], a)
+    # Slow enough for the first progress report to come mid-chunk
+    output = encode(pool, source, tmp_path, 2, 'veryslow')
+    assert pool.stopped is not None
+    assert get_clip(output, tmp_path).num_frames == FRAMES
+    assert pool.failures == {a.address: 1, b.address: 0}
+    lost = [line for line in queue.view.lines
+            if line.startswith('Lost worker')]
+    assert lost == ['Lost worker {}: timed out'.format(a.address)]
+    # Its chunk was encoded again by the other worker
+    assert a.get_encodes() == 1
+    assert b.get_encodes() == 2
+
+# vim: ts=4 sw=4 et: